@@ -0,0 +1,467 @@
+"""
+Проекция бонусного счёта клиента с разбивкой по датам сгорания.
+
+client_bonus_ledger хранит на каждого клиента одну строку: баланс и корзины
+[(дата сгорания по МСК | None, сумма)], отсортированные по дате. Корзины
+обновляются в той же транзакции, что и запись в bonus_transactions; списания
+берут из корзин, сгорающих раньше всех. Остальные сервисы RaketaClean пишут
+в bonus_transactions напрямую, поэтому проекцию периодически сверяют и
+пересобирают (python -m app.bonus_ledger verify|rebuild).
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import time
+from datetime import date, datetime, timezone
+from typing import Any, Optional
+from zoneinfo import ZoneInfo
+
+import asyncpg
+from dotenv import load_dotenv
+
+from app.db import batch_connection, close_pool, get_pool, init_pool
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+MOSCOW_TZ = ZoneInfo("Europe/Moscow")
+BONUS_LEDGER_BATCH = int(os.getenv("BONUS_LEDGER_BATCH", "2000") or "2000")
+
+Bucket = list  # [iso-дата или None, сумма]
+
+
+async def ensure_bonus_ledger_schema(conn: asyncpg.Connection) -> None:
+    await conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS client_bonus_ledger (
+            client_id bigint PRIMARY KEY REFERENCES clients(id) ON DELETE CASCADE,
+            balance integer NOT NULL DEFAULT 0,
+            next_expires_on date,
+            next_expiring integer NOT NULL DEFAULT 0,
+            buckets jsonb NOT NULL DEFAULT '[]'::jsonb,
+            last_tx_id bigint,
+            updated_at timestamptz NOT NULL DEFAULT NOW()
+        );
+        """
+    )
+    await conn.execute(
+        """
+        CREATE INDEX IF NOT EXISTS client_bonus_ledger_next_expires_idx
+        ON client_bonus_ledger (next_expires_on)
+        WHERE next_expires_on IS NOT NULL;
+        """
+    )
+
+
+def expiry_day(expires_at: Optional[datetime]) -> Optional[str]:
+    if expires_at is None:
+        return None
+    if expires_at.tzinfo is None:
+        expires_at = expires_at.replace(tzinfo=timezone.utc)
+    return expires_at.astimezone(MOSCOW_TZ).date().isoformat()
+
+
+def _sort_key(bucket: Bucket) -> tuple[int, str]:
+    # Корзины с датой — по возрастанию, бессрочная — в конце.
+    return (1, "") if bucket[0] is None else (0, bucket[0])
+
+
+def apply_delta(buckets: list[Bucket], delta: int, expires_at: Optional[datetime]) -> list[Bucket]:
+    """Применяет одну транзакцию к корзинам. Начисление — в свою корзину, списание — FIFO по дате сгорания."""
+    buckets = [list(b) for b in buckets]
+    if delta >= 0:
+        day = expiry_day(expires_at)
+        for bucket in buckets:
+            if bucket[0] == day:
+                bucket[1] += delta
+                break
+        else:
+            buckets.append([day, delta])
+            buckets.sort(key=_sort_key)
+    else:
+        remaining = -delta
+        for bucket in buckets:
+            if remaining == 0:
+                break
+            if bucket[1] > 0:
+                take = min(bucket[1], remaining)
+                bucket[1] -= take
+                remaining -= take
+        if remaining:
+            # Ушли в минус (списали больше, чем начисляли) — долг держим в бессрочной корзине.
+            for bucket in buckets:
+                if bucket[0] is None:
+                    bucket[1] -= remaining
+                    break
+            else:
+                buckets.append([None, -remaining])
+    return [b for b in buckets if b[1] != 0]
+
+
+def summarize(buckets: list[Bucket]) -> tuple[int, Optional[date], int]:
+    """Баланс, ближайшая дата сгорания и сколько сгорит в эту дату."""
+    balance = sum(b[1] for b in buckets)
+    for day, amount in buckets:
+        if day is not None and amount > 0:
+            return balance, date.fromisoformat(day), amount
+    return balance, None, 0
+
+
+def alive_expiry(buckets: list[Bucket], today: date) -> tuple[Optional[date], int]:
+    """Ближайшая ещё не наступившая дата сгорания и сумма в ней."""
+    for day, amount in buckets:
+        if day is not None and amount > 0 and date.fromisoformat(day) >= today:
+            return date.fromisoformat(day), amount
+    return None, 0
+
+
+def load_buckets(raw: Any) -> list[Bucket]:
+    if raw is None:
+        return []
+    return json.loads(raw) if isinstance(raw, str) else list(raw)
+
+
+async def _write_row(conn: asyncpg.Connection, client_id: int, buckets: list[Bucket], last_tx_id: Optional[int]) -> None:
+    balance, next_on, next_amount = summarize(buckets)
+    await conn.execute(
+        """
+        UPDATE client_bonus_ledger
+        SET balance = $2,
+            next_expires_on = $3,
+            next_expiring = $4,
+            buckets = $5::jsonb,
+            last_tx_id = COALESCE($6, last_tx_id),
+            updated_at = NOW()
+        WHERE client_id = $1
+        """,
+        client_id,
+        balance,
+        next_on,
+        next_amount,
+        json.dumps(buckets),
+        last_tx_id,
+    )
+
+
+async def record_bonus_transaction(
+    conn: asyncpg.Connection,
+    client_id: int,
+    delta: int,
+    reason: str,
+    expires_at: Optional[datetime] = None,
+    order_id: Optional[int] = None,
+) -> int:
+    """Пишет транзакцию в bonus_transactions и сразу применяет её к проекции. Вызывать внутри транзакции."""
+    tx_id = await conn.fetchval(
+        """
+        INSERT INTO bonus_transactions(client_id, order_id, delta, reason, expires_at)
+        VALUES ($1, $2, $3, $4, $5)
+        RETURNING id
+        """,
+        client_id,
+        order_id,
+        delta,
+        reason,
+        expires_at,
+    )
+    await apply_bonus_transaction(conn, client_id, delta, expires_at, tx_id)
+    return tx_id
+
+
+async def apply_bonus_transaction(
+    conn: asyncpg.Connection,
+    client_id: int,
+    delta: int,
+    expires_at: Optional[datetime],
+    tx_id: Optional[int],
+) -> None:
+    """Применяет уже записанную транзакцию к проекции (строка клиента блокируется до конца транзакции)."""
+    await conn.execute(
+        "INSERT INTO client_bonus_ledger (client_id) VALUES ($1) ON CONFLICT (client_id) DO NOTHING",
+        client_id,
+    )
+    raw = await conn.fetchval(
+        "SELECT buckets FROM client_bonus_ledger WHERE client_id = $1 FOR UPDATE",
+        client_id,
+    )
+    await _write_row(conn, client_id, apply_delta(load_buckets(raw), delta, expires_at), tx_id)
+
+
+async def fetch_ledger(conn: asyncpg.Connection, client_id: int) -> Optional[tuple[int, list[Bucket]]]:
+    """Баланс и корзины клиента одним чтением по первичному ключу; None, если проекции ещё нет."""
+    row = await conn.fetchrow(
+        "SELECT balance, buckets FROM client_bonus_ledger WHERE client_id = $1",
+        client_id,
+    )
+    if row is None:
+        return None
+    return int(row["balance"]), load_buckets(row["buckets"])
+
+
+async def rebuild_client(conn: asyncpg.Connection, client_id: int) -> None:
+    """Пересобирает проекцию одного клиента из bonus_transactions (например, после merge_clients)."""
+    rows = await conn.fetch(
+        """
+        SELECT id, delta, expires_at FROM bonus_transactions
+        WHERE client_id = $1
+        ORDER BY created_at, id
+        """,
+        client_id,
+    )
+    buckets: list[Bucket] = []
+    for row in rows:
+        buckets = apply_delta(buckets, int(row["delta"]), row["expires_at"])
+    await conn.execute(
+        "INSERT INTO client_bonus_ledger (client_id) VALUES ($1) ON CONFLICT (client_id) DO NOTHING",
+        client_id,
+    )
+    await _write_row(conn, client_id, buckets, rows[-1]["id"] if rows else None)
+
+
+# --- история для клиента ---
+
+
+async def count_bonus_history(conn: asyncpg.Connection, client_id: int) -> int:
+    return int(
+        await conn.fetchval("SELECT COUNT(*) FROM bonus_transactions WHERE client_id = $1", client_id) or 0
+    )
+
+
+async def fetch_bonus_history_page(
+    conn: asyncpg.Connection,
+    client_id: int,
+    limit: int,
+    cursor: Optional[tuple[datetime, int]] = None,
+    newer: bool = False,
+) -> tuple[list[asyncpg.Record], bool]:
+    """
+    Страница истории от новых к старым, keyset по (created_at, id).
+    cursor — граница соседней страницы; newer=True листает назад, к более новым.
+    Возвращает строки и признак, что в направлении листания есть ещё.
+    """
+    if cursor is None:
+        rows = await conn.fetch(
+            """
+            SELECT id, delta, reason, expires_at, created_at
+            FROM bonus_transactions
+            WHERE client_id = $1
+            ORDER BY created_at DESC, id DESC
+            LIMIT $2
+            """,
+            client_id,
+            limit + 1,
+        )
+    elif newer:
+        rows = await conn.fetch(
+            """
+            SELECT id, delta, reason, expires_at, created_at
+            FROM bonus_transactions
+            WHERE client_id = $1 AND (created_at, id) > ($2, $3)
+            ORDER BY created_at, id
+            LIMIT $4
+            """,
+            client_id,
+            cursor[0],
+            cursor[1],
+            limit + 1,
+        )
+    else:
+        rows = await conn.fetch(
+            """
+            SELECT id, delta, reason, expires_at, created_at
+            FROM bonus_transactions
+            WHERE client_id = $1 AND (created_at, id) < ($2, $3)
+            ORDER BY created_at DESC, id DESC
+            LIMIT $4
+            """,
+            client_id,
+            cursor[0],
+            cursor[1],
+            limit + 1,
+        )
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if newer:
+        rows.reverse()
+    return rows, has_more
+
+
+# --- сверка и пересборка ---
+
+
+async def reconcile(*, apply: bool, batch_size: int = BONUS_LEDGER_BATCH) -> dict[str, int]:
+    """
+    Потоково сверяет проекцию с bonus_transactions. Транзакции читаются курсором
+    по индексу (client_id, created_at DESC, id DESC) в снимке REPEATABLE READ, расхождения
+    накапливаются пачками и при apply=True записываются одним запросом на пачку.
+    Курсор и поиск осиротевших строк идут по отдельному соединению без лимита
+    на запрос, запись — через пул.
+    Снимок может отстать от живых apply_bonus_transaction: строку, в которую уже
+    применена более новая транзакция (last_tx_id больше), сверка не трогает.
+    """
+    stats = {
+        "clients": 0,
+        "transactions": 0,
+        "mismatched": 0,
+        "missing": 0,
+        "orphaned": 0,
+        "balance_drift": 0,
+        "skipped_newer": 0,
+    }
+    pool = get_pool()
+    started = time.monotonic()
+
+    async with batch_connection("bonus-ledger-reconcile") as reader, pool.acquire() as writer:
+        pending: dict[int, tuple[list[Bucket], int]] = {}
+
+        async def flush() -> None:
+            if not pending:
+                return
+            ids = list(pending)
+            existing = {
+                r["client_id"]: (load_buckets(r["buckets"]), r["bonus_balance"])
+                for r in await writer.fetch(
+                    """
+                    SELECT c.id AS client_id, l.buckets, c.bonus_balance
+                    FROM clients c
+                    LEFT JOIN client_bonus_ledger l ON l.client_id = c.id
+                    WHERE c.id = ANY($1::bigint[])
+                    """,
+                    ids,
+                )
+            }
+            changed: list[tuple[int, list[Bucket], int]] = []
+            for client_id, (buckets, last_tx_id) in pending.items():
+                if client_id not in existing:
+                    continue  # клиента удалили, пока шла сверка
+                current, bonus_balance = existing[client_id]
+                if bonus_balance is not None and summarize(buckets)[0] != bonus_balance:
+                    stats["balance_drift"] += 1
+                if current is None or current == []:
+                    if buckets:
+                        stats["missing"] += 1
+                        changed.append((client_id, buckets, last_tx_id))
+                elif current != buckets:
+                    stats["mismatched"] += 1
+                    changed.append((client_id, buckets, last_tx_id))
+            if apply and changed:
+                summaries = [summarize(b) for _, b, _ in changed]
+                status = await writer.execute(
+                    """
+                    INSERT INTO client_bonus_ledger
+                        (client_id, balance, next_expires_on, next_expiring, buckets, last_tx_id, updated_at)
+                    SELECT v.client_id, v.balance, v.next_on, v.next_amount, v.buckets::jsonb, v.last_tx_id, NOW()
+                    FROM unnest($1::bigint[], $2::int[], $3::date[], $4::int[], $5::text[], $6::bigint[])
+                        AS v(client_id, balance, next_on, next_amount, buckets, last_tx_id)
+                    ON CONFLICT (client_id) DO UPDATE
+                    SET balance = EXCLUDED.balance,
+                        next_expires_on = EXCLUDED.next_expires_on,
+                        next_expiring = EXCLUDED.next_expiring,
+                        buckets = EXCLUDED.buckets,
+                        last_tx_id = EXCLUDED.last_tx_id,
+                        updated_at = NOW()
+                    WHERE client_bonus_ledger.last_tx_id IS NULL
+                       OR client_bonus_ledger.last_tx_id <= EXCLUDED.last_tx_id
+                    """,
+                    [c for c, _, _ in changed],
+                    [s[0] for s in summaries],
+                    [s[1] for s in summaries],
+                    [s[2] for s in summaries],
+                    [json.dumps(b) for _, b, _ in changed],
+                    [t for _, _, t in changed],
+                )
+                stats["skipped_newer"] += len(changed) - int(status.split()[-1])
+            pending.clear()
+            logger.info(
+                "Сверка бонусов: %s клиентов, %s транзакций, %.0f tx/s",
+                stats["clients"],
+                stats["transactions"],
+                stats["transactions"] / max(time.monotonic() - started, 1e-6),
+            )
+
+        def close_client(client_id: int, rows: list[asyncpg.Record]) -> None:
+            # Курсор идёт от новых транзакций к старым; корзины собираются в хронологическом порядке.
+            client_buckets: list[Bucket] = []
+            for row in reversed(rows):
+                client_buckets = apply_delta(client_buckets, int(row["delta"]), row["expires_at"])
+            pending[client_id] = (client_buckets, rows[0]["id"])
+            stats["clients"] += 1
+
+        async with reader.transaction(isolation="repeatable_read", readonly=True):
+            current_id: Optional[int] = None
+            rows: list[asyncpg.Record] = []
+            # Порядок совпадает с индексом (client_id, created_at DESC, id DESC) — без сортировки всей таблицы.
+            cursor = reader.cursor(
+                """
+                SELECT client_id, id, delta, expires_at
+                FROM bonus_transactions
+                WHERE client_id IS NOT NULL
+                ORDER BY client_id, created_at DESC, id DESC
+                """,
+                prefetch=batch_size,
+            )
+            async for row in cursor:
+                stats["transactions"] += 1
+                if row["client_id"] != current_id:
+                    if current_id is not None:
+                        close_client(current_id, rows)
+                        if len(pending) >= batch_size:
+                            await flush()
+                    current_id = row["client_id"]
+                    rows = []
+                rows.append(row)
+            if current_id is not None:
+                close_client(current_id, rows)
+            await flush()
+
+        # Строки проекции без единой транзакции (транзакции удалили или перенесли).
+        orphaned = await reader.fetch(
+            """
+            SELECT l.client_id FROM client_bonus_ledger l
+            WHERE NOT EXISTS (SELECT 1 FROM bonus_transactions bt WHERE bt.client_id = l.client_id)
+              AND l.buckets <> '[]'::jsonb
+            """
+        )
+        stats["orphaned"] = len(orphaned)
+        if apply and orphaned:
+            await writer.execute(
+                "DELETE FROM client_bonus_ledger WHERE client_id = ANY($1::bigint[])",
+                [r["client_id"] for r in orphaned],
+            )
+    return stats
+
+
+async def reconcile_bonus_ledger() -> int:
+    """Задача планировщика: исправляет расхождения проекции. Возвращает число исправленных клиентов."""
+    stats = await reconcile(apply=True)
+    fixed = stats["mismatched"] + stats["missing"] + stats["orphaned"]
+    if fixed:
+        logger.warning("Проекция бонусов: исправлено %s клиентов (%s)", fixed, stats)
+    return fixed
+
+
+async def _main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Сверка и пересборка client_bonus_ledger")
+    parser.add_argument("mode", choices=("verify", "rebuild"))
+    parser.add_argument("--batch", type=int, default=BONUS_LEDGER_BATCH)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    await init_pool(min_size=2, max_size=2)
+    try:
+        async with get_pool().acquire() as conn:
+            await ensure_bonus_ledger_schema(conn)
+        stats = await reconcile(apply=args.mode == "rebuild", batch_size=args.batch)
+    finally:
+        await close_pool()
+    print(json.dumps(stats, ensure_ascii=False))
+    # verify возвращает 1 при расхождениях — удобно для cron/CI.
+    if args.mode == "verify" and (stats["mismatched"] or stats["missing"] or stats["orphaned"]):
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(asyncio.run(_main()))
@@ -0,0 +1,264 @@
+"""
+Напоминания о скором сгорании бонусов за подписку.
+
+За каждый сдвиг из BONUS_REMINDER_OFFSETS_DAYS (например, «7,3,1») ищем
+транзакции bot_signup, которые сгорают через столько дней (по МСК), и шлём
+клиенту напоминание. Кандидаты читаются пачками keyset-запросом по индексу
+из миграции 0006; соединение из пула держится только на время запроса.
+Перед отправкой напоминание бронируется в bonus_expiry_reminders
+(transaction_id, offset_days) — повторный прогон или второй инстанс никого не
+уведомит дважды. Бронь, зависшая в 'sending' дольше BONUS_REMINDER_LEASE_SEC
+(процесс упал посреди отправки), и временные ошибки отправки ('retry': сеть,
+429) забираются заново следующим прогоном, пока день сдвига не прошёл.
+"""
+import asyncio
+import logging
+import os
+import time
+from datetime import date, datetime, time as dt_time, timedelta
+from typing import Optional
+
+import asyncpg
+from dotenv import load_dotenv
+
+from app.bonus_ledger import MOSCOW_TZ, load_buckets
+from app.db import acquire
+from app.recipients import SEND_NETWORK, SEND_RETRY_AFTER, classify_send_error
+from app.sender import RateLimitedSender, SendFunc
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+
+def _parse_offsets(raw: str) -> tuple[int, ...]:
+    offsets = {int(part) for part in raw.replace(";", ",").split(",") if part.strip()}
+    return tuple(sorted((o for o in offsets if o > 0), reverse=True))
+
+
+BONUS_REMINDER_OFFSETS_DAYS = _parse_offsets(os.getenv("BONUS_REMINDER_OFFSETS_DAYS", "3,1") or "3,1")
+BONUS_REMINDER_CHUNK = int(os.getenv("BONUS_REMINDER_CHUNK", "500") or "500")
+BONUS_REMINDER_LEASE_SEC = float(os.getenv("BONUS_REMINDER_LEASE_SEC", "600") or "600")
+# Ошибки отправки, после которых напоминание стоит повторить
+_RETRYABLE_SEND_ERRORS = (SEND_NETWORK, SEND_RETRY_AFTER)
+
+
+async def ensure_bonus_reminder_schema(conn: asyncpg.Connection) -> None:
+    await conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS bonus_expiry_reminders (
+            transaction_id bigint NOT NULL,
+            offset_days integer NOT NULL,
+            client_id bigint NOT NULL,
+            chat_id bigint NOT NULL,
+            status text NOT NULL DEFAULT 'sending',
+            created_at timestamptz NOT NULL DEFAULT NOW(),
+            sent_at timestamptz,
+            claimed_at timestamptz NOT NULL DEFAULT NOW(),
+            PRIMARY KEY (transaction_id, offset_days)
+        );
+        ALTER TABLE bonus_expiry_reminders
+            ADD COLUMN IF NOT EXISTS claimed_at timestamptz NOT NULL DEFAULT NOW();
+        """
+    )
+
+
+def reminder_text(amount: int, expires_on: date, offset_days: int) -> str:
+    when = "завтра" if offset_days == 1 else f"через {offset_days} дн."
+    return (
+        f"⏳ {when.capitalize()} ({expires_on.strftime('%d.%m.%Y')}) сгорят <b>{amount}</b> бонусов за подписку.\n"
+        "Успейте оплатить ими до 50% заказа — нажмите «Сделать заказ»."
+    )
+
+
+def _moscow_day_bounds(day: date) -> tuple[datetime, datetime]:
+    start = datetime.combine(day, dt_time.min, tzinfo=MOSCOW_TZ)
+    return start, start + timedelta(days=1)
+
+
+def _bucket_amount(raw_buckets, day: date, fallback: int) -> int:
+    """Сколько осталось в корзине этого дня по проекции; без проекции — весь бонус за подписку."""
+    if raw_buckets is None:
+        return fallback
+    key = day.isoformat()
+    for bucket_day, amount in load_buckets(raw_buckets):
+        if bucket_day == key:
+            return int(amount)
+    return 0
+
+
+async def _fetch_candidates(
+    conn: asyncpg.Connection,
+    start: datetime,
+    end: datetime,
+    offset_days: int,
+    cursor: tuple[datetime, int],
+    limit: int,
+) -> list[asyncpg.Record]:
+    return await conn.fetch(
+        """
+        SELECT bt.id, bt.client_id, bt.delta, bt.expires_at, c.bot_tg_user_id, l.buckets
+        FROM bonus_transactions bt
+        JOIN clients c ON c.id = bt.client_id
+        LEFT JOIN client_bonus_ledger l ON l.client_id = bt.client_id
+        WHERE bt.reason = 'bot_signup'
+          AND bt.expires_at >= $1 AND bt.expires_at < $2
+          AND (bt.expires_at, bt.id) > ($4, $5)
+          AND c.bot_tg_user_id IS NOT NULL
+          AND c.bot_started
+          AND NOT EXISTS (
+              SELECT 1 FROM bonus_expiry_reminders r
+              WHERE r.transaction_id = bt.id AND r.offset_days = $3
+                AND r.status <> 'retry'
+                AND NOT (r.status = 'sending' AND r.claimed_at < NOW() - make_interval(secs => $7))
+          )
+        ORDER BY bt.expires_at, bt.id
+        LIMIT $6
+        """,
+        start,
+        end,
+        offset_days,
+        cursor[0],
+        cursor[1],
+        limit,
+        BONUS_REMINDER_LEASE_SEC,
+    )
+
+
+async def _claim(conn: asyncpg.Connection, offset_days: int, items: list[tuple[int, int, int]]) -> set[int]:
+    """
+    Бронирует напоминания; возвращает id транзакций, которые забрал именно этот прогон.
+    Повторно забираются брони с временной ошибкой и брони с истёкшей арендой.
+    """
+    rows = await conn.fetch(
+        """
+        INSERT INTO bonus_expiry_reminders (transaction_id, offset_days, client_id, chat_id)
+        SELECT v.tx_id, $1, v.client_id, v.chat_id
+        FROM unnest($2::bigint[], $3::bigint[], $4::bigint[]) AS v(tx_id, client_id, chat_id)
+        ON CONFLICT (transaction_id, offset_days) DO UPDATE
+        SET status = 'sending', claimed_at = NOW(), chat_id = EXCLUDED.chat_id
+        WHERE bonus_expiry_reminders.status = 'retry'
+           OR (bonus_expiry_reminders.status = 'sending'
+               AND bonus_expiry_reminders.claimed_at < NOW() - make_interval(secs => $5))
+        RETURNING transaction_id
+        """,
+        offset_days,
+        [i[0] for i in items],
+        [i[1] for i in items],
+        [i[2] for i in items],
+        BONUS_REMINDER_LEASE_SEC,
+    )
+    return {r["transaction_id"] for r in rows}
+
+
+async def _finish(conn: asyncpg.Connection, offset_days: int, results: dict[int, str]) -> None:
+    await conn.execute(
+        """
+        UPDATE bonus_expiry_reminders r
+        SET status = v.status,
+            sent_at = CASE WHEN v.status = 'sent' THEN NOW() END
+        FROM unnest($2::bigint[], $3::text[]) AS v(tx_id, status)
+        WHERE r.transaction_id = v.tx_id AND r.offset_days = $1
+        """,
+        offset_days,
+        list(results),
+        list(results.values()),
+    )
+
+
+async def send_bonus_expiry_reminders(
+    sender: RateLimitedSender,
+    fallback_amount: int,
+    offsets: tuple[int, ...] = BONUS_REMINDER_OFFSETS_DAYS,
+    chunk_size: int = BONUS_REMINDER_CHUNK,
+    today: Optional[date] = None,
+    send_func: Optional[SendFunc] = None,
+) -> int:
+    """
+    Рассылает напоминания по всем сдвигам. Возвращает число отправленных сообщений.
+    send_func (через sender, в общем темпе) должна пропускать наружу сетевые ошибки,
+    чтобы напоминание осталось на повтор; None от неё — чат недоступен.
+    """
+    today = today or datetime.now(MOSCOW_TZ).date()
+    total_sent = 0
+    started = time.monotonic()
+
+    for offset_days in offsets:
+        expires_on = today + timedelta(days=offset_days)
+        start, end = _moscow_day_bounds(expires_on)
+        cursor: tuple[datetime, int] = (start - timedelta(microseconds=1), 0)
+        sent = skipped = failed = retry = 0
+
+        while True:
+            async with acquire() as conn:
+                rows = await _fetch_candidates(conn, start, end, offset_days, cursor, chunk_size)
+                if not rows:
+                    break
+                cursor = (rows[-1]["expires_at"], rows[-1]["id"])
+                claimed = await _claim(
+                    conn, offset_days, [(r["id"], r["client_id"], r["bot_tg_user_id"]) for r in rows]
+                )
+
+            results: dict[int, str] = {}
+            batch = []
+            for row in rows:
+                if row["id"] not in claimed:
+                    continue
+                amount = min(_bucket_amount(row["buckets"], expires_on, fallback_amount), int(row["delta"]))
+                if amount <= 0:
+                    results[row["id"]] = "skipped"  # бонусы за подписку уже потрачены
+                    continue
+                batch.append((row["id"], row["bot_tg_user_id"], amount))
+
+            # Соединение уже возвращено в пул: отправка пачки не держит БД
+            outcomes = await asyncio.gather(
+                *(
+                    sender.send(
+                        chat_id,
+                        reminder_text(amount, expires_on, offset_days),
+                        via=send_func,
+                        raise_exhausted=True,
+                    )
+                    for _, chat_id, amount in batch
+                ),
+                return_exceptions=True,
+            )
+            for (tx_id, chat_id, _), outcome in zip(batch, outcomes):
+                if isinstance(outcome, BaseException):
+                    retryable = classify_send_error(outcome) in _RETRYABLE_SEND_ERRORS
+                    results[tx_id] = "retry" if retryable else "failed"
+                    logger.warning("Напоминание о бонусах для %s не отправлено: %s", chat_id, outcome)
+                elif outcome is None:
+                    results[tx_id] = "failed"
+                else:
+                    results[tx_id] = "sent"
+
+            if results:
+                async with acquire() as conn:
+                    await _finish(conn, offset_days, results)
+            statuses = list(results.values())
+            sent += statuses.count("sent")
+            skipped += statuses.count("skipped")
+            failed += statuses.count("failed")
+            retry += statuses.count("retry")
+            if len(rows) < chunk_size:
+                break
+
+        total_sent += sent
+        if sent or skipped or failed or retry:
+            logger.info(
+                "Напоминания о сгорании за %s дн. (%s): отправлено %s, пропущено %s, ошибок %s, на повтор %s",
+                offset_days,
+                expires_on,
+                sent,
+                skipped,
+                failed,
+                retry,
+            )
+
+    if total_sent:
+        logger.info(
+            "Напоминания о бонусах: %s сообщений за %.1f с",
+            total_sent,
+            time.monotonic() - started,
+        )
+    return total_sent
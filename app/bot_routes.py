@@ -0,0 +1,111 @@
+"""
+Какой из ботов процесса пишет клиенту.
+
+В одном процессе может работать несколько брендированных ботов (BOT_TOKENS),
+а Telegram разрешает писать пользователю только от имени бота, которого он
+запустил. Поэтому фоновые отправки (напоминания, статусы заказов, ответы CRM)
+идут через бота, с которым клиент общался последним.
+
+В памяти хранятся только клиенты не основного бота — с одним ботом ChatRoutes
+пуст и ничего не пишет. Смены маршрута копятся и раз в BOT_ROUTES_FLUSH_SEC
+пишутся в bot_chat_routes одним запросом; при старте оттуда же загружаются.
+"""
+import asyncio
+import logging
+import os
+from typing import Optional
+
+import asyncpg
+from dotenv import load_dotenv
+
+from app.db import acquire
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+BOT_ROUTES_FLUSH_SEC = float(os.getenv("BOT_ROUTES_FLUSH_SEC", "5") or "5")
+
+
+async def ensure_bot_routes_schema(conn: asyncpg.Connection) -> None:
+    await conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS bot_chat_routes (
+            user_id bigint PRIMARY KEY,
+            bot_id bigint NOT NULL,
+            updated_at timestamptz NOT NULL DEFAULT NOW()
+        );
+        """
+    )
+
+
+class ChatRoutes:
+    def __init__(self, flush_sec: float = BOT_ROUTES_FLUSH_SEC) -> None:
+        self.flush_sec = flush_sec
+        self.default_bot_id = 0
+        self._routes: dict[int, int] = {}
+        self._pending: dict[int, int] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self._routes)
+
+    def bot_id_for(self, user_id: int) -> int:
+        return self._routes.get(user_id, self.default_bot_id)
+
+    def remember(self, user_id: int, bot_id: int) -> bool:
+        """Запоминает, что клиент пишет боту bot_id. True — если маршрут сменился."""
+        if self._routes.get(user_id, self.default_bot_id) == bot_id:
+            return False
+        if bot_id == self.default_bot_id:
+            self._routes.pop(user_id, None)
+        else:
+            self._routes[user_id] = bot_id
+        self._pending[user_id] = bot_id
+        return True
+
+    async def warm(self, conn: asyncpg.Connection) -> int:
+        rows = await conn.fetch("SELECT user_id, bot_id FROM bot_chat_routes WHERE bot_id <> $1", self.default_bot_id)
+        self._routes.update((r["user_id"], r["bot_id"]) for r in rows)
+        return len(rows)
+
+    async def flush(self) -> int:
+        if not self._pending:
+            return 0
+        batch, self._pending = self._pending, {}
+        try:
+            async with acquire() as conn:
+                await conn.execute(
+                    """
+                    INSERT INTO bot_chat_routes (user_id, bot_id)
+                    SELECT * FROM unnest($1::bigint[], $2::bigint[])
+                    ON CONFLICT (user_id) DO UPDATE
+                    SET bot_id = EXCLUDED.bot_id, updated_at = NOW()
+                    """,
+                    list(batch),
+                    list(batch.values()),
+                )
+        except Exception as exc:
+            logger.warning("Не удалось сохранить %s маршрутов ботов: %s", len(batch), exc)
+            # Более свежие смены за время записи важнее
+            self._pending = {**batch, **self._pending}
+            return 0
+        return len(batch)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop(), name="bot-routes-flush")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    async def _loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_sec)
+            await self.flush()
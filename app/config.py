@@ -0,0 +1,96 @@
+"""
+Настройки клиентских ботов, нужные фабрике bot.create_app().
+
+load_configs() только читает окружение: ни Bot, ни сессия, ни соединения не
+создаются. Профиль test (BOT_PROFILE=test) не требует BOT_TOKEN — подставляется
+фиктивный токен, с которым Bot и Dispatcher собираются для тестов, бенчмарков и
+офлайн-инструментов; в Telegram с ним ходить бессмысленно.
+
+Один процесс может обслуживать несколько ботов: BOT_TOKENS — токены через
+запятую или пробел (без неё — один BOT_TOKEN). Первый бот основной. Настройки
+отдельного бота переопределяются переменными с суффиксом его id (число до «:»
+в токене): LOGS_CHAT_ID_<id>, ADMIN_TG_IDS_<id>, CLIENT_BOT_HEALTH_SERVICE_KEY_<id>,
+CLIENT_BOT_HEALTH_DISPLAY_NAME_<id>. Без переопределения бот берёт общие
+значения, а ключ heartbeat у неосновных ботов получает суффикс -<id>.
+"""
+import os
+import re
+from dataclasses import dataclass
+from typing import Optional
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+BOT_PROFILE = (os.getenv("BOT_PROFILE") or "prod").strip().lower()
+TEST_PROFILE = "test"
+# Синтаксически валидный токен; id совпадает с bench.fake_bot_api.BOT_ID
+TEST_BOT_TOKEN = "4242424242:test-profile-token"
+
+DEFAULT_HEALTH_SERVICE_KEY = "telegram-bot-client"
+DEFAULT_HEALTH_DISPLAY_NAME = "Клиентский Telegram бот"
+
+
+@dataclass(frozen=True)
+class BotConfig:
+    token: str
+    profile: str = BOT_PROFILE
+    logs_chat_id: int = 0
+    admin_ids: tuple[int, ...] = ()
+    health_service_key: str = DEFAULT_HEALTH_SERVICE_KEY
+    health_display_name: str = DEFAULT_HEALTH_DISPLAY_NAME
+
+    @property
+    def is_test(self) -> bool:
+        return self.profile == TEST_PROFILE
+
+    @property
+    def bot_id(self) -> int:
+        return int(self.token.split(":", 1)[0])
+
+
+def _env(name: str, bot_id: Optional[int] = None) -> str:
+    if bot_id is not None:
+        value = os.getenv(f"{name}_{bot_id}")
+        if value is not None and value.strip():
+            return value.strip()
+    return (os.getenv(name) or "").strip()
+
+
+def _bot_config(token: str, profile: str, primary: bool) -> BotConfig:
+    bot_id = int(token.split(":", 1)[0])
+    admins = _env("ADMIN_TG_IDS", bot_id)
+    service_key = _env(f"CLIENT_BOT_HEALTH_SERVICE_KEY_{bot_id}")
+    if not service_key:
+        service_key = _env("CLIENT_BOT_HEALTH_SERVICE_KEY") or DEFAULT_HEALTH_SERVICE_KEY
+        if not primary:
+            service_key = f"{service_key}-{bot_id}"
+    return BotConfig(
+        token=token,
+        profile=profile,
+        logs_chat_id=int(_env("LOGS_CHAT_ID", bot_id) or "0"),
+        admin_ids=tuple(int(x) for x in admins.split()) if admins else (),
+        health_service_key=service_key,
+        health_display_name=_env("CLIENT_BOT_HEALTH_DISPLAY_NAME", bot_id) or DEFAULT_HEALTH_DISPLAY_NAME,
+    )
+
+
+def load_configs(profile: Optional[str] = None) -> list[BotConfig]:
+    """Настройки всех ботов процесса; первый — основной."""
+    profile = (profile or BOT_PROFILE).strip().lower()
+    tokens = [part for part in re.split(r"[,\s;]+", _env("BOT_TOKENS")) if part]
+    if not tokens and _env("BOT_TOKEN"):
+        tokens = [_env("BOT_TOKEN")]
+    if not tokens:
+        if profile != TEST_PROFILE:
+            raise RuntimeError("BOT_TOKEN is not set")
+        tokens = [TEST_BOT_TOKEN]
+    tokens = list(dict.fromkeys(tokens))
+    configs = [_bot_config(token, profile, primary=index == 0) for index, token in enumerate(tokens)]
+    if len({config.bot_id for config in configs}) != len(configs):
+        raise RuntimeError("BOT_TOKENS contains several tokens of the same bot")
+    return configs
+
+
+def load_config(profile: Optional[str] = None) -> BotConfig:
+    return load_configs(profile)[0]
@@ -0,0 +1,297 @@
+"""
+Пересылка сообщений клиентов в Wahelp (канал clients_tg → amoCRM).
+
+Хэндлеры ничего не ждут от внешнего HTTP: enqueue() только пишет строку в
+crm_outbox и будит экспортёр. CrmExporter забирает очередь пачками
+(FOR UPDATE SKIP LOCKED — можно запускать на всех инстансах), отправляет их
+через одну ClientSession с keep-alive пулом соединений и отмечает итог одним
+UPDATE на пачку. Сообщения одного клиента уходят по порядку и при нескольких
+инстансах: забрать можно только самое раннее незавершённое сообщение номера,
+поэтому следующее не возьмёт никто, пока предыдущее не отправлено или не
+отброшено (failed).
+
+Сетевые ошибки, 429 и 5xx повторяются с экспоненциальной задержкой до
+CRM_FORWARD_MAX_ATTEMPTS раз, остальные 4xx — сразу failed. Строка, взятая
+инстансом, который упал посреди отправки, снова становится доступной через
+CRM_FORWARD_LEASE_SEC.
+
+Запрос (docs/WAHELP_TECHNICAL_SETUP.md):
+    POST {WAHELP_API_BASE}/app/projects/{project_id}/channels/{channel_uuid}/messages
+    {"user": {"phone": ..., "name": ...}, "message": {"text": ...}}
+"""
+import asyncio
+import logging
+import os
+import random
+from collections import defaultdict
+from typing import Any, Optional
+
+import aiohttp
+import asyncpg
+from dotenv import load_dotenv
+
+from app.db import acquire
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+WAHELP_API_BASE = (os.getenv("WAHELP_API_BASE") or "https://api.wahelp.ru").rstrip("/")
+WAHELP_ACCESS_TOKEN = (os.getenv("WAHELP_ACCESS_TOKEN") or "").strip()
+WAHELP_CLIENTS_PROJECT_ID = (os.getenv("WAHELP_CLIENTS_PROJECT_ID") or "").strip()
+WAHELP_CLIENTS_CHANNEL_UUID = (os.getenv("WAHELP_CLIENTS_CHANNEL_UUID") or "").strip()
+CRM_FORWARD_ENABLED = bool(WAHELP_ACCESS_TOKEN and WAHELP_CLIENTS_PROJECT_ID and WAHELP_CLIENTS_CHANNEL_UUID)
+
+CRM_FORWARD_BATCH = int(os.getenv("CRM_FORWARD_BATCH", "50") or "50")
+CRM_FORWARD_CONCURRENCY = int(os.getenv("CRM_FORWARD_CONCURRENCY", "8") or "8")
+CRM_FORWARD_MAX_ATTEMPTS = int(os.getenv("CRM_FORWARD_MAX_ATTEMPTS", "8") or "8")
+CRM_FORWARD_BACKOFF_SEC = float(os.getenv("CRM_FORWARD_BACKOFF_SEC", "2") or "2")
+CRM_FORWARD_BACKOFF_MAX_SEC = float(os.getenv("CRM_FORWARD_BACKOFF_MAX_SEC", "600") or "600")
+CRM_FORWARD_LEASE_SEC = float(os.getenv("CRM_FORWARD_LEASE_SEC", "120") or "120")
+CRM_FORWARD_POLL_SEC = float(os.getenv("CRM_FORWARD_POLL_SEC", "5") or "5")
+CRM_FORWARD_TIMEOUT_SEC = float(os.getenv("CRM_FORWARD_TIMEOUT_SEC", "10") or "10")
+
+# Виды сообщений и подписи, с которыми текст уходит менеджеру
+CRM_KIND_PREFIXES = {
+    "text": "",
+    "question": "❓ Вопрос: ",
+    "order": "🧾 Заказ: ",
+}
+
+
+async def ensure_crm_outbox_schema(conn: asyncpg.Connection) -> None:
+    await conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS crm_outbox (
+            id bigserial PRIMARY KEY,
+            client_id bigint,
+            phone text NOT NULL,
+            name text,
+            kind text NOT NULL DEFAULT 'text',
+            text text NOT NULL,
+            status text NOT NULL DEFAULT 'pending',
+            attempts integer NOT NULL DEFAULT 0,
+            next_attempt_at timestamptz NOT NULL DEFAULT NOW(),
+            last_error text,
+            created_at timestamptz NOT NULL DEFAULT NOW(),
+            sent_at timestamptz
+        );
+        CREATE INDEX IF NOT EXISTS crm_outbox_due_idx
+            ON crm_outbox (next_attempt_at, id) WHERE status IN ('pending', 'sending');
+        CREATE INDEX IF NOT EXISTS crm_outbox_phone_idx
+            ON crm_outbox (phone, id) WHERE status IN ('pending', 'sending');
+        """
+    )
+
+
+class RetryableError(Exception):
+    pass
+
+
+class CrmExporter:
+    def __init__(
+        self,
+        *,
+        api_base: str = WAHELP_API_BASE,
+        token: str = WAHELP_ACCESS_TOKEN,
+        project_id: str = WAHELP_CLIENTS_PROJECT_ID,
+        channel_uuid: str = WAHELP_CLIENTS_CHANNEL_UUID,
+        batch_size: int = CRM_FORWARD_BATCH,
+        concurrency: int = CRM_FORWARD_CONCURRENCY,
+    ) -> None:
+        self.url = f"{api_base.rstrip('/')}/app/projects/{project_id}/channels/{channel_uuid}/messages"
+        self.token = token
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._retry_in: Optional[float] = None
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+
+    async def enqueue(
+        self,
+        phone: str,
+        text: str,
+        *,
+        kind: str = "text",
+        name: Optional[str] = None,
+        client_id: Optional[int] = None,
+        conn: Optional[asyncpg.Connection] = None,
+    ) -> None:
+        """Ставит сообщение в очередь. Внешних запросов не делает."""
+        async with acquire(conn) as conn:
+            await conn.execute(
+                "INSERT INTO crm_outbox (client_id, phone, name, kind, text) VALUES ($1, $2, $3, $4, $5)",
+                client_id,
+                phone,
+                name,
+                kind,
+                text,
+            )
+        self._wakeup.set()
+
+    def start(self) -> None:
+        if self._task is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.concurrency, keepalive_timeout=60),
+                timeout=aiohttp.ClientTimeout(total=CRM_FORWARD_TIMEOUT_SEC),
+                headers={"Authorization": f"Bearer {self.token}"},
+            )
+            self._task = asyncio.create_task(self._run(), name="crm-exporter")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                exported = await self.export_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                logger.warning("Экспорт в CRM: ошибка цикла: %s", exc)
+                exported = 0
+            if exported >= self.batch_size:
+                continue  # очередь не разобрана — сразу следующая пачка
+            self._wakeup.clear()
+            # Ближайший повтор может наступить раньше очередного опроса
+            timeout = min(CRM_FORWARD_POLL_SEC, self._retry_in) if self._retry_in is not None else CRM_FORWARD_POLL_SEC
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _claim(self) -> list[asyncpg.Record]:
+        async with acquire() as conn:
+            rows = await conn.fetch(
+                """
+                UPDATE crm_outbox o SET
+                    status = 'sending',
+                    attempts = o.attempts + 1,
+                    next_attempt_at = NOW() + make_interval(secs => $2)
+                WHERE o.id IN (
+                    SELECT id FROM crm_outbox
+                    WHERE status IN ('pending', 'sending') AND next_attempt_at <= NOW()
+                      -- Только голова очереди номера. Её строку другой инстанс держит
+                      -- (SKIP LOCKED) или уже перевёл в sending с арендой — перепроверка
+                      -- заблокированной строки отсечёт её, а следующие за ней не кандидаты
+                      AND id IN (
+                          SELECT DISTINCT ON (phone) id FROM crm_outbox
+                          WHERE status IN ('pending', 'sending')
+                          ORDER BY phone, id
+                      )
+                    ORDER BY id
+                    LIMIT $1
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING o.id, o.client_id, o.phone, o.name, o.kind, o.text, o.attempts
+                """,
+                self.batch_size,
+                CRM_FORWARD_LEASE_SEC,
+            )
+        # RETURNING не обязан сохранять ORDER BY подзапроса
+        return sorted(rows, key=lambda row: row["id"])
+
+    async def _post(self, row: asyncpg.Record) -> None:
+        payload: dict[str, Any] = {
+            "user": {"phone": row["phone"]},
+            "message": {"text": CRM_KIND_PREFIXES.get(row["kind"], "") + row["text"]},
+        }
+        if row["name"]:
+            payload["user"]["name"] = row["name"]
+        try:
+            async with self._session.post(self.url, json=payload) as response:
+                if response.status < 300:
+                    await response.read()
+                    return
+                body = (await response.text())[:300]
+        except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+            raise RetryableError(f"{type(exc).__name__}: {exc}") from exc
+        if response.status == 429 or response.status >= 500:
+            raise RetryableError(f"HTTP {response.status}: {body}")
+        raise ValueError(f"HTTP {response.status}: {body}")
+
+    async def _send_client(self, rows: list[asyncpg.Record], results: dict[int, tuple[str, Optional[str]]]) -> None:
+        for index, row in enumerate(rows):
+            try:
+                await self._post(row)
+                results[row["id"]] = ("sent", None)
+            except RetryableError as exc:
+                results[row["id"]] = ("pending", str(exc))
+                # Не обгоняем неотправленное сообщение того же клиента
+                for rest in rows[index + 1 :]:
+                    results.setdefault(rest["id"], ("pending", "отложено за предыдущим сообщением"))
+                return
+            except Exception as exc:
+                results[row["id"]] = ("failed", str(exc))
+
+    async def export_once(self) -> int:
+        """Одна пачка: забрать, отправить, отметить. Возвращает размер пачки."""
+        self._retry_in = None
+        rows = await self._claim()
+        if not rows:
+            return 0
+        by_client: dict[Any, list[asyncpg.Record]] = defaultdict(list)
+        for row in rows:
+            by_client[row["client_id"] or row["phone"]].append(row)
+        results: dict[int, tuple[str, Optional[str]]] = {}
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def run(client_rows: list[asyncpg.Record]) -> None:
+            async with semaphore:
+                await self._send_client(client_rows, results)
+
+        await asyncio.gather(*(run(client_rows) for client_rows in by_client.values()))
+
+        ids: list[int] = []
+        statuses: list[str] = []
+        delays: list[float] = []
+        errors: list[Optional[str]] = []
+        for row in rows:
+            status, error = results[row["id"]]
+            delay = 0.0
+            if status == "pending":
+                if row["attempts"] >= CRM_FORWARD_MAX_ATTEMPTS:
+                    status = "failed"
+                else:
+                    base = min(CRM_FORWARD_BACKOFF_SEC * 2 ** (row["attempts"] - 1), CRM_FORWARD_BACKOFF_MAX_SEC)
+                    delay = base * random.uniform(0.8, 1.2)
+                    self._retry_in = delay if self._retry_in is None else min(self._retry_in, delay)
+                    self.retried += 1
+            if status == "sent":
+                self.sent += 1
+            elif status == "failed":
+                self.failed += 1
+                logger.warning("Сообщение %s не передано в CRM: %s", row["id"], error)
+            ids.append(row["id"])
+            statuses.append(status)
+            delays.append(delay)
+            errors.append(error[:1000] if error else None)
+        async with acquire() as conn:
+            await conn.execute(
+                """
+                UPDATE crm_outbox o SET
+                    status = v.status,
+                    next_attempt_at = NOW() + make_interval(secs => v.delay),
+                    last_error = v.error,
+                    sent_at = CASE WHEN v.status = 'sent' THEN NOW() ELSE NULL END
+                FROM unnest($1::bigint[], $2::text[], $3::float8[], $4::text[]) AS v(id, status, delay, error)
+                WHERE o.id = v.id
+                """,
+                ids,
+                statuses,
+                delays,
+                errors,
+            )
+        return len(rows)
@@ -0,0 +1,482 @@
+"""
+Ответы менеджеров из amoCRM/Wahelp → клиенту в Telegram.
+
+Встроенный aiohttp-сервер принимает webhook Wahelp на CRM_WEBHOOK_PATH.
+Тело подписывается HMAC-SHA256 с секретом CRM_WEBHOOK_SECRET, подпись
+передаётся в заголовке X-Signature (hex, допускается префикс «sha256=»).
+Проверенный ответ сначала записывается в таблицу crm_inbox и только после
+коммита получает 200 — Wahelp сам не повторяет доставленный webhook, поэтому
+принятый ответ не должен теряться при перезапуске. Если записать не удалось,
+отвечаем 503. Доставка идёт в фоне из таблицы, как у crm_outbox:
+
+- строки забираются пачками (FOR UPDATE SKIP LOCKED — можно на всех
+  инстансах), телефоны пачки ищутся одним запросом (clients.phone_digits →
+  bot_tg_user_id) с TTL-кэшем;
+- забирается только голова очереди номера вместе с готовыми следующими
+  ответами, поэтому ответы одному клиенту уходят строго по порядку; разные
+  чаты — параллельно, общий темп задаёт RateLimitedSender;
+- сетевые ошибки и сбой поиска клиентов возвращают строки в очередь с
+  экспоненциальной задержкой (до CRM_REPLY_MAX_ATTEMPTS попыток), недоступные
+  чаты отбрасываются (failed / no_chat). Строки инстанса, упавшего посреди
+  доставки, снова доступны через CRM_REPLY_LEASE_SEC.
+
+Обрабатываются только destination/direction = from_operator/operator
+(docs/FINAL_INTEGRATION_PLAN.md); повтор webhook с тем же id доставляется один
+раз (уникальный индекс по message_id).
+"""
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import os
+import random
+import time
+from collections import OrderedDict, defaultdict
+from typing import Any, Optional
+
+import asyncpg
+from aiohttp import web
+from dotenv import load_dotenv
+
+from app.db import acquire
+from app.phones import normalize_phone_digits
+from app.recipients import SEND_NETWORK, classify_send_error
+from app.sender import RateLimitedSender, SendFunc
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+CRM_WEBHOOK_SECRET = (os.getenv("CRM_WEBHOOK_SECRET") or "").strip()
+CRM_WEBHOOK_HOST = (os.getenv("CRM_WEBHOOK_HOST") or "0.0.0.0").strip()
+CRM_WEBHOOK_PORT = int(os.getenv("CRM_WEBHOOK_PORT", "8080") or "8080")
+CRM_WEBHOOK_PATH = (os.getenv("CRM_WEBHOOK_PATH") or "/wahelp/webhook").strip()
+CRM_WEBHOOK_MAX_BODY = int(os.getenv("CRM_WEBHOOK_MAX_BODY", "65536") or "65536")
+CRM_REPLY_BATCH = int(os.getenv("CRM_REPLY_BATCH", "200") or "200")
+CRM_REPLY_MAX_ATTEMPTS = int(os.getenv("CRM_REPLY_MAX_ATTEMPTS", "8") or "8")
+CRM_REPLY_RETRY_SEC = float(os.getenv("CRM_REPLY_RETRY_SEC", "1") or "1")
+CRM_REPLY_RETRY_MAX_SEC = float(os.getenv("CRM_REPLY_RETRY_MAX_SEC", "300") or "300")
+CRM_REPLY_LEASE_SEC = float(os.getenv("CRM_REPLY_LEASE_SEC", "120") or "120")
+CRM_REPLY_POLL_SEC = float(os.getenv("CRM_REPLY_POLL_SEC", "5") or "5")
+# Окно группового INSERT: webhook, пришедшие за это время, сохраняются одним запросом
+CRM_INBOX_COMMIT_SEC = float(os.getenv("CRM_INBOX_COMMIT_SEC", "0.005") or "0.005")
+CRM_PHONE_CACHE_TTL_SEC = float(os.getenv("CRM_PHONE_CACHE_TTL_SEC", "300") or "300")
+CRM_PHONE_CACHE_MAX = int(os.getenv("CRM_PHONE_CACHE_MAX", "50000") or "50000")
+
+OPERATOR_DESTINATIONS = {"from_operator", "operator"}
+
+
+async def ensure_crm_inbox_schema(conn: asyncpg.Connection) -> None:
+    await conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS crm_inbox (
+            id bigserial PRIMARY KEY,
+            message_id text,
+            phone text NOT NULL,
+            text text NOT NULL,
+            status text NOT NULL DEFAULT 'pending',
+            attempts integer NOT NULL DEFAULT 0,
+            next_attempt_at timestamptz NOT NULL DEFAULT NOW(),
+            last_error text,
+            created_at timestamptz NOT NULL DEFAULT NOW(),
+            delivered_at timestamptz
+        );
+        CREATE UNIQUE INDEX IF NOT EXISTS crm_inbox_message_id_key
+            ON crm_inbox (message_id) WHERE message_id IS NOT NULL;
+        CREATE INDEX IF NOT EXISTS crm_inbox_due_idx
+            ON crm_inbox (next_attempt_at, id) WHERE status IN ('pending', 'sending');
+        CREATE INDEX IF NOT EXISTS crm_inbox_phone_idx
+            ON crm_inbox (phone, id) WHERE status IN ('pending', 'sending');
+        """
+    )
+
+
+def sign_body(secret: str, body: bytes) -> str:
+    return hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+
+
+def verify_signature(secret: str, body: bytes, header: Optional[str]) -> bool:
+    if not header:
+        return False
+    signature = header.strip()
+    if signature.startswith("sha256="):
+        signature = signature[len("sha256="):]
+    return hmac.compare_digest(sign_body(secret, body), signature)
+
+
+def parse_operator_reply(payload: dict[str, Any]) -> Optional[tuple[Optional[str], str, str]]:
+    """(id сообщения, phone_digits, текст) для ответа менеджера, иначе None."""
+    data = payload.get("data") if isinstance(payload.get("data"), dict) else payload
+    destination = str(data.get("destination") or data.get("direction") or "").lower()
+    if destination not in OPERATOR_DESTINATIONS:
+        return None
+    message = data.get("message")
+    user = data.get("user") if isinstance(data.get("user"), dict) else {}
+    client = data.get("client") if isinstance(data.get("client"), dict) else {}
+    phone = data.get("phone") or user.get("phone") or client.get("phone")
+    if isinstance(message, dict):
+        text = message.get("text")
+        message_id = message.get("id") or data.get("message_id") or data.get("id")
+    else:
+        text = data.get("text") or message
+        message_id = data.get("message_id") or data.get("id")
+    digits = normalize_phone_digits(str(phone)) if phone else ""
+    if not digits or not isinstance(text, str) or not text.strip():
+        return None
+    return (str(message_id) if message_id is not None else None), digits, text
+
+
+class PhoneChatCache:
+    """
+    phone_digits → bot_tg_user_id с TTL и LRU. Промахи не кэшируются: клиент может
+    поделиться номером в боте в любой момент, и ответ менеджера должен дойти сразу.
+    upsert_contact сбрасывает номер через invalidate().
+    """
+
+    def __init__(self, ttl: float = CRM_PHONE_CACHE_TTL_SEC, max_entries: int = CRM_PHONE_CACHE_MAX) -> None:
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._items: OrderedDict[str, tuple[float, int]] = OrderedDict()
+        self._has_digits_column: Optional[bool] = None
+
+    async def resolve(self, phones: list[str]) -> dict[str, Optional[int]]:
+        now = time.monotonic()
+        found: dict[str, Optional[int]] = {}
+        missing: list[str] = []
+        for phone in phones:
+            item = self._items.get(phone)
+            if item is not None and now - item[0] < self.ttl:
+                self._items.move_to_end(phone)
+                found[phone] = item[1]
+            elif phone not in found:
+                missing.append(phone)
+        missing = list(dict.fromkeys(missing))
+        if missing:
+            async with acquire() as conn:
+                if self._has_digits_column is None:
+                    self._has_digits_column = bool(
+                        await conn.fetchval(
+                            """
+                            SELECT EXISTS (
+                                SELECT 1 FROM information_schema.columns
+                                WHERE table_schema = 'public' AND table_name = 'clients' AND column_name = 'phone_digits'
+                            )
+                            """
+                        )
+                    )
+                digits_sql = "phone_digits" if self._has_digits_column else "regexp_replace(phone, '\\D', '', 'g')"
+                rows = await conn.fetch(
+                    f"""
+                    SELECT {digits_sql} AS digits, bot_tg_user_id FROM clients
+                    WHERE {digits_sql} = ANY($1::text[]) AND bot_started AND bot_tg_user_id IS NOT NULL
+                    """,
+                    missing,
+                )
+            chats = {r["digits"]: r["bot_tg_user_id"] for r in rows}
+            for phone in missing:
+                found[phone] = chats.get(phone)
+                if found[phone] is not None:
+                    self._items[phone] = (now, found[phone])
+                    self._items.move_to_end(phone)
+            while len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+        return found
+
+    def invalidate(self, phone: str) -> None:
+        self._items.pop(phone, None)
+
+
+class CrmReplyRelay:
+    """
+    send_func(chat_id, text) отправляет одно сообщение через общий sender: None —
+    чат недоступен, сетевые ошибки должны выходить наружу, чтобы их повторить.
+    """
+
+    def __init__(
+        self,
+        sender: RateLimitedSender,
+        send_func: SendFunc,
+        *,
+        secret: str = CRM_WEBHOOK_SECRET,
+        cache: Optional[PhoneChatCache] = None,
+        batch_size: int = CRM_REPLY_BATCH,
+    ) -> None:
+        self.sender = sender
+        self.send_func = send_func
+        self.secret = secret
+        self.cache = cache or PhoneChatCache()
+        self.batch_size = batch_size
+        self._wakeup = asyncio.Event()
+        self._retry_in: Optional[float] = None
+        self._inbox: list[tuple[tuple[Optional[str], str, str], asyncio.Future]] = []
+        self._inbox_wakeup = asyncio.Event()
+        self._inbox_writer: Optional[asyncio.Task] = None
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._runner: Optional[web.AppRunner] = None
+        self.port: Optional[int] = None
+        self.stats = {
+            "received": 0,
+            "ignored": 0,
+            "duplicates": 0,
+            "rejected": 0,
+            "unavailable": 0,
+            "delivered": 0,
+            "retried": 0,
+            "no_chat": 0,
+            "failed": 0,
+        }
+
+    def make_app(self, path: str = CRM_WEBHOOK_PATH) -> web.Application:
+        app = web.Application(client_max_size=CRM_WEBHOOK_MAX_BODY)
+        app.router.add_post(path, self.handle)
+        return app
+
+    async def start(self, host: str = CRM_WEBHOOK_HOST, port: int = CRM_WEBHOOK_PORT) -> None:
+        self._dispatcher = asyncio.create_task(self._dispatch_loop(), name="crm-reply-dispatch")
+        self._inbox_writer = asyncio.create_task(self._inbox_loop(), name="crm-inbox-writer")
+        self._runner = web.AppRunner(self.make_app(), access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        sockets = site._server.sockets if site._server else []
+        self.port = sockets[0].getsockname()[1] if sockets else port
+        logger.info("Webhook ответов CRM слушает %s:%s%s", host, self.port, CRM_WEBHOOK_PATH)
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+        for task in (self._dispatcher, self._inbox_writer):
+            if task is not None:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self._dispatcher = None
+        self._inbox_writer = None
+
+    async def handle(self, request: web.Request) -> web.Response:
+        body = await request.read()
+        if not verify_signature(self.secret, body, request.headers.get("X-Signature")):
+            self.stats["rejected"] += 1
+            return web.json_response({"ok": False, "error": "bad signature"}, status=401)
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            return web.json_response({"ok": False, "error": "bad json"}, status=400)
+        self.stats["received"] += 1
+        reply = parse_operator_reply(payload) if isinstance(payload, dict) else None
+        if reply is None:
+            self.stats["ignored"] += 1
+            return web.json_response({"ok": True, "ignored": True})
+        fut: asyncio.Future = asyncio.get_running_loop().create_future()
+        self._inbox.append((reply, fut))
+        self._inbox_wakeup.set()
+        try:
+            inserted = await fut
+        except Exception as exc:
+            # Без записи в таблицу не подтверждаем: Wahelp повторит на 503
+            logger.warning("Ответ CRM не сохранён, отвечаем 503: %s", exc)
+            self.stats["unavailable"] += 1
+            return web.json_response({"ok": False, "error": "unavailable"}, status=503)
+        if not inserted:
+            self.stats["duplicates"] += 1
+            return web.json_response({"ok": True, "duplicate": True})
+        self._wakeup.set()
+        return web.json_response({"ok": True})
+
+    async def _inbox_loop(self) -> None:
+        while True:
+            await self._inbox_wakeup.wait()
+            await asyncio.sleep(CRM_INBOX_COMMIT_SEC)
+            self._inbox_wakeup.clear()
+            batch, self._inbox = self._inbox, []
+            if not batch:
+                continue
+            try:
+                inserted = await self._save([reply for reply, _ in batch])
+            except Exception as exc:
+                for _, fut in batch:
+                    if not fut.done():
+                        fut.set_exception(exc)
+                continue
+            for index, (_, fut) in enumerate(batch):
+                if not fut.done():
+                    fut.set_result(index in inserted)
+
+    async def _save(self, replies: list[tuple[Optional[str], str, str]]) -> set[int]:
+        """Сохраняет пачку ответов одним INSERT. Возвращает индексы новых (не повторов по message_id)."""
+        async with acquire() as conn:
+            rows = await conn.fetch(
+                """
+                INSERT INTO crm_inbox (message_id, phone, text)
+                SELECT message_id, phone, text
+                FROM unnest($1::text[], $2::text[], $3::text[]) WITH ORDINALITY AS v(message_id, phone, text, n)
+                ORDER BY n
+                ON CONFLICT (message_id) WHERE message_id IS NOT NULL DO NOTHING
+                RETURNING id, message_id
+                """,
+                [reply[0] for reply in replies],
+                [reply[1] for reply in replies],
+                [reply[2] for reply in replies],
+            )
+        # id растут в порядке вставки (ORDER BY n), а пропущенные повторы в RETURNING не попадают:
+        # идём по пачке и по вставленным строкам параллельно
+        new_message_ids = [row["message_id"] for row in sorted(rows, key=lambda row: row["id"])]
+        inserted: set[int] = set()
+        for index, (message_id, _, _) in enumerate(replies):
+            if len(inserted) < len(new_message_ids) and new_message_ids[len(inserted)] == message_id:
+                inserted.add(index)
+        return inserted
+
+    async def _dispatch_loop(self) -> None:
+        while True:
+            try:
+                claimed = await self.deliver_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                logger.warning("Ответы CRM: ошибка цикла доставки: %s", exc)
+                claimed = 0
+            if claimed >= self.batch_size:
+                continue  # очередь не разобрана — сразу следующая пачка
+            self._wakeup.clear()
+            timeout = min(CRM_REPLY_POLL_SEC, self._retry_in) if self._retry_in is not None else CRM_REPLY_POLL_SEC
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _claim(self) -> list[asyncpg.Record]:
+        async with acquire() as conn:
+            rows = await conn.fetch(
+                """
+                WITH heads AS (
+                    -- Голова очереди номера: её держит один инстанс, следующие ответы
+                    -- номера не кандидаты, пока она не доставлена или не отброшена
+                    SELECT id, phone FROM crm_inbox
+                    WHERE status IN ('pending', 'sending') AND next_attempt_at <= NOW()
+                      AND id IN (
+                          SELECT DISTINCT ON (phone) id FROM crm_inbox
+                          WHERE status IN ('pending', 'sending')
+                          ORDER BY phone, id
+                      )
+                    ORDER BY id
+                    LIMIT $1
+                    FOR UPDATE SKIP LOCKED
+                )
+                UPDATE crm_inbox i SET
+                    status = 'sending',
+                    attempts = i.attempts + 1,
+                    next_attempt_at = NOW() + make_interval(secs => $2)
+                WHERE i.id IN (SELECT id FROM heads)
+                   OR (
+                       i.phone IN (SELECT phone FROM heads)
+                       AND i.status IN ('pending', 'sending') AND i.next_attempt_at <= NOW()
+                       -- следом за головой — только без пропусков: ни одного более раннего, ждущего повтора
+                       AND NOT EXISTS (
+                           SELECT 1 FROM crm_inbox e
+                           WHERE e.phone = i.phone AND e.id < i.id
+                             AND e.status IN ('pending', 'sending') AND e.next_attempt_at > NOW()
+                       )
+                   )
+                RETURNING i.id, i.phone, i.text, i.attempts
+                """,
+                self.batch_size,
+                CRM_REPLY_LEASE_SEC,
+            )
+        # RETURNING не обязан сохранять порядок
+        return sorted(rows, key=lambda row: row["id"])
+
+    async def _deliver_chat(
+        self, chat_id: int, rows: list[asyncpg.Record], results: dict[int, tuple[str, Optional[str]]]
+    ) -> None:
+        for index, row in enumerate(rows):
+            try:
+                result = await self.sender.send(chat_id, row["text"], via=self.send_func)
+            except Exception as exc:
+                if classify_send_error(exc) != SEND_NETWORK:
+                    results[row["id"]] = ("failed", str(exc))
+                    continue
+                results[row["id"]] = ("pending", str(exc))
+                # Не обгоняем недоставленный ответ тому же клиенту: следующие ждут его без
+                # своей задержки и без списанной попытки
+                for rest in rows[index + 1 :]:
+                    results.setdefault(rest["id"], ("deferred", None))
+                return
+            results[row["id"]] = ("sent", None) if result is not None else ("failed", "чат недоступен")
+
+    async def deliver_once(self) -> int:
+        """Одна пачка: забрать, доставить, отметить. Возвращает размер пачки."""
+        self._retry_in = None
+        rows = await self._claim()
+        if not rows:
+            return 0
+        results: dict[int, tuple[str, Optional[str]]] = {}
+        try:
+            chats = await self.cache.resolve(list({row["phone"] for row in rows}))
+        except Exception as exc:
+            logger.warning("Ответы CRM: не удалось найти клиентов (%s шт.), повторим: %s", len(rows), exc)
+            results = {row["id"]: ("pending", f"поиск клиента: {exc}") for row in rows}
+        else:
+            by_chat: dict[int, list[asyncpg.Record]] = defaultdict(list)
+            for row in rows:
+                chat_id = chats.get(row["phone"])
+                if chat_id is None:
+                    results[row["id"]] = ("no_chat", None)
+                else:
+                    by_chat[chat_id].append(row)
+            await asyncio.gather(*(self._deliver_chat(chat_id, chat_rows, results) for chat_id, chat_rows in by_chat.items()))
+
+        ids: list[int] = []
+        statuses: list[str] = []
+        delays: list[float] = []
+        errors: list[Optional[str]] = []
+        refunds: list[int] = []
+        for row in rows:
+            status, error = results[row["id"]]
+            delay = 0.0
+            refund = 0
+            if status == "deferred":
+                status, refund = "pending", 1
+            elif status == "pending":
+                if row["attempts"] >= CRM_REPLY_MAX_ATTEMPTS:
+                    status = "failed"
+                else:
+                    base = min(CRM_REPLY_RETRY_SEC * 2 ** (row["attempts"] - 1), CRM_REPLY_RETRY_MAX_SEC)
+                    delay = base * random.uniform(0.8, 1.2)
+                    self._retry_in = delay if self._retry_in is None else min(self._retry_in, delay)
+                    self.stats["retried"] += 1
+            if status == "sent":
+                self.stats["delivered"] += 1
+            elif status == "no_chat":
+                self.stats["no_chat"] += 1
+            elif status == "failed":
+                self.stats["failed"] += 1
+                logger.warning("Ответ CRM %s клиенту не доставлен: %s", row["id"], error)
+            ids.append(row["id"])
+            statuses.append(status)
+            delays.append(delay)
+            errors.append(error[:1000] if error else None)
+            refunds.append(refund)
+        async with acquire() as conn:
+            await conn.execute(
+                """
+                UPDATE crm_inbox i SET
+                    status = v.status,
+                    attempts = i.attempts - v.refund,
+                    next_attempt_at = NOW() + make_interval(secs => v.delay),
+                    last_error = v.error,
+                    delivered_at = CASE WHEN v.status = 'sent' THEN NOW() ELSE NULL END
+                FROM unnest($1::bigint[], $2::text[], $3::float8[], $4::text[], $5::int[])
+                    AS v(id, status, delay, error, refund)
+                WHERE i.id = v.id
+                """,
+                ids,
+                statuses,
+                delays,
+                errors,
+                refunds,
+            )
+        return len(rows)
@@ -1,26 +1,257 @@
+import asyncio
 import os
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable
+
 import asyncpg
 from dotenv import load_dotenv
 
 load_dotenv()
 DB_DSN = os.getenv("DB_DSN")
+DB_CONNECT_TIMEOUT_SEC = float(os.getenv("DB_CONNECT_TIMEOUT_SEC", "5") or "5")
+# Лимит на запрос для соединений пула (хэндлеры и короткие фоновые запросы).
+# Долгие задачи берут batch_connection() без лимита.
+DB_COMMAND_TIMEOUT_SEC = float(os.getenv("DB_COMMAND_TIMEOUT_SEC", "15") or "15")
+DB_BREAKER_FAILURES = int(os.getenv("DB_BREAKER_FAILURES", "3") or "3")
+DB_BREAKER_WINDOW_SEC = float(os.getenv("DB_BREAKER_WINDOW_SEC", "30") or "30")
+# Без новых acquire сглаженное ожидание пула вдвое затухает за это время
+POOL_WAIT_EWMA_HALF_LIFE_SEC = float(os.getenv("POOL_WAIT_EWMA_HALF_LIFE_SEC", "5") or "5")
 _pool: asyncpg.Pool | None = None
+_timed_pool: "TimedPool | None" = None
+
+
+class DatabaseUnavailable(RuntimeError):
+    """БД недоступна: предохранитель разомкнут, запросы не отправляются."""
+
+
+class PoolAcquireTimeout(DatabaseUnavailable):
+    """Соединение из пула не получено: таймаут acquire или новое соединение не открылось."""
+
+
+# Ошибки, которые означают недоступность БД, а не ошибку в самом запросе.
+# Голые OSError/TimeoutError сюда не входят: их бросают и Bot API, и медленные
+# запросы; сбои открытия соединения пул переводит в PoolAcquireTimeout.
+DB_UNAVAILABLE_ERRORS: tuple[type[BaseException], ...] = (
+    DatabaseUnavailable,
+    asyncpg.PostgresConnectionError,
+    asyncpg.CannotConnectNowError,
+    asyncpg.AdminShutdownError,
+    asyncpg.CrashShutdownError,
+)
+
+
+def is_db_unavailable_error(exc: BaseException) -> bool:
+    return isinstance(exc, DB_UNAVAILABLE_ERRORS)
+
+
+class CircuitBreaker:
+    """
+    Размыкается после DB_BREAKER_FAILURES сбоев за DB_BREAKER_WINDOW_SEC секунд.
+    Замыкается только явным reset() после успешной проверки связи (probe_db),
+    чтобы при лежащей БД хэндлеры не копили таймауты.
+    """
+
+    def __init__(self, failures: int, window_sec: float) -> None:
+        self.failures = failures
+        self.window_sec = window_sec
+        self._failure_times: list[float] = []
+        self._opened_at: float | None = None
+
+    @property
+    def is_open(self) -> bool:
+        return self._opened_at is not None
+
+    def record_failure(self) -> None:
+        now = time.monotonic()
+        self._failure_times = [t for t in self._failure_times if now - t < self.window_sec]
+        self._failure_times.append(now)
+        if self._opened_at is None and len(self._failure_times) >= self.failures:
+            self._opened_at = now
+
+    def reset(self) -> None:
+        self._failure_times.clear()
+        self._opened_at = None
+
+
+db_breaker = CircuitBreaker(DB_BREAKER_FAILURES, DB_BREAKER_WINDOW_SEC)
+
+
+class PoolStats:
+    """Счётчики пула: ожидание свободного соединения и число запросов к БД."""
+
+    def __init__(self) -> None:
+        self.reset()
+
+    def reset(self) -> None:
+        self.acquires = 0
+        self.wait_total_sec = 0.0
+        self.wait_max_sec = 0.0
+        # Сглаженное ожидание: по нему удобно судить о перегрузке «прямо сейчас».
+        self._wait_ewma = 0.0
+        self._wait_ewma_at = time.monotonic()
+        self.queries = 0
+        # Бенчмарки включают сбор всех замеров: pool_stats.samples = []
+        self.samples: list[float] | None = None
+
+    def record_wait(self, wait_sec: float) -> None:
+        self.acquires += 1
+        self.wait_total_sec += wait_sec
+        if wait_sec > self.wait_max_sec:
+            self.wait_max_sec = wait_sec
+        self._wait_ewma = 0.8 * self.wait_ewma_sec + 0.2 * wait_sec
+        self._wait_ewma_at = time.monotonic()
+        if self.samples is not None:
+            self.samples.append(wait_sec)
+
+    @property
+    def wait_ewma_sec(self) -> float:
+        """
+        Сглаженное ожидание, затухающее со временем: сглаживание двигают только
+        acquire, и без них всплеск держался бы бесконечно (а отложенные задачи,
+        которые ждут спада, сами пул не берут).
+        """
+        idle = time.monotonic() - self._wait_ewma_at
+        return self._wait_ewma * 0.5 ** (idle / POOL_WAIT_EWMA_HALF_LIFE_SEC)
+
+    def record_query(self, _record: object = None) -> None:
+        self.queries += 1
+
+
+pool_stats = PoolStats()
+
+
+class _TimedAcquire:
+    __slots__ = ("_ctx",)
+
+    def __init__(self, ctx) -> None:
+        self._ctx = ctx
+
+    async def __aenter__(self) -> asyncpg.Connection:
+        started = time.perf_counter()
+        try:
+            return await self._ctx.__aenter__()
+        except (OSError, asyncio.TimeoutError) as exc:
+            raise PoolAcquireTimeout(f"Could not acquire a DB connection: {exc!r}") from exc
+        finally:
+            pool_stats.record_wait(time.perf_counter() - started)
+
+    async def __aexit__(self, *exc_info) -> None:
+        return await self._ctx.__aexit__(*exc_info)
+
+
+class TimedPool:
+    """Обёртка над asyncpg.Pool, замеряющая ожидание соединения в acquire()."""
+
+    def __init__(self, pool: asyncpg.Pool) -> None:
+        self.pool = pool
+
+    def acquire(self, *, timeout: float | None = None) -> _TimedAcquire:
+        return _TimedAcquire(self.pool.acquire(timeout=timeout))
+
+    def __getattr__(self, name: str):
+        return getattr(self.pool, name)
+
+
+async def _init_connection(conn: asyncpg.Connection) -> None:
+    conn.add_query_logger(pool_stats.record_query)
+
 
 async def init_pool(min_size: int = 1, max_size: int = 5) -> asyncpg.Pool:
-    global _pool
+    global _pool, _timed_pool
     if not DB_DSN:
         raise RuntimeError("DB_DSN is not set in .env")
     if _pool is None:
-        _pool = await asyncpg.create_pool(dsn=DB_DSN, min_size=min_size, max_size=max_size)
+        _pool = await asyncpg.create_pool(
+            dsn=DB_DSN,
+            min_size=min_size,
+            max_size=max_size,
+            timeout=DB_CONNECT_TIMEOUT_SEC,
+            command_timeout=DB_COMMAND_TIMEOUT_SEC,
+            init=_init_connection,
+        )
+        _timed_pool = TimedPool(_pool)
     return _pool
 
-def get_pool() -> asyncpg.Pool:
-    if _pool is None:
+async def warm_pool(warmer: Callable[[asyncpg.Connection], Awaitable[Any]], size: int) -> int:
+    """
+    Открывает size соединений одновременно и прогоняет на каждом warmer —
+    горячие запросы попадают в кэш подготовленных выражений asyncpg до первых апдейтов.
+    """
+    pool = get_pool()
+    arrived = 0
+    everyone = asyncio.Event()
+
+    async def one() -> None:
+        nonlocal arrived
+        async with pool.acquire() as conn:
+            await warmer(conn)
+            arrived += 1
+            if arrived == size:
+                everyone.set()
+            # Держим соединение, пока не возьмут все: иначе пул отдаст то же самое
+            try:
+                await asyncio.wait_for(everyone.wait(), timeout=DB_CONNECT_TIMEOUT_SEC)
+            except asyncio.TimeoutError:
+                pass
+
+    await asyncio.gather(*(one() for _ in range(size)))
+    return arrived
+
+def get_pool(*, ignore_breaker: bool = False) -> asyncpg.Pool:
+    """ignore_breaker — для восстановления (replay журнала) до замыкания предохранителя."""
+    if _timed_pool is None:
         raise RuntimeError("DB pool is not initialized. Call init_pool() first.")
-    return _pool
+    if db_breaker.is_open and not ignore_breaker:
+        raise DatabaseUnavailable("Database circuit breaker is open")
+    return _timed_pool  # type: ignore[return-value]
+
+async def probe_db() -> bool:
+    """Проверяет связь с БД в обход предохранителя."""
+    if _pool is None:
+        return False
+    try:
+        async with _pool.acquire(timeout=DB_CONNECT_TIMEOUT_SEC) as conn:
+            await conn.fetchval("SELECT 1", timeout=DB_CONNECT_TIMEOUT_SEC)
+        return True
+    except Exception:
+        return False
+
+@asynccontextmanager
+async def batch_connection(application_name: str) -> AsyncIterator[asyncpg.Connection]:
+    """
+    Отдельное соединение для долгих задач (сверки, сканы, CREATE INDEX
+    CONCURRENTLY): без DB_COMMAND_TIMEOUT_SEC и не занимает соединение пула.
+    """
+    if not DB_DSN:
+        raise RuntimeError("DB_DSN is not set in .env")
+    if db_breaker.is_open:
+        raise DatabaseUnavailable("Database circuit breaker is open")
+    try:
+        conn = await asyncpg.connect(
+            dsn=DB_DSN,
+            timeout=DB_CONNECT_TIMEOUT_SEC,
+            server_settings={"application_name": application_name},
+        )
+    except (OSError, asyncio.TimeoutError) as exc:
+        raise DatabaseUnavailable(f"Could not connect to DB: {exc!r}") from exc
+    try:
+        yield conn
+    finally:
+        await conn.close()
 
 async def close_pool() -> None:
-    global _pool
+    global _pool, _timed_pool
     if _pool is not None:
         await _pool.close()
         _pool = None
+        _timed_pool = None
+
+@asynccontextmanager
+async def acquire(conn: asyncpg.Connection | None = None) -> AsyncIterator[asyncpg.Connection]:
+    """Берёт соединение из пула или переиспользует переданное (например, внутри чужой транзакции)."""
+    if conn is not None:
+        yield conn
+        return
+    async with get_pool().acquire() as pooled:
+        yield pooled
@@ -0,0 +1,338 @@
+"""
+Поиск и слияние дублей клиентов.
+
+Дубли появляются из-за разного формата телефона и из-за того, что один и тот
+же Telegram ID записан то в tg_user_id (админ-бот, CRM), то в bot_tg_user_id
+(этот бот). Группы ищутся одним SQL-запросом по ключам phone_digits и
+Telegram ID, пересекающиеся группы склеиваются (union-find). Группу, где по
+Telegram ID сошлись клиенты с разными телефонами, не трогаем — это решает
+человек.
+
+Выживший в группе (детерминированно): больше заказов → подписан на бота →
+есть phone_digits → меньший id. Слияние идёт пачками групп, каждая пачка —
+своя короткая транзакция с lock_timeout, поэтому бот не ждёт на блокировках.
+
+    python -m app.dedup            # отчёт (dry-run)
+    python -m app.dedup --apply    # слить
+"""
+import argparse
+import asyncio
+import csv
+import json
+import logging
+import os
+import sys
+import time
+from dataclasses import dataclass, field
+from typing import Any, Optional
+
+import asyncpg
+from dotenv import load_dotenv
+
+from app.bonus_ledger import rebuild_client
+from app.db import acquire, batch_connection, close_pool, init_pool
+from app.order_push import client_chat_cache
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+DEDUP_BATCH_GROUPS = int(os.getenv("DEDUP_BATCH_GROUPS", "50") or "50")
+DEDUP_LOCK_TIMEOUT = (os.getenv("DEDUP_LOCK_TIMEOUT") or "2s").strip()
+
+# Как переносить поля удаляемого клиента в выжившего
+MERGE_SUM_COLUMNS = ("bonus_balance", "total_spent", "total_bonuses_earned", "total_bonuses_spent")
+MERGE_FILL_COLUMNS = (
+    "phone",
+    "phone_digits",
+    "tg_user_id",
+    "bot_tg_user_id",
+    "tg_username",
+    "tg_first_name",
+    "tg_last_name",
+    "bot_started_at",
+    "full_name",
+    "name",
+)
+MERGE_OR_COLUMNS = ("bot_started", "bot_bonus_granted")
+# Таблицы, которые merge_clients обрабатывает сам
+_SPECIAL_TABLES = {"clients", "client_bonus_ledger"}
+
+_CLIENT_COLUMNS: Optional[set[str]] = None
+_CLIENT_REFERENCES: Optional[list[tuple[str, str]]] = None
+
+
+async def _client_columns(conn: asyncpg.Connection) -> set[str]:
+    global _CLIENT_COLUMNS
+    if _CLIENT_COLUMNS is None:
+        rows = await conn.fetch(
+            """
+            SELECT column_name FROM information_schema.columns
+            WHERE table_schema = 'public' AND table_name = 'clients'
+            """
+        )
+        _CLIENT_COLUMNS = {r["column_name"] for r in rows}
+    return _CLIENT_COLUMNS
+
+
+async def _client_references(conn: asyncpg.Connection) -> list[tuple[str, str]]:
+    """Все (таблица, колонка) с внешним ключом на clients(id), кроме обрабатываемых отдельно."""
+    global _CLIENT_REFERENCES
+    if _CLIENT_REFERENCES is None:
+        rows = await conn.fetch(
+            """
+            SELECT con.conrelid::regclass::text AS table_name, att.attname AS column_name
+            FROM pg_constraint con
+            JOIN pg_attribute att ON att.attrelid = con.conrelid AND att.attnum = con.conkey[1]
+            WHERE con.contype = 'f'
+              AND con.confrelid = 'clients'::regclass
+              AND array_length(con.conkey, 1) = 1
+            """
+        )
+        refs = {("orders", "client_id"), ("bonus_transactions", "client_id")}
+        refs.update((r["table_name"], r["column_name"]) for r in rows if r["table_name"] not in _SPECIAL_TABLES)
+        _CLIENT_REFERENCES = sorted(refs)
+    return _CLIENT_REFERENCES
+
+
+async def merge_clients(conn: asyncpg.Connection, keep_id: int, drop_id: int) -> None:
+    """
+    Переносит в keep_id всё, что ссылается на drop_id, складывает счётчики,
+    дозаполняет пустые поля и удаляет drop_id. Вызывать внутри транзакции.
+    """
+    cols = await _client_columns(conn)
+    drop = await conn.fetchrow("SELECT * FROM clients WHERE id=$1 FOR UPDATE", drop_id)
+    if drop is None:
+        return
+
+    # Уникальный индекс bonus_transactions_bot_signup_once: бонус за подписку у клиента один.
+    # Если он был у обоих, у переносимой транзакции меняем reason, сумму не трогаем.
+    await conn.execute(
+        """
+        UPDATE bonus_transactions SET reason = 'bot_signup_merged'
+        WHERE client_id = $2 AND reason = 'bot_signup'
+          AND EXISTS (SELECT 1 FROM bonus_transactions WHERE client_id = $1 AND reason = 'bot_signup')
+        """,
+        keep_id,
+        drop_id,
+    )
+    for table, column in await _client_references(conn):
+        await conn.execute(f"UPDATE {table} SET {column}=$1 WHERE {column}=$2", keep_id, drop_id)
+
+    # Удаляем до обновления выжившего: phone_digits и bot_tg_user_id уникальны
+    await conn.execute("DELETE FROM clients WHERE id=$1", drop_id)
+
+    updates: list[str] = []
+    params: list[Any] = [keep_id]
+    for col in MERGE_SUM_COLUMNS:
+        if col in cols and drop[col]:
+            params.append(drop[col])
+            updates.append(f"{col} = COALESCE({col}, 0) + ${len(params)}")
+    for col in MERGE_FILL_COLUMNS:
+        if col in cols and drop[col] is not None:
+            params.append(drop[col])
+            updates.append(f"{col} = COALESCE({col}, ${len(params)})")
+    for col in MERGE_OR_COLUMNS:
+        if col in cols and drop[col]:
+            updates.append(f"{col} = true")
+    if updates:
+        await conn.execute(f"UPDATE clients SET {', '.join(updates)} WHERE id=$1", *params)
+    # Транзакции переехали к keep_id — корзины сгорания считаем заново
+    await rebuild_client(conn, keep_id)
+
+
+# --- поиск групп ---
+
+
+@dataclass
+class DuplicateGroup:
+    keep_id: int
+    drop_ids: list[int]
+    keys: list[str] = field(default_factory=list)
+    phones: list[str] = field(default_factory=list)
+
+
+def _find(parent: dict[int, int], item: int) -> int:
+    while parent[item] != item:
+        parent[item] = parent[parent[item]]
+        item = parent[item]
+    return item
+
+
+async def find_duplicate_groups(conn: asyncpg.Connection) -> tuple[list[DuplicateGroup], list[list[int]]]:
+    """Возвращает группы для слияния и группы с конфликтом телефонов (их не сливаем)."""
+    cols = await _client_columns(conn)
+    key_exprs: list[str] = []
+    if "phone_digits" in cols:
+        key_exprs.append("CASE WHEN phone_digits <> '' THEN 'phone:' || phone_digits END")
+    if "tg_user_id" in cols:
+        key_exprs.append("'tg:' || tg_user_id::text")
+    if "bot_tg_user_id" in cols:
+        key_exprs.append("'tg:' || bot_tg_user_id::text")
+    if not key_exprs:
+        return [], []
+    orders_expr = "(SELECT COUNT(*) FROM orders o WHERE o.client_id = c.id)"
+    started_expr = "COALESCE(c.bot_started, false)" if "bot_started" in cols else "false"
+    digits_expr = "c.phone_digits" if "phone_digits" in cols else "NULL::text"
+
+    # Только клиенты, у которых хоть один ключ встречается больше одного раза
+    rows = await conn.fetch(
+        f"""
+        WITH keys AS (
+            SELECT c.id, k.key
+            FROM clients c
+            CROSS JOIN LATERAL unnest(ARRAY[{", ".join(key_exprs)}]) AS k(key)
+            WHERE k.key IS NOT NULL
+        ),
+        dup_keys AS (
+            SELECT key FROM keys GROUP BY key HAVING COUNT(DISTINCT id) > 1
+        )
+        SELECT k.id, array_agg(DISTINCT k.key) AS keys,
+               {orders_expr} AS orders, {started_expr} AS started, {digits_expr} AS phone_digits
+        FROM keys k
+        JOIN dup_keys d ON d.key = k.key
+        JOIN clients c ON c.id = k.id
+        GROUP BY k.id, c.id
+        """
+    )
+    parent: dict[int, int] = {}
+    key_owner: dict[str, int] = {}
+    info: dict[int, asyncpg.Record] = {}
+    for row in rows:
+        client_id = row["id"]
+        info[client_id] = row
+        parent.setdefault(client_id, client_id)
+        for key in row["keys"]:
+            if key in key_owner:
+                a, b = _find(parent, client_id), _find(parent, key_owner[key])
+                if a != b:
+                    parent[max(a, b)] = min(a, b)
+            else:
+                key_owner[key] = client_id
+
+    members: dict[int, list[int]] = {}
+    for client_id in parent:
+        members.setdefault(_find(parent, client_id), []).append(client_id)
+
+    groups: list[DuplicateGroup] = []
+    conflicts: list[list[int]] = []
+    for ids in members.values():
+        if len(ids) < 2:
+            continue
+        phones = sorted({info[i]["phone_digits"] for i in ids if info[i]["phone_digits"]})
+        if len(phones) > 1:
+            conflicts.append(sorted(ids))
+            continue
+        ranked = sorted(ids, key=lambda i: (-info[i]["orders"], not info[i]["started"], not info[i]["phone_digits"], i))
+        keys = sorted({k for i in ids for k in info[i]["keys"]})
+        groups.append(DuplicateGroup(keep_id=ranked[0], drop_ids=sorted(ranked[1:]), keys=keys, phones=phones))
+    groups.sort(key=lambda g: g.keep_id)
+    conflicts.sort()
+    return groups, conflicts
+
+
+# --- слияние пачками ---
+
+
+async def _merge_batch(conn: asyncpg.Connection, batch: list[DuplicateGroup]) -> int:
+    async with conn.transaction():
+        await conn.execute(f"SET LOCAL lock_timeout = '{DEDUP_LOCK_TIMEOUT}'")
+        # Те же advisory-блокировки, что у upsert_contact: бот не создаст клиента с этим номером посреди слияния
+        for phone in sorted({p for g in batch for p in g.phones}):
+            await conn.execute("SELECT pg_advisory_xact_lock(hashtext('client_phone:' || $1))", phone)
+        ids = sorted({g.keep_id for g in batch} | {i for g in batch for i in g.drop_ids})
+        # Блокируем строки в порядке id, чтобы не получить взаимоблокировку с ботом
+        alive = {r["id"] for r in await conn.fetch(
+            "SELECT id FROM clients WHERE id = ANY($1::bigint[]) ORDER BY id FOR UPDATE", ids
+        )}
+        merged = 0
+        for group in batch:
+            if group.keep_id not in alive:
+                continue  # группа изменилась после поиска — подхватит следующий прогон
+            for drop_id in group.drop_ids:
+                if drop_id in alive:
+                    await merge_clients(conn, group.keep_id, drop_id)
+                    merged += 1
+        return merged
+
+
+async def merge_duplicate_groups(
+    groups: list[DuplicateGroup], batch_size: int = DEDUP_BATCH_GROUPS, pause_sec: float = 0.0
+) -> dict[str, Any]:
+    stats: dict[str, Any] = {"groups": len(groups), "merged": 0, "failed_batches": 0}
+    started = time.monotonic()
+    for start in range(0, len(groups), batch_size):
+        batch = groups[start : start + batch_size]
+        try:
+            async with acquire() as conn:
+                stats["merged"] += await _merge_batch(conn, batch)
+            # Чат выжившего мог смениться (bot_tg_user_id от слитого клиента)
+            for group in batch:
+                client_chat_cache.invalidate(group.keep_id)
+                for drop_id in group.drop_ids:
+                    client_chat_cache.invalidate(drop_id)
+        except (asyncpg.LockNotAvailableError, asyncpg.DeadlockDetectedError, asyncpg.UniqueViolationError) as exc:
+            stats["failed_batches"] += 1
+            logger.warning("Пачка групп %s..%s пропущена: %s", batch[0].keep_id, batch[-1].keep_id, exc)
+        done = min(start + batch_size, len(groups))
+        logger.info(
+            "Дубли: %s/%s групп, слито %s клиентов, %.0f групп/с",
+            done,
+            len(groups),
+            stats["merged"],
+            done / max(time.monotonic() - started, 1e-6),
+        )
+        if pause_sec:
+            await asyncio.sleep(pause_sec)
+    stats["elapsed_sec"] = round(time.monotonic() - started, 3)
+    return stats
+
+
+def write_report(path: str, groups: list[DuplicateGroup], conflicts: list[list[int]]) -> None:
+    with open(path, "w", encoding="utf-8", newline="") as fh:
+        writer = csv.writer(fh)
+        writer.writerow(["action", "keep_id", "drop_ids", "keys"])
+        for group in groups:
+            writer.writerow(["merge", group.keep_id, " ".join(map(str, group.drop_ids)), " ".join(group.keys)])
+        for ids in conflicts:
+            writer.writerow(["conflict", "", " ".join(map(str, ids)), "разные телефоны"])
+
+
+async def _main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Поиск и слияние дублей клиентов")
+    parser.add_argument("--apply", action="store_true", help="слить (без флага — только отчёт)")
+    parser.add_argument("--batch", type=int, default=DEDUP_BATCH_GROUPS, help="групп на транзакцию")
+    parser.add_argument("--pause", type=float, default=0.0, help="пауза между пачками, с")
+    parser.add_argument("--limit", type=int, default=0, help="обработать не больше N групп")
+    parser.add_argument("--report", help="сохранить группы в CSV")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    await init_pool(min_size=1, max_size=2)
+    try:
+        async with batch_connection("client-dedup") as conn:
+            started = time.monotonic()
+            groups, conflicts = await find_duplicate_groups(conn)
+            search_sec = time.monotonic() - started
+        if args.limit:
+            groups = groups[: args.limit]
+        if args.report:
+            write_report(args.report, groups, conflicts)
+        summary: dict[str, Any] = {
+            "groups": len(groups),
+            "clients_to_drop": sum(len(g.drop_ids) for g in groups),
+            "conflicts": len(conflicts),
+            "search_sec": round(search_sec, 3),
+        }
+        if args.apply:
+            summary.update(await merge_duplicate_groups(groups, args.batch, args.pause))
+        else:
+            for group in groups[:20]:
+                print(f"keep {group.keep_id} ← drop {group.drop_ids}  [{', '.join(group.keys)}]", file=sys.stderr)
+    finally:
+        await close_pool()
+    print(json.dumps(summary, ensure_ascii=False))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(asyncio.run(_main()))
@@ -0,0 +1,194 @@
+"""
+Выгрузка подписчиков бота и их бонусов в CSV для админов (/export).
+
+Строки не собираются в памяти бота: COPY (SELECT ...) TO STDOUT отдаёт CSV
+частями (copy_from_query), и каждая часть сразу сжимается gzip во временный
+файл — в памяти не больше одной части. Запрос идёт по отдельному соединению,
+а не из общего пула: долгая выгрузка не отнимает соединения у хэндлеров.
+Сжатие и запись файла выполняются в потоке, чтобы не задерживать цикл событий.
+
+Фильтры команды: /export [started] [phone] [from=ГГГГ-ММ-ДД] [to=ГГГГ-ММ-ДД]
+- started — только клиенты с bot_started;
+- phone — только с телефоном;
+- from / to — дата подписки на бота (bot_started_at по МСК), включительно.
+"""
+import asyncio
+import gzip
+import logging
+import os
+import tempfile
+import time
+from dataclasses import dataclass
+from datetime import date, datetime, time as day_time, timedelta
+from typing import Any, Awaitable, Callable, Optional
+
+import asyncpg
+from dotenv import load_dotenv
+
+from app.bonus_ledger import MOSCOW_TZ
+from app.db import DB_CONNECT_TIMEOUT_SEC, DB_DSN
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+EXPORT_TIMEOUT_SEC = float(os.getenv("EXPORT_TIMEOUT_SEC", "600") or "600")
+EXPORT_PROGRESS_SEC = float(os.getenv("EXPORT_PROGRESS_SEC", "3") or "3")
+# Лимит Bot API на отправку документа
+EXPORT_MAX_BYTES = int(os.getenv("EXPORT_MAX_BYTES", str(50 * 1024 * 1024)) or str(50 * 1024 * 1024))
+
+ProgressFunc = Callable[[int], Awaitable[Any]]
+
+EXPORT_USAGE = (
+    "Использование: /export [started] [phone] [from=ГГГГ-ММ-ДД] [to=ГГГГ-ММ-ДД]\n"
+    "started — только подписанные на бота, phone — только с телефоном,\n"
+    "from/to — дата подписки на бота, включительно."
+)
+
+
+@dataclass(frozen=True)
+class ExportFilters:
+    started_only: bool = False
+    with_phone: bool = False
+    date_from: Optional[date] = None
+    date_to: Optional[date] = None
+
+    def describe(self) -> str:
+        parts = []
+        if self.started_only:
+            parts.append("подписаны на бота")
+        if self.with_phone:
+            parts.append("с телефоном")
+        if self.date_from:
+            parts.append(f"с {self.date_from:%d.%m.%Y}")
+        if self.date_to:
+            parts.append(f"по {self.date_to:%d.%m.%Y}")
+        return ", ".join(parts) or "все клиенты"
+
+
+@dataclass(frozen=True)
+class ExportResult:
+    path: str
+    filename: str
+    rows: int
+    size: int
+
+
+def parse_export_args(args: Optional[str]) -> ExportFilters:
+    """Разбирает аргументы /export; на неизвестный аргумент — ValueError с подсказкой."""
+    values: dict[str, Any] = {}
+    for token in (args or "").split():
+        key, _, value = token.lower().partition("=")
+        if key == "started" and not value:
+            values["started_only"] = True
+        elif key == "phone" and not value:
+            values["with_phone"] = True
+        elif key in {"from", "to"} and value:
+            try:
+                values["date_from" if key == "from" else "date_to"] = date.fromisoformat(value)
+            except ValueError:
+                raise ValueError(f"Неверная дата: {value}\n\n{EXPORT_USAGE}") from None
+        else:
+            raise ValueError(f"Неизвестный параметр: {token}\n\n{EXPORT_USAGE}")
+    filters = ExportFilters(**values)
+    if filters.date_from and filters.date_to and filters.date_from > filters.date_to:
+        raise ValueError(f"Дата from позже даты to\n\n{EXPORT_USAGE}")
+    return filters
+
+
+def build_export_query(filters: ExportFilters, name_column: str) -> tuple[str, list[Any]]:
+    conditions: list[str] = []
+    params: list[Any] = []
+    if filters.started_only:
+        conditions.append("c.bot_started")
+    if filters.with_phone:
+        conditions.append("NULLIF(c.phone, '') IS NOT NULL")
+    if filters.date_from:
+        params.append(datetime.combine(filters.date_from, day_time(), MOSCOW_TZ))
+        conditions.append(f"c.bot_started_at >= ${len(params)}")
+    if filters.date_to:
+        params.append(datetime.combine(filters.date_to + timedelta(days=1), day_time(), MOSCOW_TZ))
+        conditions.append(f"c.bot_started_at < ${len(params)}")
+    where = " AND ".join(conditions) or "true"
+    # Баланс — как в «Моих бонусах» (clients.bonus_balance). Ближайшее сгорание —
+    # первая ещё не наступившая корзина проекции (как alive_expiry): next_expires_on
+    # в проекции может быть уже в прошлом, если сгоревшее ещё не списано.
+    params.append(datetime.now(MOSCOW_TZ).date())
+    today = f"${len(params)}"
+    query = f"""
+        SELECT c.id,
+               c.{name_column} AS name,
+               c.phone,
+               c.bot_tg_user_id,
+               c.bot_started,
+               to_char(c.bot_started_at AT TIME ZONE 'Europe/Moscow', 'YYYY-MM-DD HH24:MI') AS bot_started_at,
+               c.bonus_balance,
+               e.next_expires_on,
+               e.next_expiring
+        FROM clients c
+        LEFT JOIN client_bonus_ledger l ON l.client_id = c.id
+        LEFT JOIN LATERAL (
+            SELECT (b.bucket->>0)::date AS next_expires_on, (b.bucket->>1)::int AS next_expiring
+            FROM jsonb_array_elements(l.buckets) WITH ORDINALITY AS b(bucket, ord)
+            WHERE b.bucket->>0 IS NOT NULL
+              AND (b.bucket->>1)::int > 0
+              AND (b.bucket->>0)::date >= {today}::date
+            ORDER BY b.ord
+            LIMIT 1
+        ) e ON true
+        WHERE {where}
+        ORDER BY c.id
+    """
+    return query, params
+
+
+async def export_clients_csv(
+    filters: ExportFilters,
+    *,
+    name_column: str,
+    progress: Optional[ProgressFunc] = None,
+    dsn: Optional[str] = DB_DSN,
+) -> ExportResult:
+    """
+    Пишет выгрузку в сжатый временный файл и возвращает его. Файл удаляет
+    вызывающий. progress(строк) вызывается не чаще раза в EXPORT_PROGRESS_SEC.
+    """
+    query, params = build_export_query(filters, name_column)
+    filename = f"clients_{datetime.now(MOSCOW_TZ):%Y-%m-%d_%H%M}.csv.gz"
+    fd, path = tempfile.mkstemp(prefix="clients_export_", suffix=".csv.gz")
+    os.close(fd)
+    rows = 0
+    reported_at = time.monotonic()
+    try:
+        conn = await asyncpg.connect(
+            dsn=dsn,
+            timeout=DB_CONNECT_TIMEOUT_SEC,
+            server_settings={"application_name": "client-bot-export"},
+        )
+        try:
+            with gzip.open(path, "wb") as archive:
+
+                async def sink(chunk: bytes) -> None:
+                    nonlocal rows, reported_at
+                    await asyncio.to_thread(archive.write, chunk)
+                    # Для прогресса хватает числа переводов строк (внутри полей они редки)
+                    rows += chunk.count(b"\n")
+                    if progress is not None and time.monotonic() - reported_at >= EXPORT_PROGRESS_SEC:
+                        reported_at = time.monotonic()
+                        await progress(rows)
+
+                status = await conn.copy_from_query(
+                    query,
+                    *params,
+                    output=sink,
+                    format="csv",
+                    header=True,
+                    timeout=EXPORT_TIMEOUT_SEC,
+                )
+        finally:
+            await conn.close()
+    except BaseException:
+        os.unlink(path)
+        raise
+    # «COPY n» — точное число строк без заголовка
+    rows = int(status.split()[-1])
+    return ExportResult(path=path, filename=filename, rows=rows, size=os.path.getsize(path))
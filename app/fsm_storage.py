@@ -0,0 +1,296 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Dict, Mapping, Optional
+
+import asyncpg
+from aiogram.exceptions import DataNotDictLikeError
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+from dotenv import load_dotenv
+
+from app.db import db_breaker, get_pool, is_db_unavailable_error
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+# Сколько секунд запись из кэша считается свежей без похода в БД.
+# Держим небольшим, чтобы несколько инстансов за вебхуком видели изменения друг друга.
+FSM_CACHE_FRESH_SEC = float(os.getenv("FSM_CACHE_FRESH_SEC", "5") or "5")
+FSM_CACHE_MAX_ENTRIES = int(os.getenv("FSM_CACHE_MAX_ENTRIES", "10000") or "10000")
+FSM_FLUSH_INTERVAL_SEC = float(os.getenv("FSM_FLUSH_INTERVAL_SEC", "0.05") or "0.05")
+FSM_FLUSH_BATCH_SIZE = int(os.getenv("FSM_FLUSH_BATCH_SIZE", "500") or "500")
+# Брошенные состояния ("Задать вопрос" и тишина) удаляются через сутки.
+FSM_STATE_TTL_SEC = int(os.getenv("FSM_STATE_TTL_SEC", "86400") or "86400")
+FSM_EVICT_INTERVAL_SEC = int(os.getenv("FSM_EVICT_INTERVAL_SEC", "600") or "600")
+
+
+async def ensure_fsm_storage_schema(conn: asyncpg.Connection) -> None:
+    await conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS bot_fsm_states (
+            bot_id bigint NOT NULL,
+            chat_id bigint NOT NULL,
+            user_id bigint NOT NULL,
+            thread_id bigint NOT NULL DEFAULT 0,
+            destiny text NOT NULL DEFAULT 'default',
+            state text,
+            data jsonb,
+            updated_at timestamptz NOT NULL DEFAULT NOW(),
+            PRIMARY KEY (bot_id, chat_id, user_id, thread_id, destiny)
+        );
+        """
+    )
+    await conn.execute(
+        """
+        CREATE INDEX IF NOT EXISTS bot_fsm_states_updated_at_idx
+        ON bot_fsm_states (updated_at);
+        """
+    )
+
+
+_RowKey = tuple[int, int, int, int, str]
+
+
+def _row_key(key: StorageKey) -> _RowKey:
+    return (key.bot_id, key.chat_id, key.user_id, key.thread_id or 0, key.destiny)
+
+
+@dataclass(slots=True)
+class _CacheEntry:
+    state: Optional[str] = None
+    data: Dict[str, Any] = field(default_factory=dict)
+    loaded_at: float = 0.0
+    touched_at: float = 0.0
+
+
+class PgFSMStorage(BaseStorage):
+    """
+    FSM-хранилище в Postgres (таблица bot_fsm_states) с write-through кэшем в памяти.
+
+    Чтение идёт из кэша, пока запись свежая (FSM_CACHE_FRESH_SEC), иначе из БД.
+    Запись сразу попадает в кэш и в очередь, которая сбрасывается в БД пачками
+    раз в FSM_FLUSH_INTERVAL_SEC. Пустые состояния удаляются из таблицы,
+    брошенные — вычищаются по FSM_STATE_TTL_SEC.
+    """
+
+    def __init__(self) -> None:
+        self._cache: "OrderedDict[_RowKey, _CacheEntry]" = OrderedDict()
+        self._pending: Dict[_RowKey, _CacheEntry] = {}
+        self._flush_lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._flusher: Optional[asyncio.Task] = None
+        self._evictor: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        """Запускает фоновые задачи сброса и вычистки. Вызывать после init_pool()."""
+        if self._flusher is None:
+            self._flusher = asyncio.create_task(self._flush_loop(), name="fsm-flush")
+        if self._evictor is None:
+            self._evictor = asyncio.create_task(self._evict_loop(), name="fsm-evict")
+
+    async def close(self) -> None:
+        for task in (self._flusher, self._evictor):
+            if task is not None:
+                task.cancel()
+        for task in (self._flusher, self._evictor):
+            if task is not None:
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self._flusher = None
+        self._evictor = None
+        try:
+            await self.flush()
+        except Exception as exc:
+            logger.error("FSM storage: не удалось сбросить %s состояний при остановке: %s", len(self._pending), exc)
+
+    # --- cache ---
+
+    def _remember(self, row_key: _RowKey, entry: _CacheEntry) -> None:
+        self._cache[row_key] = entry
+        self._cache.move_to_end(row_key)
+        # Несброшенные записи живут в self._pending, поэтому из кэша их выбрасывать безопасно.
+        while len(self._cache) > FSM_CACHE_MAX_ENTRIES:
+            self._cache.popitem(last=False)
+
+    async def _entry(self, key: StorageKey) -> _CacheEntry:
+        row_key = _row_key(key)
+        pending = self._pending.get(row_key)
+        if pending is not None:
+            return pending
+        now = time.monotonic()
+        cached = self._cache.get(row_key)
+        if cached is not None:
+            if now - cached.touched_at > FSM_STATE_TTL_SEC:
+                cached = _CacheEntry(loaded_at=now, touched_at=now)
+                self._remember(row_key, cached)
+                return cached
+            if now - cached.loaded_at < FSM_CACHE_FRESH_SEC:
+                self._cache.move_to_end(row_key)
+                return cached
+
+        try:
+            row = await self._load(row_key)
+        except Exception as exc:
+            if not is_db_unavailable_error(exc):
+                raise
+            # БД недоступна: отдаём что есть (даже устаревшее), чтобы статичные хэндлеры работали.
+            db_breaker.record_failure()
+            return cached if cached is not None else _CacheEntry()
+        entry = _CacheEntry(loaded_at=now, touched_at=now)
+        if row:
+            entry.state = row["state"]
+            entry.data = json.loads(row["data"]) if row["data"] else {}
+        self._remember(row_key, entry)
+        return entry
+
+    async def _load(self, row_key: _RowKey) -> Optional[asyncpg.Record]:
+        pool = get_pool()
+        async with pool.acquire() as conn:
+            return await conn.fetchrow(
+                """
+                SELECT state, data
+                FROM bot_fsm_states
+                WHERE bot_id = $1 AND chat_id = $2 AND user_id = $3
+                  AND thread_id = $4 AND destiny = $5
+                  AND updated_at > NOW() - make_interval(secs => $6)
+                """,
+                *row_key,
+                float(FSM_STATE_TTL_SEC),
+            )
+
+    def _write(self, key: StorageKey, state: Optional[str], data: Dict[str, Any]) -> None:
+        row_key = _row_key(key)
+        now = time.monotonic()
+        entry = _CacheEntry(state=state, data=data, loaded_at=now, touched_at=now)
+        self._pending[row_key] = entry
+        self._remember(row_key, entry)
+        if len(self._pending) >= FSM_FLUSH_BATCH_SIZE:
+            self._wakeup.set()
+
+    # --- BaseStorage ---
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        entry = await self._entry(key)
+        new_state = state.state if isinstance(state, State) else state
+        self._write(key, new_state, entry.data)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._entry(key)).state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        if not isinstance(data, dict):
+            raise DataNotDictLikeError(
+                f"Data must be a dict or dict-like object, got {type(data).__name__}"
+            )
+        entry = await self._entry(key)
+        self._write(key, entry.state, data.copy())
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return (await self._entry(key)).data.copy()
+
+    # --- flushing ---
+
+    async def flush(self) -> None:
+        """Сбрасывает накопленные изменения в БД одной пачкой на upsert и одной на delete."""
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            batch = self._pending
+            self._pending = {}
+            upserts = [(k, e) for k, e in batch.items() if e.state is not None or e.data]
+            deletes = [k for k, e in batch.items() if e.state is None and not e.data]
+            try:
+                pool = get_pool()
+                async with pool.acquire() as conn:
+                    async with conn.transaction():
+                        if upserts:
+                            await conn.execute(
+                                """
+                                INSERT INTO bot_fsm_states (bot_id, chat_id, user_id, thread_id, destiny, state, data, updated_at)
+                                SELECT b, c, u, t, d, s, x::jsonb, NOW()
+                                FROM unnest($1::bigint[], $2::bigint[], $3::bigint[], $4::bigint[],
+                                            $5::text[], $6::text[], $7::text[]) AS v(b, c, u, t, d, s, x)
+                                ON CONFLICT (bot_id, chat_id, user_id, thread_id, destiny) DO UPDATE
+                                SET state = EXCLUDED.state,
+                                    data = EXCLUDED.data,
+                                    updated_at = EXCLUDED.updated_at
+                                """,
+                                [k[0] for k, _ in upserts],
+                                [k[1] for k, _ in upserts],
+                                [k[2] for k, _ in upserts],
+                                [k[3] for k, _ in upserts],
+                                [k[4] for k, _ in upserts],
+                                [e.state for _, e in upserts],
+                                [json.dumps(e.data, ensure_ascii=False) if e.data else None for _, e in upserts],
+                            )
+                        if deletes:
+                            await conn.execute(
+                                """
+                                DELETE FROM bot_fsm_states s
+                                USING unnest($1::bigint[], $2::bigint[], $3::bigint[], $4::bigint[], $5::text[])
+                                    AS v(b, c, u, t, d)
+                                WHERE s.bot_id = v.b AND s.chat_id = v.c AND s.user_id = v.u
+                                  AND s.thread_id = v.t AND s.destiny = v.d
+                                """,
+                                [k[0] for k in deletes],
+                                [k[1] for k in deletes],
+                                [k[2] for k in deletes],
+                                [k[3] for k in deletes],
+                                [k[4] for k in deletes],
+                            )
+            except Exception:
+                # Возвращаем несброшенное, не затирая более свежие записи.
+                for row_key, entry in batch.items():
+                    self._pending.setdefault(row_key, entry)
+                raise
+
+    async def _flush_loop(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=FSM_FLUSH_INTERVAL_SEC)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if db_breaker.is_open:
+                # Пока БД недоступна, изменения копятся в памяти и уйдут после восстановления.
+                continue
+            try:
+                await self.flush()
+            except Exception as exc:
+                logger.warning("FSM storage: сброс в БД не удался, повторим: %s", exc)
+                await asyncio.sleep(1.0)
+
+    async def evict_expired(self) -> int:
+        """Удаляет брошенные состояния из кэша и из таблицы. Возвращает число удалённых строк."""
+        now = time.monotonic()
+        stale = [
+            k for k, e in self._cache.items()
+            if now - e.touched_at > FSM_STATE_TTL_SEC and k not in self._pending
+        ]
+        for row_key in stale:
+            self._cache.pop(row_key, None)
+        pool = get_pool()
+        async with pool.acquire() as conn:
+            result = await conn.execute(
+                "DELETE FROM bot_fsm_states WHERE updated_at < NOW() - make_interval(secs => $1)",
+                float(FSM_STATE_TTL_SEC),
+            )
+        deleted = int(result.split()[-1]) if result else 0
+        if deleted or stale:
+            logger.info("FSM storage: вычищено %s строк и %s записей кэша", deleted, len(stale))
+        return deleted
+
+    async def _evict_loop(self) -> None:
+        while True:
+            await asyncio.sleep(FSM_EVICT_INTERVAL_SEC)
+            try:
+                await self.evict_expired()
+            except Exception as exc:
+                logger.warning("FSM storage: вычистка не удалась: %s", exc)
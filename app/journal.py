@@ -0,0 +1,321 @@
+import asyncio
+import json
+import logging
+import os
+import time
+import uuid
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Optional, TypeVar
+
+import asyncpg
+from dotenv import load_dotenv
+
+from app.db import db_breaker, get_pool, is_db_unavailable_error, probe_db
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+WRITE_JOURNAL_PATH = Path(os.getenv("WRITE_JOURNAL_PATH") or "var/write_journal.jsonl")
+# Окно группового fsync: записи, пришедшие за это время, сбрасываются на диск одним fsync.
+WRITE_JOURNAL_FSYNC_SEC = float(os.getenv("WRITE_JOURNAL_FSYNC_SEC", "0.02") or "0.02")
+WRITE_JOURNAL_REPLAY_SEC = float(os.getenv("WRITE_JOURNAL_REPLAY_SEC", "5") or "5")
+# После стольких неудачных попыток запись уходит в dead-letter файл и не держит очередь
+WRITE_JOURNAL_MAX_ATTEMPTS = int(os.getenv("WRITE_JOURNAL_MAX_ATTEMPTS", "5") or "5")
+# Ключи идемпотентности нужны, пока запись может проиграться повторно (она ещё в файле
+# журнала); старые строки write_journal_applied удаляются раз в WRITE_JOURNAL_PRUNE_SEC.
+WRITE_JOURNAL_APPLIED_KEEP_DAYS = int(os.getenv("WRITE_JOURNAL_APPLIED_KEEP_DAYS", "7") or "7")
+WRITE_JOURNAL_PRUNE_SEC = float(os.getenv("WRITE_JOURNAL_PRUNE_SEC", "3600") or "3600")
+
+ApplyFunc = Callable[[asyncpg.Connection, dict[str, Any]], Awaitable[Any]]
+AfterFunc = Callable[[dict[str, Any], Any], Awaitable[None]]
+T = TypeVar("T")
+
+
+async def ensure_write_journal_schema(conn: asyncpg.Connection) -> None:
+    await conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS write_journal_applied (
+            key text PRIMARY KEY,
+            op text NOT NULL,
+            applied_at timestamptz NOT NULL DEFAULT NOW()
+        );
+        """
+    )
+
+
+class WriteJournal:
+    """
+    Локальный журнал записей на время недоступности БД.
+
+    Записи добавляются в JSONL-файл (append-only, групповой fsync) и потом
+    проигрываются по порядку. Каждая запись несёт ключ идемпотентности: он
+    фиксируется в write_journal_applied в той же транзакции, что и сама запись,
+    поэтому повторное проигрывание (например, после падения посреди replay)
+    ничего не задвоит.
+
+    Пока в журнале есть непроигранные записи, новые записи тоже идут в журнал,
+    а не в БД: иначе replay применил бы старые записи поверх более новых
+    (например, подписку поверх отписки). Предохранитель БД замыкается только
+    после того, как журнал проигран целиком. Запись, которая не применилась
+    WRITE_JOURNAL_MAX_ATTEMPTS раз не из-за недоступности БД, переносится в
+    dead-letter файл (<журнал>.dead), чтобы не блокировать остальные.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.replaying_path = path.with_name(path.name + ".replaying")
+        self.dead_letter_path = path.with_name(path.name + ".dead")
+        self._handlers: dict[str, tuple[ApplyFunc, Optional[AfterFunc]]] = {}
+        self._buffer: list[tuple[str, asyncio.Future]] = []
+        self._wakeup = asyncio.Event()
+        self._file_lock = asyncio.Lock()
+        self._replay_lock = asyncio.Lock()
+        self._writer: Optional[asyncio.Task] = None
+        self._closing = False
+        self._recovery: Optional[asyncio.Task] = None
+        self._pruned_at: Optional[float] = None
+        # Есть записи, ещё не проигранные в БД (в файлах или на пути к ним)
+        self._backlog = self.has_pending()
+        self._in_flight = 0
+
+    def register(self, op: str, apply: ApplyFunc, after: Optional[AfterFunc] = None) -> None:
+        """
+        apply выполняется в транзакции replay, after — после её коммита с результатом apply
+        (например, чтобы уведомить клиента).
+        """
+        self._handlers[op] = (apply, after)
+
+    def has_pending(self) -> bool:
+        return any(p.exists() and p.stat().st_size > 0 for p in (self.replaying_path, self.path))
+
+    @property
+    def backlog(self) -> bool:
+        return self._backlog
+
+    # --- запись ---
+
+    async def run_or_append(self, op: str, payload: dict[str, Any], func: Callable[[], Awaitable[T]]) -> Optional[T]:
+        """
+        Выполняет запись в БД, а если БД недоступна или журнал ещё не проигран —
+        кладёт её в журнал (после старых записей) и возвращает None.
+        """
+        if not self._backlog:
+            try:
+                return await func()
+            except Exception as exc:
+                if not is_db_unavailable_error(exc):
+                    raise
+                db_breaker.record_failure()
+        await self.append(op, payload)
+        return None
+
+    async def append(self, op: str, payload: dict[str, Any]) -> str:
+        """Добавляет запись и ждёт, пока она окажется на диске. Возвращает ключ идемпотентности."""
+        if op not in self._handlers:
+            raise ValueError(f"Unknown journal op: {op}")
+        if self._writer is None:
+            self._writer = asyncio.create_task(self._writer_loop(), name="write-journal")
+        key = uuid.uuid4().hex
+        line = json.dumps({"key": key, "op": op, "ts": time.time(), "payload": payload}, ensure_ascii=False)
+        fut = asyncio.get_running_loop().create_future()
+        self._backlog = True
+        self._in_flight += 1
+        self._buffer.append((line, fut))
+        self._wakeup.set()
+        try:
+            await fut
+        finally:
+            self._in_flight -= 1
+        logger.warning("БД недоступна, запись %s сохранена в журнал (%s)", op, key)
+        return key
+
+    def _write_lines(self, lines: list[str]) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, "a", encoding="utf-8") as fh:
+            fh.write("".join(line + "\n" for line in lines))
+            fh.flush()
+            os.fsync(fh.fileno())
+
+    async def _flush(self) -> None:
+        batch, self._buffer = self._buffer, []
+        if not batch:
+            return
+        try:
+            async with self._file_lock:
+                await asyncio.to_thread(self._write_lines, [line for line, _ in batch])
+        except Exception as exc:
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(exc)
+            return
+        for _, fut in batch:
+            if not fut.done():
+                fut.set_result(None)
+
+    async def _writer_loop(self) -> None:
+        while True:
+            await self._wakeup.wait()
+            if not self._closing:
+                await asyncio.sleep(WRITE_JOURNAL_FSYNC_SEC)
+            self._wakeup.clear()
+            await self._flush()
+            if self._closing:
+                return
+
+    # --- проигрывание ---
+
+    async def replay(self) -> int:
+        """
+        Проигрывает журнал по порядку. На недоступности БД останавливается, и
+        хвост ждёт следующей попытки. Другая ошибка тоже останавливает replay
+        (порядок важнее), но считается попыткой записи; исчерпавшая попытки
+        запись уходит в dead-letter файл, и replay идёт дальше.
+        """
+        async with self._replay_lock:
+            async with self._file_lock:
+                # Новые записи во время replay пишутся в свежий файл, старый переименовываем.
+                if not self.replaying_path.exists() and self.path.exists():
+                    self.path.rename(self.replaying_path)
+            if not self.replaying_path.exists():
+                return 0
+
+            lines = (await asyncio.to_thread(self.replaying_path.read_text, encoding="utf-8")).splitlines()
+            applied = 0
+            for idx, line in enumerate(lines):
+                if not line.strip():
+                    continue
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # Недописанная строка при падении процесса.
+                    logger.warning("Журнал: пропущена повреждённая строка %s", idx + 1)
+                    continue
+                try:
+                    if await self._apply(entry):
+                        applied += 1
+                except Exception as exc:
+                    if not is_db_unavailable_error(exc):
+                        entry["attempts"] = entry.get("attempts", 0) + 1
+                        if entry["attempts"] >= WRITE_JOURNAL_MAX_ATTEMPTS:
+                            logger.error(
+                                "Журнал: %s (%s) не применилась %s раз, перенесена в %s: %s",
+                                entry.get("op"),
+                                entry.get("key"),
+                                entry["attempts"],
+                                self.dead_letter_path,
+                                exc,
+                            )
+                            dead = json.dumps({**entry, "error": str(exc)}, ensure_ascii=False)
+                            await asyncio.to_thread(self._write_dead_letter, dead)
+                            continue
+                        lines[idx] = json.dumps(entry, ensure_ascii=False)
+                    logger.warning("Журнал: replay остановлен на %s (%s): %s", entry.get("op"), entry.get("key"), exc)
+                    rest = "".join(item + "\n" for item in lines[idx:])
+                    await asyncio.to_thread(self.replaying_path.write_text, rest, encoding="utf-8")
+                    return applied
+            self.replaying_path.unlink()
+            if applied:
+                logger.warning("Журнал: проиграно %s записей", applied)
+            return applied
+
+    def _write_dead_letter(self, line: str) -> None:
+        with open(self.dead_letter_path, "a", encoding="utf-8") as fh:
+            fh.write(line + "\n")
+            fh.flush()
+            os.fsync(fh.fileno())
+
+    async def _apply(self, entry: dict[str, Any]) -> bool:
+        handler = self._handlers.get(entry.get("op", ""))
+        if handler is None:
+            logger.error("Журнал: неизвестная операция %s, пропускаю", entry.get("op"))
+            return False
+        apply, after = handler
+        # Предохранитель замыкается только после replay, поэтому в обход него
+        pool = get_pool(ignore_breaker=True)
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                fresh = await conn.fetchval(
+                    """
+                    INSERT INTO write_journal_applied (key, op)
+                    VALUES ($1, $2)
+                    ON CONFLICT (key) DO NOTHING
+                    RETURNING true
+                    """,
+                    entry["key"],
+                    entry["op"],
+                )
+                if not fresh:
+                    return False
+                result = await apply(conn, entry["payload"])
+        if after is not None:
+            try:
+                await after(entry["payload"], result)
+            except Exception as exc:
+                logger.warning("Журнал: пост-обработка %s не удалась: %s", entry["op"], exc)
+        return True
+
+    def start_recovery(self) -> None:
+        if self._recovery is None:
+            self._recovery = asyncio.create_task(self._recovery_loop(), name="write-journal-recovery")
+
+    async def stop(self) -> None:
+        if self._recovery is not None:
+            self._recovery.cancel()
+            try:
+                await self._recovery
+            except asyncio.CancelledError:
+                pass
+            self._recovery = None
+        if self._writer is not None:
+            # Не отменяем писателя посреди записи: он сбрасывает буфер на диск и выходит сам
+            self._closing = True
+            self._wakeup.set()
+            try:
+                await self._writer
+            finally:
+                self._writer = None
+                self._closing = False
+        await self._flush()
+
+    async def prune_applied(self) -> int:
+        """Удаляет ключи идемпотентности старше WRITE_JOURNAL_APPLIED_KEEP_DAYS."""
+        async with get_pool().acquire() as conn:
+            result = await conn.execute(
+                "DELETE FROM write_journal_applied WHERE applied_at < NOW() - make_interval(days => $1)",
+                WRITE_JOURNAL_APPLIED_KEEP_DAYS,
+            )
+        return int(result.split()[-1]) if result else 0
+
+    async def _drain(self) -> bool:
+        """Проигрывает журнал, пока он не опустеет. True — если опустел и можно писать в БД напрямую."""
+        while True:
+            await self.replay()
+            if self.replaying_path.exists():
+                return False  # replay остановился на ошибке
+            # Между проверкой и сбросом флага нет await — новая запись не проскочит
+            if self._in_flight == 0 and not self.has_pending():
+                self._backlog = False
+                return True
+            if self._in_flight:
+                await asyncio.sleep(WRITE_JOURNAL_FSYNC_SEC)
+
+    async def _recovery_loop(self) -> None:
+        while True:
+            try:
+                if (db_breaker.is_open or self._backlog) and await probe_db():
+                    if await self._drain():
+                        if db_breaker.is_open:
+                            logger.warning("БД снова доступна, выходим из деградированного режима")
+                        db_breaker.reset()
+                now = time.monotonic()
+                if not (db_breaker.is_open or self._backlog) and (
+                    self._pruned_at is None or now - self._pruned_at >= WRITE_JOURNAL_PRUNE_SEC
+                ):
+                    self._pruned_at = now
+                    await self.prune_applied()
+            except Exception as exc:
+                logger.warning("Журнал: восстановление не удалось: %s", exc)
+            await asyncio.sleep(WRITE_JOURNAL_REPLAY_SEC)
+
+
+write_journal = WriteJournal(WRITE_JOURNAL_PATH)
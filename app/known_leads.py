@@ -0,0 +1,85 @@
+"""
+Индекс Telegram ID, для которых лид уже есть.
+
+Болтливый пользователь без телефона шлёт много сообщений, и каждое вызывает
+create_lead_if_missing. Если ID уже в индексе, в БД не ходим вообще. Индекс
+ограничен KNOWN_LEADS_MAX записями (вытесняются давно не встречавшиеся) и
+прогревается при старте самыми свежими лидами пачками по id. Промах — не
+ошибка: вставка идёт через ON CONFLICT по уникальному индексу (миграция 0008).
+"""
+import logging
+import os
+import time
+from collections import OrderedDict
+
+from dotenv import load_dotenv
+
+from app.db import acquire
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+KNOWN_LEADS_MAX = int(os.getenv("KNOWN_LEADS_MAX", "100000") or "100000")
+KNOWN_LEADS_WARM_BATCH = int(os.getenv("KNOWN_LEADS_WARM_BATCH", "5000") or "5000")
+
+
+class KnownLeadIndex:
+    def __init__(self, max_entries: int = KNOWN_LEADS_MAX) -> None:
+        self.max_entries = max_entries
+        self._ids: OrderedDict[int, None] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def contains(self, tg_user_id: int) -> bool:
+        if tg_user_id in self._ids:
+            self._ids.move_to_end(tg_user_id)
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+    def add(self, tg_user_id: int) -> None:
+        self._ids[tg_user_id] = None
+        self._ids.move_to_end(tg_user_id)
+        if len(self._ids) > self.max_entries:
+            self._ids.popitem(last=False)
+
+    async def warm(self, batch_size: int = KNOWN_LEADS_WARM_BATCH) -> int:
+        """Загружает самые свежие лиды (не больше max_entries), пачками по id от новых к старым."""
+        started = time.monotonic()
+        loaded = 0
+        last_id = None
+        while loaded < self.max_entries:
+            limit = min(batch_size, self.max_entries - loaded)
+            async with acquire() as conn:
+                rows = await conn.fetch(
+                    """
+                    SELECT id, tg_user_id FROM leads
+                    WHERE tg_user_id IS NOT NULL AND ($1::bigint IS NULL OR id < $1)
+                    ORDER BY id DESC
+                    LIMIT $2
+                    """,
+                    last_id,
+                    limit,
+                )
+            if not rows:
+                break
+            last_id = rows[-1]["id"]
+            for row in rows:
+                # Идём от новых к старым: старые не должны вытеснять свежих
+                if row["tg_user_id"] not in self._ids:
+                    self._ids[row["tg_user_id"]] = None
+                    self._ids.move_to_end(row["tg_user_id"], last=False)
+            loaded += len(rows)
+            if len(rows) < limit:
+                break
+        while len(self._ids) > self.max_entries:
+            self._ids.popitem(last=False)
+        logger.info("Индекс лидов прогрет: %s ID за %.2f с", len(self._ids), time.monotonic() - started)
+        return len(self._ids)
+
+
+known_leads = KnownLeadIndex()
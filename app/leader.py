@@ -0,0 +1,209 @@
+import asyncio
+import logging
+import os
+import socket
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable, Optional
+
+import asyncpg
+from dotenv import load_dotenv
+
+from app.db import DB_DSN, get_pool
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+LEADER_POLL_SEC = float(os.getenv("LEADER_POLL_SEC", "2") or "2")
+LEADER_CHECK_TIMEOUT_SEC = float(os.getenv("LEADER_CHECK_TIMEOUT_SEC", "3") or "3")
+JOB_RUNS_KEEP_DAYS = int(os.getenv("JOB_RUNS_KEEP_DAYS", "14") or "14")
+
+INSTANCE_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+
+async def ensure_job_runs_schema(conn: asyncpg.Connection) -> None:
+    await conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS scheduler_job_runs (
+            id bigserial PRIMARY KEY,
+            job_id text NOT NULL,
+            instance_id text NOT NULL,
+            started_at timestamptz NOT NULL DEFAULT NOW(),
+            finished_at timestamptz,
+            status text NOT NULL DEFAULT 'running',
+            rows_affected integer,
+            error text,
+            CONSTRAINT scheduler_job_runs_status_check
+                CHECK (status IN ('running', 'ok', 'error'))
+        );
+        """
+    )
+    await conn.execute(
+        """
+        CREATE INDEX IF NOT EXISTS scheduler_job_runs_job_started_idx
+        ON scheduler_job_runs (job_id, started_at DESC);
+        """
+    )
+
+
+class LeaderElector:
+    """
+    Выбор лидера среди нескольких инстансов бота через pg_try_advisory_lock.
+
+    Блокировка держится на отдельном соединении (не из пула): если процесс-лидер
+    умер или потерял сеть, Postgres отпускает блокировку вместе с сессией, и другой
+    инстанс забирает лидерство на следующем опросе (LEADER_POLL_SEC).
+    """
+
+    def __init__(self, lock_name: str) -> None:
+        self.lock_name = lock_name
+        self._conn: Optional[asyncpg.Connection] = None
+        self._is_leader = False
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def is_leader(self) -> bool:
+        return self._is_leader
+
+    async def start(self) -> None:
+        if self._task is None:
+            # Первую попытку делаем сразу, чтобы одиночный инстанс не ждал интервал опроса.
+            await self._tick()
+            self._task = asyncio.create_task(self._loop(), name="leader-election")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self._drop_connection()
+
+    async def _connect(self) -> asyncpg.Connection:
+        return await asyncpg.connect(
+            dsn=DB_DSN,
+            timeout=LEADER_CHECK_TIMEOUT_SEC,
+            server_settings={
+                "application_name": f"leader:{self.lock_name}",
+                # Мёртвого лидера сервер должен заметить за секунды, а не за часы TCP по умолчанию.
+                "tcp_keepalives_idle": "5",
+                "tcp_keepalives_interval": "2",
+                "tcp_keepalives_count": "3",
+            },
+        )
+
+    async def _drop_connection(self) -> None:
+        conn, self._conn = self._conn, None
+        if self._is_leader:
+            logger.warning("Лидерство потеряно: %s (%s)", self.lock_name, INSTANCE_ID)
+        self._is_leader = False
+        if conn is not None and not conn.is_closed():
+            try:
+                await asyncio.wait_for(conn.close(), timeout=LEADER_CHECK_TIMEOUT_SEC)
+            except Exception:
+                conn.terminate()
+
+    async def _tick(self) -> None:
+        try:
+            if self._conn is None or self._conn.is_closed():
+                self._is_leader = False
+                self._conn = await self._connect()
+            if self._is_leader:
+                # Проверяем, что сессия с блокировкой жива.
+                await self._conn.fetchval("SELECT 1", timeout=LEADER_CHECK_TIMEOUT_SEC)
+                return
+            acquired = await self._conn.fetchval(
+                "SELECT pg_try_advisory_lock(hashtext($1))",
+                self.lock_name,
+                timeout=LEADER_CHECK_TIMEOUT_SEC,
+            )
+            if acquired:
+                self._is_leader = True
+                logger.warning("Инстанс %s стал лидером: %s", INSTANCE_ID, self.lock_name)
+        except Exception as exc:
+            logger.warning("Выбор лидера %s: ошибка соединения: %s", self.lock_name, exc)
+            await self._drop_connection()
+
+    async def _loop(self) -> None:
+        while True:
+            await asyncio.sleep(LEADER_POLL_SEC)
+            await self._tick()
+
+    def singleton(
+        self,
+        job_id: str,
+        func: Callable[[], Awaitable[Any]],
+    ) -> Callable[[], Awaitable[None]]:
+        """
+        Оборачивает задачу планировщика: выполняется только на лидере и пишет историю
+        запусков в scheduler_job_runs. Если задача вернула int, он сохраняется как rows_affected.
+        """
+
+        async def run() -> None:
+            if not self._is_leader:
+                return
+            run_id = await _job_run_started(job_id)
+            try:
+                result = await func()
+            except Exception as exc:
+                logger.exception("Задача %s упала", job_id)
+                await _job_run_finished(run_id, status="error", rows=None, error=f"{type(exc).__name__}: {exc}")
+                return
+            rows = result if isinstance(result, int) and not isinstance(result, bool) else None
+            await _job_run_finished(run_id, status="ok", rows=rows, error=None)
+
+        run.__name__ = f"singleton_{job_id}"
+        return run
+
+
+async def _job_run_started(job_id: str) -> Optional[int]:
+    try:
+        pool = get_pool()
+        async with pool.acquire() as conn:
+            return await conn.fetchval(
+                """
+                INSERT INTO scheduler_job_runs (job_id, instance_id, started_at, status)
+                VALUES ($1, $2, $3, 'running')
+                RETURNING id
+                """,
+                job_id,
+                INSTANCE_ID,
+                datetime.now(timezone.utc),
+            )
+    except Exception as exc:
+        # История запусков — для наглядности, задачу из-за неё не блокируем.
+        logger.warning("Не удалось записать старт задачи %s: %s", job_id, exc)
+        return None
+
+
+async def _job_run_finished(run_id: Optional[int], *, status: str, rows: Optional[int], error: Optional[str]) -> None:
+    if run_id is None:
+        return
+    try:
+        pool = get_pool()
+        async with pool.acquire() as conn:
+            await conn.execute(
+                """
+                UPDATE scheduler_job_runs
+                SET finished_at = NOW(), status = $2, rows_affected = $3, error = $4
+                WHERE id = $1
+                """,
+                run_id,
+                status,
+                rows,
+                error[:1000] if error else None,
+            )
+    except Exception as exc:
+        logger.warning("Не удалось записать завершение задачи (run %s): %s", run_id, exc)
+
+
+async def prune_job_runs() -> int:
+    """Удаляет историю запусков старше JOB_RUNS_KEEP_DAYS."""
+    pool = get_pool()
+    async with pool.acquire() as conn:
+        result = await conn.execute(
+            "DELETE FROM scheduler_job_runs WHERE started_at < NOW() - make_interval(days => $1)",
+            JOB_RUNS_KEEP_DAYS,
+        )
+    return int(result.split()[-1]) if result else 0
@@ -0,0 +1,164 @@
+"""
+Проверка, что клиенты с bot_started = true всё ещё достижимы.
+
+О блокировке бота мы узнаём, только когда отправка падает или приходит
+my_chat_member, поэтому bot_started отстаёт от реальности, и рассылки и выбор
+Wahelp считаются по неверным данным. Обход идёт по таким клиентам keyset-пачками
+по id и шлёт каждому sendChatAction — самый дешёвый запрос, который падает с
+Forbidden, если бот заблокирован (клиент на секунду видит «печатает…»).
+
+Бюджет LIVENESS_DAILY_BUDGET запросов в сутки делится на запуски раз в
+LIVENESS_TICK_MIN минут, внутри запуска темп не выше LIVENESS_RATE_PER_SEC.
+Позиция обхода хранится в liveness_sweep_state, после перезапуска обход
+продолжается с неё; дойдя до конца таблицы, начинается новый круг.
+"""
+import asyncio
+import logging
+import math
+import os
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable
+
+import asyncpg
+from aiogram.exceptions import TelegramRetryAfter
+from dotenv import load_dotenv
+
+from app.db import acquire
+from app.recipients import SEND_UNREACHABLE, classify_send_error
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+LIVENESS_DAILY_BUDGET = int(os.getenv("LIVENESS_DAILY_BUDGET", "5000") or "5000")
+LIVENESS_TICK_MIN = int(os.getenv("LIVENESS_TICK_MIN", "15") or "15")
+LIVENESS_RATE_PER_SEC = float(os.getenv("LIVENESS_RATE_PER_SEC", "2") or "2")
+LIVENESS_BATCH = int(os.getenv("LIVENESS_BATCH", "100") or "100")
+LIVENESS_SWEEP_KEY = "bot_started"
+
+ProbeFunc = Callable[[int], Awaitable[Any]]
+MarkFunc = Callable[[list[int]], Awaitable[Any]]
+
+
+async def ensure_liveness_schema(conn: asyncpg.Connection) -> None:
+    await conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS liveness_sweep_state (
+            sweep_key text PRIMARY KEY,
+            last_client_id bigint NOT NULL DEFAULT 0,
+            pass_started_at timestamptz NOT NULL DEFAULT NOW(),
+            passes integer NOT NULL DEFAULT 0,
+            checked bigint NOT NULL DEFAULT 0,
+            unreachable bigint NOT NULL DEFAULT 0,
+            updated_at timestamptz NOT NULL DEFAULT NOW()
+        );
+        """
+    )
+
+
+def tick_budget(daily_budget: int = LIVENESS_DAILY_BUDGET, tick_min: int = LIVENESS_TICK_MIN) -> int:
+    return max(1, math.ceil(daily_budget * tick_min / 1440))
+
+
+async def _load_position(conn: asyncpg.Connection) -> int:
+    return await conn.fetchval(
+        """
+        INSERT INTO liveness_sweep_state (sweep_key) VALUES ($1)
+        ON CONFLICT (sweep_key) DO UPDATE SET sweep_key = EXCLUDED.sweep_key
+        RETURNING last_client_id
+        """,
+        LIVENESS_SWEEP_KEY,
+    )
+
+
+async def _save_position(conn: asyncpg.Connection, last_id: int, checked: int, unreachable: int, wrapped: bool) -> None:
+    await conn.execute(
+        """
+        UPDATE liveness_sweep_state SET
+            last_client_id = $2,
+            checked = checked + $3,
+            unreachable = unreachable + $4,
+            passes = passes + CASE WHEN $5 THEN 1 ELSE 0 END,
+            pass_started_at = CASE WHEN $5 THEN $6 ELSE pass_started_at END,
+            updated_at = $6
+        WHERE sweep_key = $1
+        """,
+        LIVENESS_SWEEP_KEY,
+        last_id,
+        checked,
+        unreachable,
+        wrapped,
+        datetime.now(timezone.utc),
+    )
+
+
+async def _probe_all(rows: list[asyncpg.Record], probe: ProbeFunc, interval: float) -> list[int]:
+    """Проверяет чаты по очереди в заданном темпе. Возвращает недоступные chat_id."""
+    unreachable: list[int] = []
+    for row in rows:
+        chat_id = row["bot_tg_user_id"]
+        for _ in range(2):
+            try:
+                await probe(chat_id)
+            except TelegramRetryAfter as exc:
+                logger.warning("Проверка доступности: 429, пауза %s с", exc.retry_after)
+                await asyncio.sleep(exc.retry_after)
+                continue
+            except Exception as exc:
+                if classify_send_error(exc) == SEND_UNREACHABLE:
+                    unreachable.append(chat_id)
+                else:
+                    logger.info("Проверка доступности %s: %s", chat_id, exc)
+            break
+        if interval:
+            await asyncio.sleep(interval)
+    return unreachable
+
+
+async def sweep_liveness(
+    probe: ProbeFunc,
+    mark_unreachable: MarkFunc,
+    *,
+    budget: int | None = None,
+    rate_per_sec: float = LIVENESS_RATE_PER_SEC,
+    batch_size: int = LIVENESS_BATCH,
+) -> dict[str, int]:
+    """
+    Один запуск обхода: проверяет до budget клиентов, начиная с сохранённой позиции.
+    Недоступные передаются в mark_unreachable пачкой после каждой порции.
+    """
+    budget = tick_budget() if budget is None else budget
+    interval = 1.0 / rate_per_sec if rate_per_sec > 0 else 0.0
+    stats = {"checked": 0, "unreachable": 0, "passes": 0}
+    async with acquire() as conn:
+        last_id = await _load_position(conn)
+    while stats["checked"] < budget:
+        limit = min(batch_size, budget - stats["checked"])
+        async with acquire() as conn:
+            rows = await conn.fetch(
+                """
+                SELECT id, bot_tg_user_id FROM clients
+                WHERE id > $1 AND bot_started AND bot_tg_user_id IS NOT NULL
+                ORDER BY id
+                LIMIT $2
+                """,
+                last_id,
+                limit,
+            )
+        wrapped = len(rows) < limit
+        # Соединение не держим, пока ждём Telegram
+        unreachable = await _probe_all(rows, probe, interval)
+        if unreachable:
+            await mark_unreachable(unreachable)
+        last_id = 0 if wrapped else rows[-1]["id"]
+        async with acquire() as conn:
+            await _save_position(conn, last_id, len(rows), len(unreachable), wrapped)
+        stats["checked"] += len(rows)
+        stats["unreachable"] += len(unreachable)
+        if wrapped:
+            # Новый круг начнётся со следующего запуска, а не сразу
+            stats["passes"] += 1
+            logger.info("Проверка доступности: круг завершён")
+            break
+    if stats["unreachable"]:
+        logger.warning("Проверка доступности: %s из %s клиентов недоступны", stats["unreachable"], stats["checked"])
+    return stats
@@ -0,0 +1,61 @@
+"""
+Маршрутизация кнопок меню одной таблицей.
+
+Текст кнопки приводится к виду без эмодзи в начале, с одиночными пробелами и
+casefold: «📱 Поделиться номером», «поделиться  номером» и «ПОДЕЛИТЬСЯ НОМЕРОМ»
+дают один ключ. Точный текст кнопки (так его присылает клавиатура) находится
+сразу по словарю, без нормализации.
+"""
+import re
+from typing import Any, Iterable, Optional, Union
+
+from aiogram.filters import Filter
+from aiogram.types import Message
+
+_LEADING_SYMBOLS = re.compile(r"^\W+")
+
+
+def normalize_menu_text(text: str) -> str:
+    return " ".join(_LEADING_SYMBOLS.sub("", text.strip()).split()).casefold()
+
+
+class MenuTable:
+    def __init__(self, buttons: Iterable[str]) -> None:
+        self.buttons = tuple(buttons)
+        self._exact = {button: button for button in self.buttons}
+        self._normalized = {normalize_menu_text(button): button for button in self.buttons}
+        # Как и раньше в is_menu_button, кнопкой считается и текст без первого слова
+        # («бонусы», «заказ»): такие сообщения не уходят админу как вопрос.
+        self._loose = set(self._normalized) | {
+            normalize_menu_text(button.split(" ", 1)[-1]) for button in self.buttons
+        }
+
+    def lookup(self, text: Optional[str]) -> Optional[str]:
+        """Кнопка меню для текста сообщения или None."""
+        if not text:
+            return None
+        button = self._exact.get(text)
+        if button is not None:
+            return button
+        if len(text) > 64:
+            return None  # длиннее любой кнопки — это не кнопка
+        return self._normalized.get(normalize_menu_text(text))
+
+    def is_menu_text(self, text: Optional[str]) -> bool:
+        """Кнопка меню или команда."""
+        if not text:
+            return False
+        if text.strip().startswith("/") or text in self._exact:
+            return True
+        return len(text) <= 64 and normalize_menu_text(text) in self._loose
+
+
+class MenuButtonFilter(Filter):
+    """Пропускает нажатия кнопок меню и передаёт хэндлеру menu_button — исходный текст кнопки."""
+
+    def __init__(self, table: MenuTable) -> None:
+        self.table = table
+
+    async def __call__(self, message: Message) -> Union[bool, dict[str, Any]]:
+        button = self.table.lookup(message.text)
+        return {"menu_button": button} if button is not None else False
@@ -0,0 +1,11 @@
+-- Signup bonus is granted at most once per client.
+-- Backs INSERT ... ON CONFLICT DO NOTHING in _grant_signup_bonus_if_needed, so two
+-- concurrent contact shares cannot both credit ONBOARDING_BONUS.
+--
+-- If this fails on existing duplicates, find them with:
+--   SELECT client_id, COUNT(*) FROM bonus_transactions
+--   WHERE reason = 'bot_signup' GROUP BY client_id HAVING COUNT(*) > 1;
+
+CREATE UNIQUE INDEX IF NOT EXISTS bonus_transactions_bot_signup_once
+    ON bonus_transactions (client_id)
+    WHERE reason = 'bot_signup';
@@ -0,0 +1,10 @@
+-- Covering index for the client bonus history view ("Мои бонусы" → История).
+-- Keyset pages on (created_at, id) within one client are served by an index-only
+-- scan, so page N costs the same as page 1.
+--
+-- CONCURRENTLY keeps bonus_transactions writable while the index builds; the file
+-- must therefore contain this single statement (no implicit transaction block).
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS bonus_transactions_client_history
+    ON bonus_transactions (client_id, created_at DESC, id DESC)
+    INCLUDE (delta, reason, expires_at);
@@ -0,0 +1,8 @@
+-- Pre-expiry reminders scan bot_signup grants by expiry day in keyset chunks
+-- ORDER BY (expires_at, id); this partial index serves that scan directly.
+--
+-- Single statement on purpose: CONCURRENTLY cannot run inside a transaction block.
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS bonus_transactions_bot_signup_expiry
+    ON bonus_transactions (expires_at, id)
+    WHERE reason = 'bot_signup';
@@ -0,0 +1,32 @@
+-- Push order status changes to the client bot (app/order_push.py) via NOTIFY.
+-- The status is read through to_jsonb(NEW) so the trigger does not depend on the
+-- exact orders schema of the main stack; rows without a status are ignored.
+-- NOTIFY is delivered on commit only, and identical payloads within one
+-- transaction are collapsed by Postgres.
+
+CREATE OR REPLACE FUNCTION notify_order_status_change() RETURNS trigger
+LANGUAGE plpgsql AS $$
+DECLARE
+    new_status text := to_jsonb(NEW) ->> 'status';
+    old_status text := to_jsonb(OLD) ->> 'status';
+BEGIN
+    IF NEW.client_id IS NULL OR new_status IS NULL OR new_status IS NOT DISTINCT FROM old_status THEN
+        RETURN NULL;
+    END IF;
+    PERFORM pg_notify(
+        'order_status',
+        json_build_object(
+            'order_id', NEW.id,
+            'client_id', NEW.client_id,
+            'status', new_status,
+            'old_status', old_status
+        )::text
+    );
+    RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS orders_status_notify ON orders;
+CREATE TRIGGER orders_status_notify
+    AFTER UPDATE ON orders
+    FOR EACH ROW EXECUTE FUNCTION notify_order_status_change();
@@ -0,0 +1,12 @@
+-- One lead per Telegram user. Backs INSERT ... ON CONFLICT (tg_user_id) DO NOTHING
+-- in create_lead_if_missing, so the in-memory known-lead index is only a shortcut
+-- and never the source of truth. NULL tg_user_id (leads from other sources) is
+-- not constrained.
+--
+-- If this fails on existing duplicates, find them with:
+--   SELECT tg_user_id, array_agg(id ORDER BY id) FROM leads
+--   WHERE tg_user_id IS NOT NULL GROUP BY tg_user_id HAVING COUNT(*) > 1;
+-- A failed CONCURRENTLY build leaves an INVALID index: DROP INDEX CONCURRENTLY it first.
+
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS leads_tg_user_id_key
+    ON leads (tg_user_id);
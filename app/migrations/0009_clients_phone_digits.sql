@@ -0,0 +1,9 @@
+-- Normalized phone (digits only, see app/phones.py) that upsert_contact looks clients up by.
+-- Added here once instead of by the backfill: ADD COLUMN takes an ACCESS EXCLUSIVE lock
+-- on the shared clients table even when the column already exists.
+--
+-- Fill existing rows and build the unique index afterwards with:
+--   python -m app.phone_backfill
+
+ALTER TABLE IF EXISTS clients
+    ADD COLUMN IF NOT EXISTS phone_digits TEXT;
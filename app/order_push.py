@@ -0,0 +1,222 @@
+"""
+Уведомления клиентов о смене статуса заказа.
+
+Триггер orders_status_notify (миграция 0007) шлёт NOTIFY в канал order_status,
+когда админ-бот или CRM меняют статус. OrderStatusListener слушает канал на
+отдельном соединении (не из пула) и переподключается при обрыве. События
+одного клиента собираются ORDER_PUSH_COALESCE_SEC секунд и уходят одним
+сообщением: серия «принят → в работе → выполнен» даёт одно уведомление.
+
+NOTIFY приходит всем инстансам, поэтому отправляет только тот, для кого
+should_send() истинно (лидер). События, пришедшие во время обрыва соединения,
+теряются — это уведомления, а не источник истины о заказе.
+
+Чат клиента берётся из client_chat_cache. Бот сбрасывает запись, когда сам
+меняет bot_tg_user_id / bot_started (контакт, подписка, отписка, слияние).
+Правки из других процессов (админ-бот, CRM, python -m app.dedup) кэш не
+видит: они доходят через CLIENT_CHAT_CACHE_TTL_SEC.
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Callable, Optional
+
+import asyncpg
+from dotenv import load_dotenv
+
+from app.db import DB_DSN, acquire
+from app.sender import RateLimitedSender
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+ORDER_PUSH_CHANNEL = "order_status"
+ORDER_PUSH_ENABLED = (os.getenv("ORDER_PUSH_ENABLED", "1") or "1").strip().lower() not in {"0", "false", "no"}
+ORDER_PUSH_COALESCE_SEC = float(os.getenv("ORDER_PUSH_COALESCE_SEC", "3") or "3")
+ORDER_PUSH_PING_SEC = float(os.getenv("ORDER_PUSH_PING_SEC", "15") or "15")
+ORDER_PUSH_RECONNECT_MAX_SEC = float(os.getenv("ORDER_PUSH_RECONNECT_MAX_SEC", "30") or "30")
+CLIENT_CHAT_CACHE_TTL_SEC = float(os.getenv("CLIENT_CHAT_CACHE_TTL_SEC", "300") or "300")
+CLIENT_CHAT_CACHE_MAX = int(os.getenv("CLIENT_CHAT_CACHE_MAX", "50000") or "50000")
+
+# Тексты для известных статусов; остальные показываются как есть.
+ORDER_STATUS_TEXTS = {
+    "new": "принят",
+    "confirmed": "подтверждён",
+    "scheduled": "запланирован",
+    "in_progress": "в работе",
+    "done": "выполнен",
+    "completed": "выполнен",
+    "cancelled": "отменён",
+    "canceled": "отменён",
+}
+
+
+class ClientChatCache:
+    """client_id → bot_tg_user_id (или None, если бот клиенту недоступен), с TTL и LRU."""
+
+    def __init__(self, ttl: float = CLIENT_CHAT_CACHE_TTL_SEC, max_entries: int = CLIENT_CHAT_CACHE_MAX) -> None:
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._items: OrderedDict[int, tuple[float, Optional[int]]] = OrderedDict()
+
+    def invalidate(self, client_id: int) -> None:
+        """Вызывать после коммита изменения — иначе resolve успеет закэшировать старое значение."""
+        self._items.pop(client_id, None)
+
+    async def resolve(self, client_ids: list[int]) -> dict[int, Optional[int]]:
+        now = time.monotonic()
+        found: dict[int, Optional[int]] = {}
+        missing: list[int] = []
+        for client_id in client_ids:
+            item = self._items.get(client_id)
+            if item is not None and now - item[0] < self.ttl:
+                self._items.move_to_end(client_id)
+                found[client_id] = item[1]
+            else:
+                missing.append(client_id)
+        if missing:
+            async with acquire() as conn:
+                rows = await conn.fetch(
+                    """
+                    SELECT id, bot_tg_user_id FROM clients
+                    WHERE id = ANY($1::bigint[]) AND bot_started
+                    """,
+                    missing,
+                )
+            chats = {r["id"]: r["bot_tg_user_id"] for r in rows}
+            for client_id in missing:
+                found[client_id] = chats.get(client_id)
+                self._items[client_id] = (now, found[client_id])
+                self._items.move_to_end(client_id)
+            while len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+        return found
+
+
+client_chat_cache = ClientChatCache()
+
+
+def order_status_text(changes: dict[int, tuple[Optional[str], str]]) -> str:
+    lines = []
+    for order_id, (_, status) in sorted(changes.items()):
+        label = ORDER_STATUS_TEXTS.get(status.lower(), status)
+        lines.append(f"Заказ №{order_id}: <b>{label}</b>")
+    header = "📦 Обновление по вашему заказу" if len(lines) == 1 else "📦 Обновления по вашим заказам"
+    return header + "\n" + "\n".join(lines)
+
+
+class OrderStatusListener:
+    def __init__(
+        self,
+        sender: RateLimitedSender,
+        should_send: Callable[[], bool] = lambda: True,
+        cache: Optional[ClientChatCache] = None,
+        coalesce_sec: float = ORDER_PUSH_COALESCE_SEC,
+    ) -> None:
+        self.sender = sender
+        self.should_send = should_send
+        self.cache = cache or client_chat_cache
+        self.coalesce_sec = coalesce_sec
+        self._conn: Optional[asyncpg.Connection] = None
+        self._task: Optional[asyncio.Task] = None
+        # client_id → {order_id: (статус до серии, последний статус)}
+        self._pending: dict[int, dict[int, tuple[Optional[str], str]]] = {}
+        self._flushes: set[asyncio.Task] = set()
+        self.received = 0
+        self.pushed = 0
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name="order-status-listener")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self._drop_connection()
+        for task in list(self._flushes):
+            task.cancel()
+
+    async def _connect(self) -> asyncpg.Connection:
+        conn = await asyncpg.connect(
+            dsn=DB_DSN,
+            timeout=ORDER_PUSH_PING_SEC,
+            server_settings={
+                "application_name": "order-status-listener",
+                "tcp_keepalives_idle": "5",
+                "tcp_keepalives_interval": "2",
+                "tcp_keepalives_count": "3",
+            },
+        )
+        await conn.add_listener(ORDER_PUSH_CHANNEL, self._on_notify)
+        return conn
+
+    async def _drop_connection(self) -> None:
+        conn, self._conn = self._conn, None
+        if conn is not None and not conn.is_closed():
+            try:
+                await asyncio.wait_for(conn.close(), timeout=ORDER_PUSH_PING_SEC)
+            except Exception:
+                conn.terminate()
+
+    async def _run(self) -> None:
+        backoff = 1.0
+        while True:
+            try:
+                self._conn = await self._connect()
+                logger.info("Слушаем канал %s", ORDER_PUSH_CHANNEL)
+                backoff = 1.0
+                while True:
+                    # Уведомления приходят сами; пинг нужен, чтобы заметить обрыв
+                    await asyncio.sleep(ORDER_PUSH_PING_SEC)
+                    await self._conn.fetchval("SELECT 1", timeout=ORDER_PUSH_PING_SEC)
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                logger.warning("Канал %s: соединение потеряно (%s), переподключение через %.0f с", ORDER_PUSH_CHANNEL, exc, backoff)
+                await self._drop_connection()
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, ORDER_PUSH_RECONNECT_MAX_SEC)
+
+    def _on_notify(self, connection, pid, channel, payload: str) -> None:
+        try:
+            event = json.loads(payload)
+            client_id = int(event["client_id"])
+            order_id = int(event["order_id"])
+            status = str(event["status"])
+        except (ValueError, KeyError, TypeError):
+            logger.warning("Некорректное уведомление в %s: %r", channel, payload[:200])
+            return
+        self.received += 1
+        orders = self._pending.get(client_id)
+        if orders is None:
+            orders = self._pending[client_id] = {}
+            task = asyncio.create_task(self._flush_later(client_id))
+            self._flushes.add(task)
+            task.add_done_callback(self._flushes.discard)
+        first_old = orders[order_id][0] if order_id in orders else event.get("old_status")
+        orders[order_id] = (first_old, status)
+
+    async def _flush_later(self, client_id: int) -> None:
+        await asyncio.sleep(self.coalesce_sec)
+        orders = self._pending.pop(client_id, {})
+        # Статус вернулся к исходному за время серии — сообщать не о чем
+        changes = {oid: change for oid, change in orders.items() if change[0] != change[1]}
+        if not changes or not self.should_send():
+            return
+        try:
+            chat_id = (await self.cache.resolve([client_id])).get(client_id)
+        except Exception as exc:
+            logger.warning("Не удалось найти чат клиента %s для уведомления о заказе: %s", client_id, exc)
+            return
+        if chat_id is None:
+            return
+        if await self.sender.send(chat_id, order_status_text(changes)) is not None:
+            self.pushed += 1
@@ -0,0 +1,280 @@
+"""
+Заполнение clients.phone_digits для старых строк и уникальный индекс по нему.
+
+upsert_contact ищет клиента по phone_digits, а строки, записанные до появления
+колонки или другими сервисами («8 (904) ...»), его не имеют — такой клиент не
+находится и заводится дубликат. Задача идёт по clients keyset-пачками по id,
+нормализует телефоны (app.phones) и пишет phone_digits одним UPDATE ... FROM
+unnest на пачку. Затем строит уникальный индекс CONCURRENTLY — если дублей
+по номеру нет (иначе сначала нужно объединить дубли клиентов: python -m app.dedup).
+
+Колонку добавляет миграция 0009_clients_phone_digits.sql, а не эта задача:
+ALTER TABLE берёт ACCESS EXCLUSIVE на общую clients. Номер, который уже есть
+у другого клиента, не пишется (иначе уникальный индекс уронил бы всю пачку):
+такие строки остаются без phone_digits и попадают в отчёт как conflicts.
+
+    python -m app.phone_backfill [--batch 5000] [--dry-run] [--skip-index]
+
+После миграции работающие боты увидят колонку только после перезапуска
+(_CLIENTS_COLUMNS кэшируется на процесс).
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import Any, Optional
+
+import asyncpg
+from dotenv import load_dotenv
+
+from app.db import acquire, batch_connection, close_pool, init_pool
+from app.phones import normalize_phone_digits
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+PHONE_BACKFILL_BATCH = int(os.getenv("PHONE_BACKFILL_BATCH", "5000") or "5000")
+PHONE_DIGITS_INDEX = "clients_phone_digits_key"
+
+
+async def _max_client_id(conn: asyncpg.Connection) -> int:
+    return int(await conn.fetchval("SELECT COALESCE(MAX(id), 0) FROM clients") or 0)
+
+
+async def _has_phone_digits_column(conn: asyncpg.Connection) -> bool:
+    return bool(
+        await conn.fetchval(
+            """
+            SELECT EXISTS (
+                SELECT 1 FROM information_schema.columns
+                WHERE table_schema = 'public' AND table_name = 'clients' AND column_name = 'phone_digits'
+            )
+            """
+        )
+    )
+
+
+async def _write_batch(conn: asyncpg.Connection, ids: list[int], values: list[Optional[str]]) -> set[int]:
+    """
+    Пишет phone_digits пачкой, пропуская номера, уже занятые другим клиентом.
+    Возвращает id записанных строк. Если номер заняли между проверкой и записью
+    (UniqueViolation), пачка повторяется построчно, каждая строка в своём savepoint.
+    """
+    query = """
+        UPDATE clients c
+        SET phone_digits = v.digits
+        FROM unnest($1::bigint[], $2::text[]) AS v(id, digits)
+        WHERE c.id = v.id
+          AND c.phone_digits IS DISTINCT FROM v.digits
+          AND (
+              v.digits IS NULL
+              OR NOT EXISTS (SELECT 1 FROM clients o WHERE o.phone_digits = v.digits AND o.id <> c.id)
+          )
+        RETURNING c.id
+    """
+    try:
+        return {r["id"] for r in await conn.fetch(query, ids, values)}
+    except asyncpg.UniqueViolationError:
+        pass
+    written: set[int] = set()
+    async with conn.transaction():
+        for client_id, value in zip(ids, values):
+            try:
+                async with conn.transaction():
+                    written.update(r["id"] for r in await conn.fetch(query, [client_id], [value]))
+            except asyncpg.UniqueViolationError:
+                pass
+    return written
+
+
+async def backfill_phone_digits(
+    *,
+    batch_size: int = PHONE_BACKFILL_BATCH,
+    only_missing: bool = False,
+    dry_run: bool = False,
+    pause_sec: float = 0.0,
+) -> dict[str, Any]:
+    """
+    Проходит clients пачками по id и выравнивает phone_digits с нормализованным phone.
+    only_missing=True смотрит только строки без phone_digits (ночной догоняющий прогон).
+    """
+    stats: dict[str, Any] = {"scanned": 0, "updated": 0, "cleared": 0, "conflicts": 0, "batches": 0}
+    conflict_sample: list[int] = []
+    started = time.monotonic()
+    last_id = 0
+    async with acquire() as conn:
+        if not await _has_phone_digits_column(conn):
+            raise RuntimeError("clients.phone_digits is missing: apply migration 0009_clients_phone_digits.sql")
+        max_id = await _max_client_id(conn)
+    filter_sql = "AND phone IS NOT NULL AND phone_digits IS NULL" if only_missing else ""
+
+    while True:
+        async with acquire() as conn:
+            rows = await conn.fetch(
+                f"""
+                SELECT id, phone, phone_digits FROM clients
+                WHERE id > $1 {filter_sql}
+                ORDER BY id
+                LIMIT $2
+                """,
+                last_id,
+                batch_size,
+            )
+            if not rows:
+                break
+            last_id = rows[-1]["id"]
+            ids: list[int] = []
+            values: list[Optional[str]] = []
+            conflicts: list[int] = []
+            batch_digits: set[str] = set()
+            for row in rows:
+                digits = normalize_phone_digits(row["phone"]) if row["phone"] else ""
+                value = digits or None
+                if value != row["phone_digits"]:
+                    if value is not None and value in batch_digits:
+                        # Тот же номер у клиента выше в этой же пачке — он и получит phone_digits
+                        conflicts.append(row["id"])
+                        continue
+                    ids.append(row["id"])
+                    values.append(value)
+                    if value is not None:
+                        batch_digits.add(value)
+                    else:
+                        stats["cleared"] += 1
+            written = len(ids)
+            if ids and not dry_run:
+                done = await _write_batch(conn, ids, values)
+                written = len(done)
+                conflicts.extend(client_id for client_id in ids if client_id not in done)
+        stats["scanned"] += len(rows)
+        stats["updated"] += written
+        stats["conflicts"] += len(conflicts)
+        conflict_sample.extend(conflicts[: max(0, 20 - len(conflict_sample))])
+        stats["batches"] += 1
+        elapsed = max(time.monotonic() - started, 1e-6)
+        logger.info(
+            "phone_digits: id %s/%s (%.0f%%), просмотрено %s, исправлено %s, %.0f строк/с",
+            last_id,
+            max_id,
+            100.0 * min(last_id, max_id) / max_id if max_id else 100.0,
+            stats["scanned"],
+            stats["updated"],
+            stats["scanned"] / elapsed,
+        )
+        if len(rows) < batch_size:
+            break
+        if pause_sec:
+            # Даём боевым запросам пул и WAL между пачками
+            await asyncio.sleep(pause_sec)
+
+    if stats["conflicts"]:
+        stats["conflict_ids"] = conflict_sample
+        logger.warning(
+            "phone_digits: %s клиентов не получили номер — он уже у другого клиента (дубли, python -m app.dedup), "
+            "например id %s",
+            stats["conflicts"],
+            conflict_sample[:5],
+        )
+    stats["elapsed_sec"] = round(time.monotonic() - started, 3)
+    stats["rows_per_sec"] = round(stats["scanned"] / max(stats["elapsed_sec"], 1e-6), 1)
+    return stats
+
+
+async def phone_digits_duplicates(conn: asyncpg.Connection, limit: int = 10) -> tuple[int, list[asyncpg.Record]]:
+    count = await conn.fetchval(
+        """
+        SELECT COUNT(*) FROM (
+            SELECT phone_digits FROM clients
+            WHERE phone_digits IS NOT NULL
+            GROUP BY phone_digits HAVING COUNT(*) > 1
+        ) d
+        """
+    )
+    sample = await conn.fetch(
+        """
+        SELECT phone_digits, array_agg(id ORDER BY id) AS ids FROM clients
+        WHERE phone_digits IS NOT NULL
+        GROUP BY phone_digits HAVING COUNT(*) > 1
+        ORDER BY phone_digits
+        LIMIT $1
+        """,
+        limit,
+    )
+    return int(count or 0), sample
+
+
+async def ensure_phone_digits_index(conn: asyncpg.Connection) -> str:
+    """
+    Строит уникальный индекс по phone_digits без блокировки записи. Соединение —
+    из batch_connection(): вне транзакции (CONCURRENTLY) и без лимита на запрос
+    (timeout=None у соединения пула означает его DB_COMMAND_TIMEOUT_SEC). Возвращает итог.
+    """
+    valid = await conn.fetchval(
+        """
+        SELECT i.indisvalid FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE c.relname = $1
+        """,
+        PHONE_DIGITS_INDEX,
+    )
+    if valid:
+        return "exists"
+    if valid is False:
+        # Остаток упавшей сборки CONCURRENTLY: индекс есть, но невалидный
+        await conn.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {PHONE_DIGITS_INDEX}")
+    duplicates, sample = await phone_digits_duplicates(conn)
+    if duplicates:
+        logger.warning(
+            "Уникальный индекс не построен: %s номеров у нескольких клиентов, например %s",
+            duplicates,
+            [(r["phone_digits"], list(r["ids"])) for r in sample[:3]],
+        )
+        return f"skipped: {duplicates} duplicate phones"
+    started = time.monotonic()
+    await conn.execute(
+        f"CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS {PHONE_DIGITS_INDEX} ON clients (phone_digits)"
+    )
+    return f"built in {time.monotonic() - started:.1f}s"
+
+
+async def backfill_missing_phone_digits() -> int:
+    """Задача планировщика: догоняет строки, которые другие сервисы записали без phone_digits."""
+    try:
+        stats = await backfill_phone_digits(only_missing=True)
+    except RuntimeError as exc:
+        logger.warning("phone_digits: ночной прогон пропущен: %s", exc)
+        return 0
+    return stats["updated"]
+
+
+async def _main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Заполнение clients.phone_digits и уникальный индекс")
+    parser.add_argument("--batch", type=int, default=PHONE_BACKFILL_BATCH)
+    parser.add_argument("--only-missing", action="store_true", help="только строки без phone_digits")
+    parser.add_argument("--pause", type=float, default=0.0, help="пауза между пачками, с")
+    parser.add_argument("--dry-run", action="store_true")
+    parser.add_argument("--skip-index", action="store_true")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    await init_pool(min_size=1, max_size=2)
+    try:
+        stats = await backfill_phone_digits(
+            batch_size=args.batch,
+            only_missing=args.only_missing,
+            dry_run=args.dry_run,
+            pause_sec=args.pause,
+        )
+        if not args.dry_run and not args.skip_index:
+            async with batch_connection("phone-digits-index") as conn:
+                stats["index"] = await ensure_phone_digits_index(conn)
+    finally:
+        await close_pool()
+    print(json.dumps(stats, ensure_ascii=False))
+    return 0 if not str(stats.get("index", "")).startswith("skipped") else 2
+
+
+if __name__ == "__main__":
+    raise SystemExit(asyncio.run(_main()))
@@ -0,0 +1,27 @@
+"""Нормализация телефонов. Общая для бота и пакетных задач (app.phone_backfill)."""
+import re
+
+_NON_DIGITS = re.compile(r"\D")
+
+
+def _digits(raw: str) -> str:
+    # Быстрый путь: номер уже из одних ASCII-цифр (так хранится большинство строк)
+    if raw.isascii() and raw.isdigit():
+        return raw
+    return _NON_DIGITS.sub("", raw)
+
+
+def normalize_phone_digits(raw: str) -> str:
+    digits = _digits(raw or "")
+    if len(digits) == 11 and digits.startswith("8"):
+        digits = "7" + digits[1:]
+    if len(digits) == 10 and digits.startswith("9"):
+        digits = "7" + digits
+    return digits
+
+
+def normalize_phone(raw: str) -> str:
+    digits = normalize_phone_digits(raw)
+    if digits.startswith("7") and len(digits) == 11:
+        return f"+{digits}"
+    return raw.strip()
@@ -0,0 +1,146 @@
+"""
+Разбор ошибок отправки и кэш недоступных чатов.
+
+«Бот заблокирован пользователем» в aiogram 3 приходит как TelegramForbiddenError,
+«чат не найден» — как TelegramBadRequest; classify_send_error сводит всё к
+нескольким видам. Чаты, куда писать бесполезно, попадают в BlockedChats:
+отправки в них обрываются без запроса к Telegram, а отметка в clients
+(bot_started = false) пишется пачками раз в BLOCKED_FLUSH_SEC.
+
+При старте множество прогревается из БД; событие my_chat_member со статусом
+member возвращает чат обратно.
+"""
+import asyncio
+import logging
+import os
+from typing import Awaitable, Callable, Optional
+
+import asyncpg
+from aiogram.exceptions import (
+    TelegramBadRequest,
+    TelegramForbiddenError,
+    TelegramNetworkError,
+    TelegramRetryAfter,
+    TelegramServerError,
+)
+from dotenv import load_dotenv
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+BLOCKED_FLUSH_SEC = float(os.getenv("BLOCKED_FLUSH_SEC", "5") or "5")
+BLOCKED_FLUSH_BATCH = int(os.getenv("BLOCKED_FLUSH_BATCH", "500") or "500")
+
+SEND_RETRY_AFTER = "retry_after"
+SEND_UNREACHABLE = "unreachable"
+SEND_BAD_REQUEST = "bad_request"
+SEND_NETWORK = "network"
+SEND_OTHER = "other"
+
+# BadRequest, которые означают, что писать в чат больше нельзя
+UNREACHABLE_BAD_REQUEST = (
+    "chat not found",
+    "user not found",
+    "peer_id_invalid",
+    "user_is_deleted",
+    "bot_blocked_by_user",
+    "user is deactivated",
+)
+
+
+def classify_send_error(exc: BaseException) -> str:
+    if isinstance(exc, TelegramRetryAfter):
+        return SEND_RETRY_AFTER
+    if isinstance(exc, TelegramForbiddenError):
+        # blocked by the user, user is deactivated, can't initiate conversation
+        return SEND_UNREACHABLE
+    if isinstance(exc, TelegramBadRequest):
+        message = str(exc).lower()
+        if any(marker in message for marker in UNREACHABLE_BAD_REQUEST):
+            return SEND_UNREACHABLE
+        return SEND_BAD_REQUEST
+    if isinstance(exc, (TelegramNetworkError, TelegramServerError, asyncio.TimeoutError)):
+        return SEND_NETWORK
+    return SEND_OTHER
+
+
+def failed_chat_id(exc: BaseException) -> Optional[int]:
+    """Чат, в который не удалось отправить: берём из метода, а не из апдейта."""
+    chat_id = getattr(getattr(exc, "method", None), "chat_id", None)
+    return chat_id if isinstance(chat_id, int) else None
+
+
+FlushFunc = Callable[[list[int]], Awaitable[object]]
+
+
+class BlockedChats:
+    def __init__(self, flush_func: FlushFunc, flush_sec: float = BLOCKED_FLUSH_SEC) -> None:
+        self.flush_func = flush_func
+        self.flush_sec = flush_sec
+        self._ids: set[int] = set()
+        self._pending: set[int] = set()
+        self._task: Optional[asyncio.Task] = None
+        self.short_circuited = 0
+        self.flushed = 0
+
+    def __contains__(self, chat_id: int) -> bool:
+        return chat_id in self._ids
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def add(self, chat_id: int) -> bool:
+        """Отмечает чат недоступным. True — если узнали об этом только сейчас."""
+        if chat_id in self._ids:
+            return False
+        self._ids.add(chat_id)
+        self._pending.add(chat_id)
+        return True
+
+    def discard(self, chat_id: int) -> None:
+        self._ids.discard(chat_id)
+        self._pending.discard(chat_id)
+
+    async def warm(self, conn: asyncpg.Connection) -> int:
+        rows = await conn.fetch(
+            """
+            SELECT bot_tg_user_id FROM clients
+            WHERE bot_tg_user_id IS NOT NULL AND bot_started = false
+            """
+        )
+        self._ids.update(r["bot_tg_user_id"] for r in rows)
+        return len(rows)
+
+    async def flush(self) -> int:
+        total = 0
+        while self._pending:
+            batch = [self._pending.pop() for _ in range(min(BLOCKED_FLUSH_BATCH, len(self._pending)))]
+            try:
+                await self.flush_func(batch)
+            except Exception as exc:
+                logger.warning("Не удалось отметить %s недоступных чатов: %s", len(batch), exc)
+                # Вернём в очередь, если за это время чат не вернулся
+                self._pending.update(chat_id for chat_id in batch if chat_id in self._ids)
+                break
+            total += len(batch)
+        self.flushed += total
+        return total
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop(), name="blocked-chats-flush")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    async def _loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_sec)
+            await self.flush()
@@ -0,0 +1,148 @@
+import asyncio
+import gzip
+import hashlib
+import hmac
+import json
+import logging
+import os
+import time
+from pathlib import Path
+from typing import Any, Callable, Optional
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, Update
+from dotenv import load_dotenv
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+UPDATE_RECORD_PATH = (os.getenv("UPDATE_RECORD_PATH") or "").strip()
+# Секрет для HMAC псевдонимов. Без него запись не включается: с известной солью
+# телефоны и ID из записи восстанавливаются перебором.
+UPDATE_RECORD_SALT = (os.getenv("UPDATE_RECORD_SALT") or "").strip().encode()
+UPDATE_RECORD_FLUSH_SEC = float(os.getenv("UPDATE_RECORD_FLUSH_SEC", "1") or "1")
+
+# Служебные поля, которые попадают в запись как есть. Всё, чего здесь нет
+# (в том числе новые поля Bot API), псевдонимизируется.
+_PASS_FIELDS = frozenset({
+    "update_id", "message_id", "message_thread_id", "media_group_id", "date", "edit_date",
+    "type", "status", "is_bot", "is_premium", "is_forum", "is_topic_message", "language_code",
+    "offset", "length", "data", "chat_instance", "game_short_name",
+    "width", "height", "duration", "file_size", "mime_type",
+})
+# Геопозиция не нужна replay и не маскируется хэшем, поэтому выбрасывается целиком.
+_DROP_FIELDS = frozenset({"location", "venue"})
+
+
+def _digest(value: str) -> bytes:
+    return hmac.new(UPDATE_RECORD_SALT, value.encode("utf-8"), hashlib.sha256).digest()
+
+
+def pseudonymize_id(value: int) -> int:
+    """Стабильный псевдоним для Telegram ID: порядок апдейтов одного клиента сохраняется."""
+    sign = -1 if value < 0 else 1
+    return sign * (1_000_000_000 + int.from_bytes(_digest(str(value))[:5], "big") % 1_000_000_000_000)
+
+
+def pseudonymize_phone(value: str) -> str:
+    """Фейковый, но валидный по формату номер: нормализация телефона в replay работает как в бою."""
+    digits = int.from_bytes(_digest(value)[:6], "big") % 1_000_000_000
+    return f"+79{digits:09d}"
+
+
+def pseudonymize_text(value: str) -> str:
+    token = _digest(value).hex()
+    return (token * (len(value) // len(token) + 1))[: len(value)]
+
+
+class UpdateScrubber:
+    """Убирает персональные данные из апдейта, сохраняя форму и размер полей."""
+
+    def __init__(self, keep_text: Callable[[str], bool]) -> None:
+        self.keep_text = keep_text
+
+    def scrub(self, node: Any, key: str = "") -> Any:
+        if isinstance(node, dict):
+            return {k: self.scrub(v, k) for k, v in node.items() if k not in _DROP_FIELDS}
+        if isinstance(node, list):
+            return [self.scrub(item, key) for item in node]
+        return self._scrub_value(key, node)
+
+    def _scrub_value(self, key: str, value: Any) -> Any:
+        if value is None or isinstance(value, bool) or key in _PASS_FIELDS:
+            return value
+        if key in {"text", "caption"} and isinstance(value, str):
+            # Команды и кнопки меню нужны replay как есть, остальной текст — нет.
+            return value if self.keep_text(value) else pseudonymize_text(value)
+        if key == "phone_number" and isinstance(value, str):
+            return pseudonymize_phone(value)
+        if isinstance(value, int):
+            return pseudonymize_id(value)
+        if isinstance(value, str):
+            # Имена, username, vcard, адреса и любые незнакомые строки.
+            return pseudonymize_text(value)
+        return None
+
+
+class UpdateRecorder(BaseMiddleware):
+    """
+    Пишет входящие апдейты (с вычищенными персональными данными) в gzip JSONL.
+    Каждая строка: {"run": время старта процесса (unix), "t": секунды от старта,
+    "update": {...}}. После перезапуска бот дописывает тот же файл, поэтому
+    read_recording упорядочивает строки по run + t.
+    Запись идёт в фоне пачками, обработку апдейта она не задерживает.
+    """
+
+    def __init__(self, path: Path, keep_text: Callable[[str], bool]) -> None:
+        if not UPDATE_RECORD_SALT:
+            raise RuntimeError("UPDATE_RECORD_SALT is not set: refusing to record updates")
+        self.path = path
+        self.scrubber = UpdateScrubber(keep_text)
+        self._run = round(time.time(), 3)
+        self._started = time.monotonic()
+        self._buffer: list[str] = []
+        self._task: Optional[asyncio.Task] = None
+
+    async def __call__(self, handler, event: TelegramObject, data: dict):
+        if isinstance(event, Update):
+            try:
+                raw = event.model_dump(mode="json", by_alias=True, exclude_none=True, exclude_unset=True)
+                record = {"run": self._run, "t": round(time.monotonic() - self._started, 4), "update": self.scrubber.scrub(raw)}
+                self._buffer.append(json.dumps(record, ensure_ascii=False, separators=(",", ":")))
+                if self._task is None:
+                    self._task = asyncio.create_task(self._flush_loop(), name="update-recorder")
+            except Exception as exc:
+                logger.warning("Не удалось записать апдейт: %s", exc)
+        return await handler(event, data)
+
+    def _write(self, lines: list[str]) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # Каждая пачка — отдельный gzip-member; gzip.open читает такой файл целиком.
+        with gzip.open(self.path, "at", encoding="utf-8") as fh:
+            fh.write("".join(line + "\n" for line in lines))
+
+    async def flush(self) -> None:
+        batch, self._buffer = self._buffer, []
+        if batch:
+            await asyncio.to_thread(self._write, batch)
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(UPDATE_RECORD_FLUSH_SEC)
+            try:
+                await self.flush()
+            except Exception as exc:
+                logger.warning("Не удалось сохранить запись апдейтов: %s", exc)
+
+
+def read_recording(path: Path) -> list[dict[str, Any]]:
+    """Записи в порядке поступления; "t" пересчитан от первого апдейта всего файла."""
+    with gzip.open(path, "rt", encoding="utf-8") as fh:
+        records = [json.loads(line) for line in fh if line.strip()]
+    for record in records:
+        record["t"] = record.get("run", 0.0) + record["t"]
+    records.sort(key=lambda record: record["t"])
+    base = records[0]["t"] if records else 0.0
+    for record in records:
+        record["t"] = round(record["t"] - base, 4)
+    return records
@@ -0,0 +1,101 @@
+"""
+Исходящие сообщения с ограничением скорости.
+
+Telegram пропускает ~30 сообщений в секунду на бота и ~1 в секунду в один чат;
+при превышении отвечает 429 (TelegramRetryAfter). RateLimitedSender раздаёт
+слоты по общему темпу и по чату, ограничивает число одновременных запросов и
+при 429 притормаживает всю отправку на retry_after.
+"""
+import asyncio
+import logging
+import os
+from typing import Any, Awaitable, Callable, Optional
+
+from aiogram.exceptions import TelegramRetryAfter
+from dotenv import load_dotenv
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+OUTBOUND_RATE_PER_SEC = float(os.getenv("OUTBOUND_RATE_PER_SEC", "25") or "25")
+OUTBOUND_PER_CHAT_INTERVAL_SEC = float(os.getenv("OUTBOUND_PER_CHAT_INTERVAL_SEC", "1") or "1")
+OUTBOUND_CONCURRENCY = int(os.getenv("OUTBOUND_CONCURRENCY", "10") or "10")
+OUTBOUND_MAX_RETRIES = int(os.getenv("OUTBOUND_MAX_RETRIES", "3") or "3")
+
+SendFunc = Callable[..., Awaitable[Any]]
+
+
+class RateLimitedSender:
+    """
+    send() ждёт свой слот и вызывает send_func. send_func должна пропускать
+    TelegramRetryAfter наружу — остальные ошибки она обрабатывает сама.
+    """
+
+    def __init__(
+        self,
+        send_func: SendFunc,
+        rate_per_sec: float = OUTBOUND_RATE_PER_SEC,
+        per_chat_interval: float = OUTBOUND_PER_CHAT_INTERVAL_SEC,
+        concurrency: int = OUTBOUND_CONCURRENCY,
+    ) -> None:
+        self.send_func = send_func
+        self.interval = 1.0 / rate_per_sec if rate_per_sec > 0 else 0.0
+        self.per_chat_interval = per_chat_interval
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._next_at = 0.0
+        self._chat_next_at: dict[int, float] = {}
+        self._paused_until = 0.0
+        self.pending = 0  # сколько отправок ждут слота или выполняются
+        self.sent = 0
+        self.retried = 0
+
+    def _reserve(self, chat_id: int) -> float:
+        """Бронирует момент отправки; вызывается без await, поэтому без гонок."""
+        now = asyncio.get_running_loop().time()
+        slot = max(now, self._next_at, self._paused_until, self._chat_next_at.get(chat_id, 0.0))
+        self._next_at = slot + self.interval
+        self._chat_next_at[chat_id] = slot + self.per_chat_interval
+        if len(self._chat_next_at) > 10_000:
+            # Старые брони чатов больше ничего не ограничивают
+            self._chat_next_at = {k: v for k, v in self._chat_next_at.items() if v > now}
+        return slot - now
+
+    async def send(
+        self,
+        chat_id: int,
+        text: str,
+        *,
+        via: Optional[SendFunc] = None,
+        raise_exhausted: bool = False,
+        **kwargs: Any,
+    ) -> Optional[Any]:
+        """
+        via — другая функция отправки с тем же общим темпом (например, без разбора ошибок).
+        raise_exhausted=True пропускает последний 429 наружу вместо None — чтобы вызывающий
+        мог повторить позже.
+        """
+        send_func = via or self.send_func
+        self.pending += 1
+        try:
+            for attempt in range(OUTBOUND_MAX_RETRIES + 1):
+                delay = self._reserve(chat_id)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                async with self._semaphore:
+                    try:
+                        result = await send_func(chat_id, text, **kwargs)
+                    except TelegramRetryAfter as exc:
+                        if attempt == OUTBOUND_MAX_RETRIES:
+                            logger.warning("Отправка в %s не удалась после %s ретраев (429)", chat_id, attempt)
+                            if raise_exhausted:
+                                raise
+                            return None
+                        self.retried += 1
+                        loop_time = asyncio.get_running_loop().time()
+                        self._paused_until = max(self._paused_until, loop_time + exc.retry_after)
+                        continue
+                self.sent += 1
+                return result
+            return None
+        finally:
+            self.pending -= 1
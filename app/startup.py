@@ -0,0 +1,63 @@
+"""
+Порядок запуска бота: независимые шаги идут параллельно, второстепенные —
+после начала polling.
+
+Startup замеряет каждый шаг и пишет в лог разбивку по фазам: сколько заняли
+пул, схема, обращения к Telegram и т.д. Отложенные шаги (defer) запускаются
+из dp.startup — то есть когда бот уже принимает апдейты; их ошибки только
+логируются.
+"""
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable
+
+logger = logging.getLogger(__name__)
+
+
+class Startup:
+    def __init__(self) -> None:
+        self.started = time.perf_counter()
+        self.timings: dict[str, float] = {}
+        self._deferred: list[tuple[str, Callable[[], Awaitable[Any]]]] = []
+        self._tasks: set[asyncio.Task] = set()
+
+    async def step(self, name: str, awaitable: Awaitable[Any]) -> Any:
+        started = time.perf_counter()
+        try:
+            return await awaitable
+        finally:
+            self.timings[name] = time.perf_counter() - started
+
+    async def parallel(self, **steps: Awaitable[Any]) -> dict[str, Any]:
+        """Выполняет шаги одновременно; ошибка любого из них прерывает запуск."""
+        results = await asyncio.gather(*(self.step(name, aw) for name, aw in steps.items()))
+        return dict(zip(steps, results))
+
+    def defer(self, name: str, factory: Callable[[], Awaitable[Any]]) -> None:
+        self._deferred.append((name, factory))
+
+    async def _run_deferred(self, name: str, factory: Callable[[], Awaitable[Any]]) -> None:
+        try:
+            await self.step(name, factory())
+        except Exception as exc:
+            logger.warning("Отложенный шаг запуска %s не выполнен: %s", name, exc)
+
+    async def launch_deferred(self, **_: Any) -> None:
+        """Обработчик dp.startup: отчёт о запуске и старт отложенных шагов."""
+        self.report("готов к polling")
+        deferred = [asyncio.create_task(self._run_deferred(name, factory)) for name, factory in self._deferred]
+        if not deferred:
+            return
+        done = asyncio.create_task(self._report_when_done(deferred))
+        self._tasks.add(done)
+        done.add_done_callback(self._tasks.discard)
+
+    async def _report_when_done(self, tasks: list[asyncio.Task]) -> None:
+        await asyncio.gather(*tasks)
+        self.report("отложенные шаги завершены")
+
+    def report(self, label: str) -> None:
+        total = time.perf_counter() - self.started
+        phases = ", ".join(f"{name} {sec * 1000:.0f}мс" for name, sec in self.timings.items())
+        logger.info("Запуск: %s за %.2f с (%s)", label, total, phases)
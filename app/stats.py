@@ -0,0 +1,233 @@
+"""
+Счётчики для админской команды /stats.
+
+Вместо COUNT(*) по общим clients и bonus_transactions бот сам ведёт дневные
+счётчики: bump_stats() вызывается в той же транзакции, что и изменение, и
+прибавляет дельты к строкам bot_daily_stats (день по МСК, метрика).
+Число активных подписчиков — не дневная сумма, а текущее значение: оно хранится
+в bot_stats_totals и меняется теми же дельтами.
+
+Чтобы одновременные транзакции не ждали друг друга на одной горячей строке,
+счётчик разбит на STATS_SHARDS строк: соединение пишет в свою (по pid
+backend-процесса), а чтение их складывает.
+
+/stats читает не больше STATS_WINDOW_DAYS × STATS_SHARDS строк на метрику по
+первичному ключу — время ответа не зависит от размера таблиц. История до запуска счётчиков
+восстанавливается один раз из bonus_transactions и leads (seed_stats_history),
+а число подписчиков периодически сверяется с clients (resync_active_subscribers).
+"""
+import logging
+import os
+from datetime import date, datetime
+from typing import Any, Optional
+
+import asyncpg
+from dotenv import load_dotenv
+
+from app.bonus_ledger import MOSCOW_TZ
+from app.db import batch_connection
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+STATS_WINDOW_DAYS = int(os.getenv("STATS_WINDOW_DAYS", "30") or "30")
+STATS_SHARDS = max(1, int(os.getenv("STATS_SHARDS", "8") or "8"))
+
+# Дневные метрики в порядке вывода
+STAT_LABELS = {
+    "signups": "Подписки (бонус за номер)",
+    "new_clients": "Новые клиенты",
+    "bonus_granted": "Начислено бонусов",
+    "bonus_burned": "Сгорело бонусов",
+    "subscribed": "Подписались на бота",
+    "unsubscribed": "Отписались от бота",
+    "leads": "Новые лиды",
+    "cleaned_clients": "Удалено при очистке",
+}
+ACTIVE_SUBSCRIBERS = "active_subscribers"
+_SEEDED = "history_seeded"
+
+
+async def ensure_stats_schema(conn: asyncpg.Connection) -> None:
+    await conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS bot_daily_stats (
+            day date NOT NULL,
+            metric text NOT NULL,
+            shard smallint NOT NULL DEFAULT 0,
+            value bigint NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, metric, shard)
+        );
+        CREATE TABLE IF NOT EXISTS bot_stats_totals (
+            metric text NOT NULL,
+            shard smallint NOT NULL DEFAULT 0,
+            value bigint NOT NULL DEFAULT 0,
+            updated_at timestamptz NOT NULL DEFAULT NOW(),
+            PRIMARY KEY (metric, shard)
+        );
+        """
+    )
+
+
+def stats_day(now: Optional[datetime] = None) -> date:
+    return (now or datetime.now(MOSCOW_TZ)).astimezone(MOSCOW_TZ).date()
+
+
+async def bump_stats(conn: asyncpg.Connection, *, active: int = 0, **deltas: int) -> None:
+    """
+    Прибавляет дельты к счётчикам сегодняшнего дня, active — к числу активных
+    подписчиков. Вызывать внутри транзакции изменения; нулевые дельты не пишутся.
+    """
+    metrics = [metric for metric, delta in deltas.items() if delta]
+    if not metrics and not active:
+        return
+    shard = conn.get_server_pid() % STATS_SHARDS
+    if metrics:
+        await conn.execute(
+            """
+            INSERT INTO bot_daily_stats (day, metric, shard, value)
+            SELECT $1, metric, $4, delta FROM unnest($2::text[], $3::bigint[]) AS v(metric, delta)
+            ON CONFLICT (day, metric, shard) DO UPDATE SET value = bot_daily_stats.value + EXCLUDED.value
+            """,
+            stats_day(),
+            metrics,
+            [deltas[metric] for metric in metrics],
+            shard,
+        )
+    if active:
+        await conn.execute(
+            """
+            INSERT INTO bot_stats_totals (metric, shard, value) VALUES ($1, $2, $3)
+            ON CONFLICT (metric, shard) DO UPDATE
+            SET value = bot_stats_totals.value + EXCLUDED.value, updated_at = NOW()
+            """,
+            ACTIVE_SUBSCRIBERS,
+            shard,
+            active,
+        )
+
+
+async def read_stats(conn: asyncpg.Connection, *, today: Optional[date] = None) -> dict[str, Any]:
+    """Сегодня, вчера, 7 и STATS_WINDOW_DAYS дней по каждой метрике и число подписчиков."""
+    today = today or stats_day()
+    rows = await conn.fetch(
+        """
+        SELECT metric,
+               SUM(value) FILTER (WHERE day = $1)::bigint AS today,
+               SUM(value) FILTER (WHERE day = $1 - 1)::bigint AS yesterday,
+               SUM(value) FILTER (WHERE day > $1 - 7)::bigint AS week,
+               SUM(value)::bigint AS total
+        FROM bot_daily_stats
+        WHERE day > $1 - $2::int AND day <= $1
+        GROUP BY metric
+        """,
+        today,
+        STATS_WINDOW_DAYS,
+    )
+    active = await conn.fetchval(
+        "SELECT SUM(value)::bigint FROM bot_stats_totals WHERE metric = $1",
+        ACTIVE_SUBSCRIBERS,
+    )
+    return {
+        "day": today,
+        "metrics": {
+            r["metric"]: (r["today"] or 0, r["yesterday"] or 0, r["week"] or 0, r["total"] or 0) for r in rows
+        },
+        ACTIVE_SUBSCRIBERS: active,
+    }
+
+
+def format_stats(stats: dict[str, Any]) -> str:
+    metrics = stats["metrics"]
+    lines = [
+        f"📊 Статистика бота на {stats['day']:%d.%m.%Y}",
+        f"сегодня / вчера / 7 дн. / {STATS_WINDOW_DAYS} дн.",
+        "",
+    ]
+    for metric, label in STAT_LABELS.items():
+        today, yesterday, week, total = metrics.get(metric, (0, 0, 0, 0))
+        lines.append(f"{label}: {today} / {yesterday} / {week} / {total}")
+    active = stats[ACTIVE_SUBSCRIBERS]
+    lines.append("")
+    lines.append(f"Активных подписчиков: {active if active is not None else 'ещё не посчитано'}")
+    return "\n".join(lines)
+
+
+async def seed_stats_history(conn: asyncpg.Connection) -> bool:
+    """
+    Один раз заполняет прошлые дни из общих таблиц: подписки и начисления — по
+    bonus_transactions (bot_signup), сгорания — по bonus_expired, лиды — по leads.
+    Сегодняшний день не трогает: его уже считают живые счётчики. Клиенты,
+    удалённые очисткой, из истории пропадают вместе со своими транзакциями.
+    """
+    async with conn.transaction():
+        seeded = await conn.fetchval(
+            """
+            INSERT INTO bot_stats_totals (metric, value) VALUES ($1, 1)
+            ON CONFLICT (metric, shard) DO NOTHING
+            RETURNING value
+            """,
+            _SEEDED,
+        )
+        if seeded is None:
+            return False
+        today = stats_day()
+        await conn.execute(
+            """
+            INSERT INTO bot_daily_stats (day, metric, value)
+            SELECT day, metric, value FROM (
+                SELECT (created_at AT TIME ZONE 'Europe/Moscow')::date AS day,
+                       unnest(ARRAY['signups', 'bonus_granted']) AS metric,
+                       unnest(ARRAY[COUNT(*), SUM(delta)]) AS value
+                FROM bonus_transactions WHERE reason = 'bot_signup'
+                GROUP BY 1
+                UNION ALL
+                SELECT (created_at AT TIME ZONE 'Europe/Moscow')::date, 'bonus_burned', -SUM(delta)
+                FROM bonus_transactions WHERE reason = 'bonus_expired'
+                GROUP BY 1
+                UNION ALL
+                SELECT (created_at AT TIME ZONE 'Europe/Moscow')::date, 'leads', COUNT(*)
+                FROM leads WHERE source = 'telegram_bot'
+                GROUP BY 1
+            ) history
+            WHERE day < $1 AND value <> 0
+            ON CONFLICT (day, metric, shard) DO UPDATE SET value = EXCLUDED.value
+            """,
+            today,
+        )
+    logger.info("Статистика: история до %s восстановлена", today)
+    return True
+
+
+async def resync_active_subscribers(conn: asyncpg.Connection) -> int:
+    """Пересчитывает число активных подписчиков по clients (дельты могут разойтись с правками извне)."""
+    async with conn.transaction():
+        # Блокируем все строки счётчика, чтобы параллельные дельты не потерялись между COUNT и записью
+        await conn.execute(
+            """
+            INSERT INTO bot_stats_totals (metric, shard, value)
+            SELECT $1, shard, 0 FROM generate_series(0, $2 - 1) AS shard
+            ON CONFLICT (metric, shard) DO NOTHING
+            """,
+            ACTIVE_SUBSCRIBERS,
+            STATS_SHARDS,
+        )
+        await conn.execute("SELECT 1 FROM bot_stats_totals WHERE metric = $1 FOR UPDATE", ACTIVE_SUBSCRIBERS)
+        active = await conn.fetchval("SELECT COUNT(*) FROM clients WHERE bot_started AND bot_tg_user_id IS NOT NULL")
+        await conn.execute(
+            """
+            UPDATE bot_stats_totals SET value = CASE WHEN shard = 0 THEN $2 ELSE 0 END, updated_at = NOW()
+            WHERE metric = $1
+            """,
+            ACTIVE_SUBSCRIBERS,
+            active,
+        )
+    return active
+
+
+async def backfill_stats() -> int:
+    """Задача планировщика: история (один раз) и сверка числа подписчиков."""
+    # Пересчёт истории и COUNT(*) по clients дольше лимита запросов пула
+    async with batch_connection("stats-backfill") as conn:
+        await seed_stats_history(conn)
+        return await resync_active_subscribers(conn)
@@ -0,0 +1,151 @@
+"""
+Готовые клавиатуры и статические ответы.
+
+Клавиатуры строятся один раз (модели aiogram неизменяемые) и переиспользуются;
+их JSON тоже считается один раз — TemplateSession подставляет его в запрос
+вместо model_dump на каждую отправку.
+
+Тексты «Режим работы» и «Прайс» и ссылку на прайс можно поменять без
+перезапуска: они читаются из JSON-файла BOT_TEXTS_PATH, файл перечитывается,
+когда меняется его mtime (проверка не чаще BOT_TEXTS_CHECK_SEC). Пример:
+
+    {"schedule_text": "🕐 <b>Режим работы:</b>\\n...", "price_url": "https://raketaclean.ru/price"}
+
+Ключи, которых нет в файле, берутся из DEFAULT_TEXTS.
+"""
+import json
+import logging
+import os
+import time
+from pathlib import Path
+from typing import Any, Optional
+
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.methods import TelegramMethod
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, TelegramObject
+from aiohttp import FormData
+from dotenv import load_dotenv
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+BOT_TEXTS_PATH = (os.getenv("BOT_TEXTS_PATH") or "bot_texts.json").strip()
+BOT_TEXTS_CHECK_SEC = float(os.getenv("BOT_TEXTS_CHECK_SEC", "5") or "5")
+
+DEFAULT_TEXTS = {
+    "price_text": "💰 <b>Прайс на услуги</b>\n\nПосмотрите актуальные цены на нашем сайте:",
+    "price_button": "📄 Открыть прайс",
+    "price_url": "https://raketaclean.ru/price",
+    "schedule_text": (
+        "🕐 <b>Режим работы:</b>\n"
+        "Ежедневно с 9:00 до 19:00\n\n"
+        "<b>Для связи:</b>\n"
+        "Телефон: +79040437523\n"
+        "Telegram: @raketaclean\n"
+        "Сайт: raketaclean.ru\n"
+        "Эл.почта: raketa@raketaclean.ru\n"
+        "Адрес: Нижний Новгород, ул. Артельная 37 (офис)\n\n"
+        "<b>Услуги:</b> Химчистка мебели и ковролина, клининг, стирка ковров, клининг для бизнеса"
+    ),
+}
+
+# id(модели) → (модель, JSON). Модель держим, чтобы id не переиспользовался другим объектом.
+_SERIALIZED: dict[int, tuple[TelegramObject, str]] = {}
+
+
+def _without_none(value: Any) -> Any:
+    # Так же, как BaseSession.prepare_value: None-поля в запрос не попадают
+    if isinstance(value, dict):
+        return {k: _without_none(v) for k, v in value.items() if v is not None}
+    if isinstance(value, list):
+        return [_without_none(v) for v in value if v is not None]
+    return value
+
+
+def frozen(markup: TelegramObject) -> TelegramObject:
+    """Регистрирует готовую клавиатуру: её JSON считается один раз."""
+    _SERIALIZED[id(markup)] = (markup, json.dumps(_without_none(markup.model_dump(warnings=False))))
+    return markup
+
+
+def forget(markup: Optional[TelegramObject]) -> None:
+    """Убирает клавиатуру из кэша (например, заменённую при перечитывании текстов)."""
+    if markup is not None:
+        entry = _SERIALIZED.get(id(markup))
+        if entry is not None and entry[0] is markup:
+            del _SERIALIZED[id(markup)]
+
+
+def serialized(markup: Any) -> Optional[str]:
+    entry = _SERIALIZED.get(id(markup)) if markup is not None else None
+    if entry is not None and entry[0] is markup:
+        return entry[1]
+    return None
+
+
+class TemplateSession(AiohttpSession):
+    """Сессия, которая берёт JSON готовых клавиатур из кэша вместо model_dump."""
+
+    def build_form_data(self, bot: Bot, method: TelegramMethod[Any]) -> FormData:
+        cached = serialized(getattr(method, "reply_markup", None))
+        if cached is None:
+            return super().build_form_data(bot, method)
+        form = super().build_form_data(bot, method.model_copy(update={"reply_markup": None}))
+        form.add_field("reply_markup", cached)
+        return form
+
+
+class BotTexts:
+    """Тексты из BOT_TEXTS_PATH с перечитыванием по mtime."""
+
+    def __init__(self, path: str = BOT_TEXTS_PATH) -> None:
+        self.path = Path(path)
+        self._texts = dict(DEFAULT_TEXTS)
+        self._mtime: Optional[float] = None
+        self._checked_at = 0.0
+        self._price_keyboard: Optional[InlineKeyboardMarkup] = None
+        self._reload()
+
+    def _reload(self) -> None:
+        try:
+            mtime = self.path.stat().st_mtime
+        except FileNotFoundError:
+            mtime = None
+        if mtime == self._mtime and self._price_keyboard is not None:
+            return
+        texts = dict(DEFAULT_TEXTS)
+        if mtime is not None:
+            try:
+                loaded = json.loads(self.path.read_text(encoding="utf-8"))
+                texts.update({k: str(v) for k, v in loaded.items() if k in DEFAULT_TEXTS})
+            except (OSError, ValueError) as exc:
+                # Битый файл не ломает ответы: оставляем прошлые тексты до следующей правки файла
+                logger.warning("Не удалось прочитать %s: %s", self.path, exc)
+                self._mtime = mtime
+                return
+            logger.info("Тексты бота загружены из %s", self.path)
+        self._texts = texts
+        self._mtime = mtime
+        # Старая клавиатура ещё может уйти в начатой отправке — без кэша она просто сериализуется заново
+        forget(self._price_keyboard)
+        self._price_keyboard = frozen(
+            InlineKeyboardMarkup(
+                inline_keyboard=[[InlineKeyboardButton(text=texts["price_button"], url=texts["price_url"])]]
+            )
+        )
+
+    def _maybe_reload(self) -> None:
+        now = time.monotonic()
+        if now - self._checked_at >= BOT_TEXTS_CHECK_SEC:
+            self._checked_at = now
+            self._reload()
+
+    def get(self, key: str) -> str:
+        self._maybe_reload()
+        return self._texts[key]
+
+    @property
+    def price_keyboard(self) -> InlineKeyboardMarkup:
+        self._maybe_reload()
+        return self._price_keyboard
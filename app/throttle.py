@@ -0,0 +1,230 @@
+"""
+Ограничение частоты сообщений от одного пользователя и сброс нагрузки.
+
+Каждое сообщение клиента — это запросы в БД, а вопрос или медиа ещё и рассылка
+всем админам. ThrottleMiddleware (outer middleware на message) считает
+сообщения пользователя в скользящем окне отдельно для медиа, свободного текста
+и кнопок меню. Сверх бюджета сообщение до хэндлеров не доходит: первый раз в
+окне пользователь получает предупреждение, дальше — тишина.
+
+LoadShedder включает режим перегрузки, когда сглаженное ожидание соединения из
+пула (pool_stats.wait_ewma_sec, затухает без новых acquire с полураспадом
+POOL_WAIT_EWMA_HALF_LIFE_SEC) или очередь исходящих (outbound.pending)
+превышают порог. В этом режиме бюджеты текста и медиа урезаются в
+LOAD_SHED_FACTOR раз, а фоновые задачи, обёрнутые в deferrable(), ждут спада.
+
+Бюджеты задаются как «сообщений/секунд», например THROTTLE_MEDIA=20/60.
+"""
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Optional
+
+from aiogram import BaseMiddleware
+from aiogram.types import Message, TelegramObject
+from dotenv import load_dotenv
+
+from app.db import PoolStats
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+
+def parse_budget(value: str, default: str) -> tuple[int, float]:
+    raw = (value or default).strip()
+    try:
+        limit, window = raw.split("/", 1)
+        return int(limit), float(window)
+    except ValueError:
+        logger.warning("Некорректный бюджет %r, используется %s", raw, default)
+        limit, window = default.split("/", 1)
+        return int(limit), float(window)
+
+
+THROTTLE_BUDGETS = {
+    "media": parse_budget(os.getenv("THROTTLE_MEDIA", ""), "20/60"),
+    "text": parse_budget(os.getenv("THROTTLE_TEXT", ""), "8/60"),
+    "menu": parse_budget(os.getenv("THROTTLE_MENU", ""), "30/60"),
+}
+THROTTLE_MAX_USERS = int(os.getenv("THROTTLE_MAX_USERS", "50000") or "50000")
+THROTTLE_WARNING_TEXT = "⏳ Слишком много сообщений подряд. Подождите немного и попробуйте снова."
+
+LOAD_SHED_POOL_WAIT_SEC = float(os.getenv("LOAD_SHED_POOL_WAIT_SEC", "0.5") or "0.5")
+LOAD_SHED_OUTBOUND_PENDING = int(os.getenv("LOAD_SHED_OUTBOUND_PENDING", "500") or "500")
+LOAD_SHED_FACTOR = float(os.getenv("LOAD_SHED_FACTOR", "0.5") or "0.5")
+LOAD_SHED_HOLD_SEC = float(os.getenv("LOAD_SHED_HOLD_SEC", "30") or "30")
+LOAD_SHED_MAX_DEFER_SEC = float(os.getenv("LOAD_SHED_MAX_DEFER_SEC", "1800") or "1800")
+
+# Виды сообщений, которые режим перегрузки урезает; кнопки меню не трогаем.
+SHEDDABLE_KINDS = {"media", "text"}
+
+
+class LoadShedder:
+    """
+    Режим перегрузки по давлению на пул и очереди исходящих. Включившись,
+    держится LOAD_SHED_HOLD_SEC после последнего превышения, чтобы не мигать.
+    """
+
+    def __init__(
+        self,
+        pool_stats: PoolStats,
+        outbound_pending: Callable[[], int],
+        pool_wait_sec: float = LOAD_SHED_POOL_WAIT_SEC,
+        outbound_limit: int = LOAD_SHED_OUTBOUND_PENDING,
+        hold_sec: float = LOAD_SHED_HOLD_SEC,
+    ) -> None:
+        self.pool_stats = pool_stats
+        self.outbound_pending = outbound_pending
+        self.pool_wait_sec = pool_wait_sec
+        self.outbound_limit = outbound_limit
+        self.hold_sec = hold_sec
+        self._until = 0.0
+        self._was_active = False
+        self.activations = 0
+
+    @property
+    def active(self) -> bool:
+        now = time.monotonic()
+        wait = self.pool_stats.wait_ewma_sec
+        pending = self.outbound_pending()
+        if wait > self.pool_wait_sec or pending > self.outbound_limit:
+            self._until = now + self.hold_sec
+        active = now < self._until
+        if active != self._was_active:
+            self._was_active = active
+            if active:
+                self.activations += 1
+                logger.warning("Режим перегрузки включён: ожидание пула %.3f с, очередь исходящих %s", wait, pending)
+            else:
+                logger.warning("Режим перегрузки выключен")
+        return active
+
+    async def wait_calm(self, max_wait: float = LOAD_SHED_MAX_DEFER_SEC, poll_sec: float = 5.0) -> float:
+        """Ждёт выхода из режима перегрузки, но не дольше max_wait. Возвращает время ожидания."""
+        started = time.monotonic()
+        while self.active and time.monotonic() - started < max_wait:
+            await asyncio.sleep(poll_sec)
+        return time.monotonic() - started
+
+
+def deferrable(
+    shedder: LoadShedder,
+    func: Callable[[], Awaitable[Any]],
+    max_wait: float = LOAD_SHED_MAX_DEFER_SEC,
+) -> Callable[[], Awaitable[Any]]:
+    """Оборачивает фоновую задачу: при перегрузке она стартует после спада (или через max_wait)."""
+
+    async def run() -> Any:
+        waited = await shedder.wait_calm(max_wait)
+        if waited >= 1:
+            logger.info("Задача %s отложена на %.0f с из-за перегрузки", func.__name__, waited)
+        return await func()
+
+    run.__name__ = func.__name__
+    return run
+
+
+class SlidingWindowLimiter:
+    """
+    Счётчик в скользящем окне по двум соседним фиксированным окнам:
+    оценка = prev * (доля прошлого окна, попавшая в скользящее) + cur.
+    На пользователя и вид — три числа; неактивные пользователи вытесняются
+    с головы OrderedDict, как только их окна истекли, и по THROTTLE_MAX_USERS.
+    """
+
+    def __init__(self, budgets: dict[str, tuple[int, float]], max_users: int = THROTTLE_MAX_USERS) -> None:
+        self.budgets = budgets
+        self.max_users = max_users
+        self.max_window = max(window for _, window in budgets.values())
+        # user_id → (последнее сообщение, {вид: [начало окна, prev, cur, окно последнего предупреждения]})
+        self._users: OrderedDict[int, tuple[float, dict[str, list[float]]]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._users)
+
+    def _evict(self, now: float) -> None:
+        while self._users:
+            _, (seen, _) = next(iter(self._users.items()))
+            if now - seen <= 2 * self.max_window and len(self._users) <= self.max_users:
+                break
+            self._users.popitem(last=False)
+
+    def hit(self, user_id: int, kind: str, factor: float = 1.0, now: Optional[float] = None) -> tuple[bool, bool]:
+        """
+        Учитывает сообщение. Возвращает (пропустить, предупредить): предупреждение —
+        только на первое превышение в текущем окне.
+        """
+        now = time.monotonic() if now is None else now
+        limit, window = self.budgets[kind]
+        limit = max(1, int(limit * factor))
+        entry = self._users.pop(user_id, None)
+        counters = entry[1] if entry is not None else {}
+        state = counters.get(kind)
+        if state is None:
+            state = counters[kind] = [now, 0.0, 0.0, -1.0]
+        elapsed = now - state[0]
+        if elapsed >= window:
+            # Сдвигаем окно; если прошло больше двух окон, прошлое окно пустое
+            shifts = int(elapsed // window)
+            state[1] = state[2] if shifts == 1 else 0.0
+            state[2] = 0.0
+            state[0] += shifts * window
+            elapsed = now - state[0]
+        estimate = state[1] * (1.0 - elapsed / window) + state[2]
+        self._users[user_id] = (now, counters)
+        self._evict(now)
+        if estimate >= limit:
+            warn = state[3] != state[0]
+            state[3] = state[0]
+            return False, warn
+        state[2] += 1
+        return True, False
+
+
+MEDIA_FIELDS = ("photo", "video", "document", "animation", "voice", "video_note", "audio", "sticker")
+
+
+def message_kind(message: Message, is_menu: Callable[[str], bool]) -> str:
+    if any(getattr(message, name, None) for name in MEDIA_FIELDS):
+        return "media"
+    if message.contact or (message.text and is_menu(message.text)):
+        return "menu"
+    return "text"
+
+
+class ThrottleMiddleware(BaseMiddleware):
+    """Outer middleware на message: лишние сообщения не доходят до фильтров и хэндлеров."""
+
+    def __init__(
+        self,
+        limiter: SlidingWindowLimiter,
+        shedder: LoadShedder,
+        is_menu: Callable[[str], bool],
+        exempt: Callable[[Optional[int]], bool] = lambda user_id: False,
+    ) -> None:
+        self.limiter = limiter
+        self.shedder = shedder
+        self.is_menu = is_menu
+        self.exempt = exempt
+        self.dropped = 0
+        self.warned = 0
+
+    async def __call__(self, handler, event: TelegramObject, data: dict):
+        if not isinstance(event, Message) or event.from_user is None or self.exempt(event.from_user.id):
+            return await handler(event, data)
+        kind = message_kind(event, self.is_menu)
+        factor = LOAD_SHED_FACTOR if kind in SHEDDABLE_KINDS and self.shedder.active else 1.0
+        allowed, warn = self.limiter.hit(event.from_user.id, kind, factor)
+        if allowed:
+            return await handler(event, data)
+        self.dropped += 1
+        if warn:
+            self.warned += 1
+            logger.info("Пользователь %s превысил лимит (%s)", event.from_user.id, kind)
+            try:
+                await event.answer(THROTTLE_WARNING_TEXT)
+            except Exception as exc:
+                logger.warning("Не удалось предупредить %s о лимите: %s", event.from_user.id, exc)
+        return None
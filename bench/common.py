@@ -0,0 +1,64 @@
+"""Общие части бенчмарков: подготовка окружения, локальная БД, отчёты."""
+import os
+import statistics
+from pathlib import Path
+from typing import Any, Iterable
+
+import asyncpg
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def bench_env(admins: str = "1000001 1000002") -> str:
+    """
+    Настраивает окружение до импорта bot.py. Бенчмарк работает только с явно
+    указанной BENCH_DB_DSN, чтобы случайно не нагрузить боевую БД из .env.
+    """
+    dsn = os.getenv("BENCH_DB_DSN")
+    if not dsn:
+        raise SystemExit("BENCH_DB_DSN is not set (use a throwaway local database)")
+    os.environ["DB_DSN"] = dsn
+    # Профиль test: bot.create_app() соберёт бота без настоящего BOT_TOKEN
+    os.environ.setdefault("BOT_PROFILE", "test")
+    os.environ.setdefault("ADMIN_TG_IDS", admins)
+    os.environ.setdefault("LOGS_CHAT_ID", "-1001000000001")
+    # Журнал бенчмарка не должен смешиваться с боевым.
+    os.environ.setdefault("WRITE_JOURNAL_PATH", str(ROOT / "var" / "bench_write_journal.jsonl"))
+    return dsn
+
+
+async def apply_bench_schema(dsn: str) -> None:
+    """Создаёт минимальную схему общих таблиц и применяет миграции бота."""
+    conn = await asyncpg.connect(dsn)
+    try:
+        await conn.execute((ROOT / "bench" / "schema.sql").read_text(encoding="utf-8"))
+        for migration in sorted((ROOT / "app" / "migrations").glob("*.sql")):
+            await conn.execute(migration.read_text(encoding="utf-8"))
+    finally:
+        await conn.close()
+
+
+def percentiles(samples: Iterable[float]) -> dict[str, float]:
+    data = sorted(samples)
+    if not data:
+        return {"count": 0, "mean": 0.0, "p50": 0.0, "p95": 0.0, "p99": 0.0, "max": 0.0}
+
+    def pick(q: float) -> float:
+        return data[min(len(data) - 1, int(round(q * (len(data) - 1))))]
+
+    return {
+        "count": len(data),
+        "mean": statistics.fmean(data),
+        "p50": pick(0.50),
+        "p95": pick(0.95),
+        "p99": pick(0.99),
+        "max": data[-1],
+    }
+
+
+def format_ms(stats: dict[str, Any]) -> str:
+    return (
+        f"n={stats['count']:<6} mean={stats['mean'] * 1000:7.2f}ms "
+        f"p50={stats['p50'] * 1000:7.2f}ms p95={stats['p95'] * 1000:7.2f}ms "
+        f"p99={stats['p99'] * 1000:7.2f}ms max={stats['max'] * 1000:7.2f}ms"
+    )
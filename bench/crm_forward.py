@@ -0,0 +1,156 @@
+"""
+Бенчмарк пересылки сообщений в CRM (app.crm_forward) против локальной заглушки Wahelp.
+
+FakeWahelp принимает POST /app/projects/{project}/channels/{channel}/messages,
+отвечает с задержкой и с заданной долей ответов 503 — экспортёр должен
+повторить их, не нарушив порядок сообщений одного клиента. Меряется задержка
+enqueue (то, что видит хэндлер) и время до полной доставки. --instances N
+запускает N экспортёров на одной очереди, как N инстансов бота. Сеть наружу не нужна.
+
+Пример:
+    BENCH_DB_DSN=postgresql://postgres@localhost/bench \\
+        python -m bench.crm_forward --messages 2000 --clients 200 --fail-rate 0.1
+"""
+import argparse
+import asyncio
+import random
+import time
+from collections import defaultdict
+from typing import Any, Optional
+
+from aiohttp import web
+
+from bench.common import bench_env, format_ms, percentiles
+
+
+class FakeWahelp:
+    def __init__(self, *, latency_ms: float = 40.0, fail_rate: float = 0.0, host: str = "127.0.0.1", port: int = 0) -> None:
+        self.latency_ms = latency_ms
+        self.fail_rate = fail_rate
+        self.host = host
+        self.port = port
+        self.received: dict[str, list[str]] = defaultdict(list)
+        self.requests = 0
+        self.failed = 0
+        self._rng = random.Random(7)
+        self._runner: Optional[web.AppRunner] = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.router.add_post("/app/projects/{project}/channels/{channel}/messages", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        sockets = site._server.sockets if site._server else []
+        if sockets:
+            self.port = sockets[0].getsockname()[1]
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        payload = await request.json()
+        await asyncio.sleep(max(0.0, self._rng.gauss(self.latency_ms, self.latency_ms / 4)) / 1000)
+        if self._rng.random() < self.fail_rate:
+            self.failed += 1
+            return web.json_response({"error": "unavailable"}, status=503)
+        self.received[payload["user"]["phone"]].append(payload["message"]["text"])
+        return web.json_response({"ok": True})
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--latency-ms", type=float, default=40.0)
+    parser.add_argument("--fail-rate", type=float, default=0.05)
+    parser.add_argument("--batch", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--instances", type=int, default=1, help="экспортёров на одной очереди")
+    return parser.parse_args(argv)
+
+
+async def run(args: argparse.Namespace) -> dict[str, Any]:
+    bench_env()
+    import app.crm_forward as crm
+    from app.db import acquire, close_pool, init_pool
+
+    # Повторы в бенчмарке — без долгих пауз
+    crm.CRM_FORWARD_BACKOFF_SEC = 0.05
+    crm.CRM_FORWARD_BACKOFF_MAX_SEC = 0.5
+
+    stub = FakeWahelp(latency_ms=args.latency_ms, fail_rate=args.fail_rate)
+    await stub.start()
+    await init_pool(min_size=1, max_size=5)
+    exporters = [
+        crm.CrmExporter(
+            api_base=stub.base_url,
+            token="bench",
+            project_id="1",
+            channel_uuid="bench",
+            batch_size=args.batch,
+            concurrency=args.concurrency,
+        )
+        for _ in range(max(1, args.instances))
+    ]
+    exporter = exporters[0]
+    try:
+        async with acquire() as conn:
+            await crm.ensure_crm_outbox_schema(conn)
+            await conn.execute("DELETE FROM crm_outbox WHERE phone LIKE '+7999%'")
+        phones = [f"+7999{index:07d}" for index in range(args.clients)]
+        for item in exporters:
+            item.start()
+        enqueue_samples: list[float] = []
+        started = time.perf_counter()
+
+        async def client(phone: str, count: int) -> None:
+            for seq in range(count):
+                t0 = time.perf_counter()
+                await exporter.enqueue(phone, f"{seq}", client_id=None)
+                enqueue_samples.append(time.perf_counter() - t0)
+
+        per_client = max(1, args.messages // args.clients)
+        await asyncio.gather(*(client(phone, per_client) for phone in phones))
+        total = per_client * len(phones)
+        while sum(len(v) for v in stub.received.values()) < total:
+            await asyncio.sleep(0.05)
+            if time.perf_counter() - started > 300:
+                break
+        elapsed = time.perf_counter() - started
+        out_of_order = sum(
+            1 for texts in stub.received.values() if [int(t) for t in texts] != sorted(int(t) for t in texts)
+        )
+        async with acquire() as conn:
+            await conn.execute("DELETE FROM crm_outbox WHERE phone LIKE '+7999%'")
+    finally:
+        for item in exporters:
+            await item.stop()
+        await close_pool()
+        await stub.stop()
+
+    delivered = sum(len(v) for v in stub.received.values())
+    print(f"enqueue (reply path)  {format_ms(percentiles(enqueue_samples))}")
+    print(
+        f"delivered {delivered}/{total} in {elapsed:.2f}s ({delivered / elapsed:.0f} msg/s), "
+        f"HTTP requests {stub.requests}, 503 injected {stub.failed}, "
+        f"retried {sum(item.retried for item in exporters)}, "
+        f"clients out of order {out_of_order}"
+    )
+    return {"delivered": delivered, "total": total, "elapsed_sec": elapsed, "out_of_order": out_of_order}
+
+
+def main(argv: list[str] | None = None) -> None:
+    asyncio.run(run(parse_args(argv)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+"""
+Нагрузочный тест webhook ответов CRM (app.crm_webhook) через настоящий bot.py.
+
+Заводит в BENCH_DB_DSN клиентов бенчмарка, поднимает фейковый Bot API и relay
+из bot.py на свободном порту и шлёт подписанные webhook «ответ менеджера» с
+заданной параллельностью. Меряется время ответа webhook (ack) и время до
+доставки всех сообщений; проверяется порядок сообщений внутри каждого чата.
+
+Пример:
+    BENCH_DB_DSN=postgresql://postgres@localhost/bench \\
+        python -m bench.crm_webhook --init-schema --replies 5000 --chats 300 --concurrency 100 --rate 1000
+"""
+import argparse
+import asyncio
+import json
+import logging
+import time
+from collections import defaultdict
+from typing import Any
+
+import aiohttp
+
+from bench.common import apply_bench_schema, bench_env, format_ms, percentiles
+from bench.fake_bot_api import FakeBotAPI
+
+BENCH_PHONE_PREFIX = "7998"
+BENCH_CHAT_BASE = 8_000_000_000
+
+
+class RecordingBotAPI(FakeBotAPI):
+    """Запоминает тексты sendMessage по чатам — для проверки порядка."""
+
+    def __init__(self, **kwargs: Any) -> None:
+        super().__init__(**kwargs)
+        self.texts: dict[int, list[str]] = defaultdict(list)
+
+    def _result(self, method: str, form: dict[str, Any]) -> Any:
+        if method == "sendmessage":
+            self.texts[int(form["chat_id"])].append(str(form["text"]))
+        return super()._result(method, form)
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--replies", type=int, default=3000)
+    parser.add_argument("--chats", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, default=100, help="одновременных webhook-запросов")
+    parser.add_argument("--rate", type=float, default=1000.0, help="темп отправки в фейковый Bot API, сообщений/с")
+    parser.add_argument("--api-latency-ms", type=float, default=35.0)
+    parser.add_argument("--init-schema", action="store_true")
+    return parser.parse_args(argv)
+
+
+async def seed_clients(conn, chats: int) -> list[str]:
+    phones = [f"{BENCH_PHONE_PREFIX}{index:07d}" for index in range(chats)]
+    await conn.execute("DELETE FROM clients WHERE phone_digits LIKE $1", BENCH_PHONE_PREFIX + "%")
+    await conn.execute(
+        """
+        INSERT INTO clients (full_name, phone, phone_digits, status, bot_tg_user_id, bot_started)
+        SELECT 'Bench CRM', '+' || d, d, 'client', $2 + n, true
+        FROM unnest($1::text[]) WITH ORDINALITY AS v(d, n)
+        """,
+        phones,
+        BENCH_CHAT_BASE,
+    )
+    return phones
+
+
+async def run(args: argparse.Namespace) -> dict[str, Any]:
+    dsn = bench_env()
+    secret = "bench-secret"
+    if args.init_schema:
+        await apply_bench_schema(dsn)
+    logging.disable(logging.WARNING)
+
+    from aiogram.client.telegram import TelegramAPIServer
+
+    import bot as bot_module
+    from app.crm_webhook import CRM_WEBHOOK_PATH, ensure_crm_inbox_schema, sign_body
+    from app.db import acquire, close_pool, init_pool
+    from app.sender import RateLimitedSender
+
+    api = RecordingBotAPI(latency_ms=args.api_latency_ms, jitter_ms=args.api_latency_ms / 3)
+    await api.start()
+    bot_module.create_app()
+    bot_module.bot.session.api = TelegramAPIServer.from_base(api.base_url)
+    relay = bot_module.CrmReplyRelay(
+        RateLimitedSender(bot_module._send_outbound, rate_per_sec=args.rate, per_chat_interval=0.0, concurrency=100),
+        bot_module._send_crm_reply,
+        secret=secret,
+    )
+    await init_pool(min_size=1, max_size=5)
+    async with acquire() as conn:
+        await ensure_crm_inbox_schema(conn)
+        await conn.execute("DELETE FROM crm_inbox WHERE phone LIKE $1", BENCH_PHONE_PREFIX + "%")
+        phones = await seed_clients(conn, args.chats)
+    await relay.start(host="127.0.0.1", port=0)
+    url = f"http://127.0.0.1:{relay.port}{CRM_WEBHOOK_PATH}"
+
+    ack_samples: list[float] = []
+    statuses: dict[int, int] = defaultdict(int)
+    bodies = []
+    for index in range(args.replies):
+        payload = {
+            "data": {
+                "destination": "from_operator",
+                "id": f"bench-{index}",
+                "user": {"phone": "+" + phones[index % len(phones)]},
+                "message": {"text": str(index)},
+            }
+        }
+        body = json.dumps(payload).encode()
+        bodies.append((body, sign_body(secret, body)))
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    started = time.perf_counter()
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=args.concurrency)) as session:
+
+        async def post(body: bytes, signature: str) -> None:
+            async with semaphore:
+                t0 = time.perf_counter()
+                async with session.post(url, data=body, headers={"X-Signature": signature}) as response:
+                    await response.read()
+                    statuses[response.status] += 1
+                ack_samples.append(time.perf_counter() - t0)
+
+        await asyncio.gather(*(post(body, signature) for body, signature in bodies))
+    acked = time.perf_counter() - started
+    while relay.stats["delivered"] + relay.stats["failed"] + relay.stats["no_chat"] < statuses.get(200, 0):
+        await asyncio.sleep(0.02)
+        if time.perf_counter() - started > 300:
+            break
+    delivered_in = time.perf_counter() - started
+
+    out_of_order = 0
+    for chat_id, texts in api.texts.items():
+        numbers = [int(text) for text in texts]
+        if numbers != sorted(numbers):
+            out_of_order += 1
+    await relay.stop()
+    async with acquire() as conn:
+        await conn.execute("DELETE FROM clients WHERE phone_digits LIKE $1", BENCH_PHONE_PREFIX + "%")
+        await conn.execute("DELETE FROM crm_inbox WHERE phone LIKE $1", BENCH_PHONE_PREFIX + "%")
+    await close_pool()
+    await bot_module.bot.session.close()
+    await api.stop()
+
+    print(f"ack            {format_ms(percentiles(ack_samples))}")
+    print(
+        f"accepted {statuses.get(200, 0)}/{args.replies} in {acked:.2f}s ({args.replies / acked:.0f} req/s), "
+        f"statuses {dict(statuses)}"
+    )
+    print(
+        f"delivered {relay.stats['delivered']} in {delivered_in:.2f}s "
+        f"({relay.stats['delivered'] / delivered_in:.0f} msg/s), failed {relay.stats['failed']}, "
+        f"no chat {relay.stats['no_chat']}, chats out of order {out_of_order}"
+    )
+    return {"stats": relay.stats, "out_of_order": out_of_order}
+
+
+def main(argv: list[str] | None = None) -> None:
+    asyncio.run(run(parse_args(argv)))
+
+
+if __name__ == "__main__":
+    main()
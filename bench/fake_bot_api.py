@@ -0,0 +1,123 @@
+"""
+Локальный фейковый Telegram Bot API для бенчмарков.
+
+Принимает те же запросы, что и api.telegram.org (POST /bot<token>/<method>),
+отвечает правдоподобными объектами и добавляет настраиваемую задержку.
+Сеть наружу не нужна.
+"""
+import asyncio
+import itertools
+import json
+import random
+import time
+from collections import Counter
+from typing import Any, Optional
+
+from aiohttp import web
+
+BOT_ID = 4242424242
+BOT_USERNAME = "raketaclean_bench_bot"
+
+
+class FakeBotAPI:
+    def __init__(
+        self,
+        *,
+        latency_ms: float = 35.0,
+        jitter_ms: float = 15.0,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        seed: Optional[int] = None,
+    ) -> None:
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.host = host
+        self.port = port
+        self.calls: Counter[str] = Counter()
+        self._message_ids = itertools.count(1)
+        self._rng = random.Random(seed)
+        self._runner: Optional[web.AppRunner] = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        # При port=0 ОС выдала свободный порт — узнаём какой.
+        sockets = site._server.sockets if site._server else []
+        if sockets:
+            self.port = sockets[0].getsockname()[1]
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def _delay(self) -> None:
+        if self.latency_ms <= 0:
+            return
+        delay = max(0.0, self._rng.gauss(self.latency_ms, self.jitter_ms)) / 1000
+        await asyncio.sleep(delay)
+
+    def _chat(self, chat_id: Any) -> dict[str, Any]:
+        chat_id = int(chat_id)
+        return {"id": chat_id, "type": "private" if chat_id > 0 else "group", "first_name": "Bench"}
+
+    def _message(self, form: dict[str, Any], **extra: Any) -> dict[str, Any]:
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": self._chat(form.get("chat_id", 0)),
+            "from": {"id": BOT_ID, "is_bot": True, "first_name": "RaketaClean", "username": BOT_USERNAME},
+        }
+        if "text" in form:
+            message["text"] = form["text"]
+        if "caption" in form:
+            message["caption"] = form["caption"]
+        message.update(extra)
+        return message
+
+    def _result(self, method: str, form: dict[str, Any]) -> Any:
+        if method == "getme":
+            return {
+                "id": BOT_ID,
+                "is_bot": True,
+                "first_name": "RaketaClean",
+                "username": BOT_USERNAME,
+                "can_join_groups": False,
+                "can_read_all_group_messages": False,
+                "supports_inline_queries": False,
+            }
+        if method in {"sendmessage", "editmessagetext"}:
+            return self._message(form)
+        if method == "sendphoto":
+            file_id = str(form.get("photo", "photo"))
+            return self._message(
+                form,
+                photo=[{"file_id": file_id, "file_unique_id": file_id[-16:], "width": 1280, "height": 960}],
+            )
+        if method == "sendvideo":
+            file_id = str(form.get("video", "video"))
+            return self._message(
+                form,
+                video={"file_id": file_id, "file_unique_id": file_id[-16:], "width": 1280, "height": 720, "duration": 5},
+            )
+        if method == "senddocument":
+            file_id = str(form.get("document", "document"))
+            return self._message(form, document={"file_id": file_id, "file_unique_id": file_id[-16:]})
+        # setMyCommands, deleteWebhook, sendChatAction, answerCallbackQuery и прочие возвращают True.
+        return True
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"].lower()
+        self.calls[method] += 1
+        form = dict(await request.post()) if request.can_read_body else {}
+        await self._delay()
+        body = {"ok": True, "result": self._result(method, form)}
+        return web.Response(text=json.dumps(body, ensure_ascii=False), content_type="application/json")
@@ -0,0 +1,167 @@
+"""
+Время импорта bot.py и сборки приложения (create_app) — с бюджетом и историей.
+
+Каждый прогон — отдельный процесс `python -X importtime` в профиле test (без
+BOT_TOKEN, БД и сети). Из отчёта importtime берутся суммарное время импорта bot
+и самые тяжёлые модули; отдельно меряется create_app(). Берётся медиана по
+--runs прогонам. Если время выше --budget-ms или при импорте подтянулись
+модули из --forbid (по умолчанию APScheduler — он нужен только main()),
+скрипт завершается с кодом 1. С --history результат дописывается в JSONL
+вместе с коммитом, и печатается разница с предыдущей записью.
+
+Пример:
+    python -m bench.importtime --runs 5 --budget-ms 3000 --history var/importtime.jsonl
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Any
+
+from bench.common import ROOT
+
+PROBE = """
+import json, sys, time
+started = time.perf_counter()
+import bot
+imported = time.perf_counter()
+bot.create_app()
+built = time.perf_counter()
+print(json.dumps({"import_sec": imported - started, "create_app_sec": built - imported}))
+"""
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--budget-ms", type=float, default=float(os.getenv("IMPORT_BUDGET_MS", "3000") or "3000"))
+    parser.add_argument("--top", type=int, default=15, help="сколько самых тяжёлых модулей показать")
+    parser.add_argument("--forbid", default="apscheduler", help="пакеты через запятую, которых не должно быть при импорте")
+    parser.add_argument("--history", default="", help="JSONL-файл для истории замеров")
+    return parser.parse_args(argv)
+
+
+def parse_importtime(stderr: str) -> list[tuple[str, int, int]]:
+    """Строки `import time: self | cumulative | name` → (модуль, self мкс, cumulative мкс)."""
+    rows: list[tuple[str, int, int]] = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        parts = line[len("import time:"):].split("|")
+        if len(parts) != 3 or not parts[0].strip().isdigit():
+            continue  # заголовок таблицы
+        rows.append((parts[2].strip(), int(parts[0]), int(parts[1])))
+    return rows
+
+
+def run_once() -> dict[str, Any]:
+    env = dict(os.environ, BOT_PROFILE="test", PYTHONPATH=str(ROOT))
+    env.pop("BOT_TOKEN", None)
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", PROBE],
+        cwd=ROOT,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=False,
+    )
+    if proc.returncode != 0:
+        raise SystemExit(f"import bot failed:\n{proc.stderr[-2000:]}")
+    timings = json.loads(proc.stdout.strip().splitlines()[-1])
+    modules = parse_importtime(proc.stderr)
+    bot_row = next((row for row in modules if row[0] == "bot"), None)
+    return {
+        "import_sec": timings["import_sec"],
+        "create_app_sec": timings["create_app_sec"],
+        "bot_cumulative_us": bot_row[2] if bot_row else 0,
+        "modules": modules,
+    }
+
+
+def package_totals(modules: list[tuple[str, int, int]]) -> dict[str, int]:
+    """Собственное время модулей, сложенное по верхнему пакету."""
+    totals: dict[str, int] = defaultdict(int)
+    for name, self_us, _ in modules:
+        totals[name.split(".", 1)[0]] += self_us
+    return dict(sorted(totals.items(), key=lambda item: item[1], reverse=True))
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def append_history(path: Path, record: dict[str, Any]) -> dict[str, Any] | None:
+    previous = None
+    if path.exists():
+        lines = [line for line in path.read_text(encoding="utf-8").splitlines() if line.strip()]
+        if lines:
+            previous = json.loads(lines[-1])
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with path.open("a", encoding="utf-8") as fh:
+        fh.write(json.dumps(record, ensure_ascii=False) + "\n")
+    return previous
+
+
+def main(argv: list[str] | None = None) -> None:
+    args = parse_args(argv)
+    runs = [run_once() for _ in range(max(1, args.runs))]
+    import_ms = statistics.median(run["import_sec"] for run in runs) * 1000
+    create_app_ms = statistics.median(run["create_app_sec"] for run in runs) * 1000
+    # Модули и пакеты — по прогону с медианным временем импорта
+    median_run = sorted(runs, key=lambda run: run["import_sec"])[len(runs) // 2]
+    modules = median_run["modules"]
+    packages = package_totals(modules)
+    imported = {name.split(".", 1)[0] for name, _, _ in modules}
+    forbidden = [name for name in (part.strip() for part in args.forbid.split(",")) if name and name in imported]
+
+    print(f"import bot     {import_ms:8.1f}ms (median of {len(runs)}, budget {args.budget_ms:.0f}ms)")
+    print(f"create_app()   {create_app_ms:8.1f}ms")
+    print(f"modules        {len(modules)}")
+    print("heaviest modules (self time):")
+    for name, self_us, cumulative_us in sorted(modules, key=lambda row: row[1], reverse=True)[: args.top]:
+        print(f"  {self_us / 1000:8.1f}ms  (cumulative {cumulative_us / 1000:8.1f}ms)  {name}")
+    print("by package (self time):")
+    for name, self_us in list(packages.items())[: args.top]:
+        print(f"  {self_us / 1000:8.1f}ms  {name}")
+
+    if args.history:
+        record = {
+            "at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "commit": git_commit(),
+            "import_ms": round(import_ms, 1),
+            "create_app_ms": round(create_app_ms, 1),
+            "modules": len(modules),
+            "packages_ms": {name: round(us / 1000, 1) for name, us in list(packages.items())[:10]},
+        }
+        previous = append_history(Path(args.history), record)
+        if previous:
+            print(
+                f"vs {previous.get('commit') or previous.get('at')}: "
+                f"import {import_ms - previous['import_ms']:+.1f}ms, "
+                f"create_app {create_app_ms - previous['create_app_ms']:+.1f}ms, "
+                f"modules {len(modules) - previous['modules']:+d}"
+            )
+
+    failed = False
+    if import_ms > args.budget_ms:
+        print(f"FAIL: import bot {import_ms:.1f}ms is over budget {args.budget_ms:.0f}ms")
+        failed = True
+    if forbidden:
+        print(f"FAIL: imported at module import: {', '.join(forbidden)}")
+        failed = True
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+"""
+Микробенчмарк маршрутизации текстовых апдейтов: цепочка F.text.casefold() == BTN.lower()
+(как было) против одной таблицы MENU_TABLE (app.menu).
+
+Через настоящий aiogram Dispatcher с пустыми хэндлерами: меряется только выбор
+хэндлера, без БД и сети. Ни БД, ни Bot API не нужны.
+
+Пример:
+    python -m bench.menu_dispatch --updates 20000
+"""
+import argparse
+import asyncio
+import logging
+import time
+from typing import Any
+
+from bench.common import percentiles
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--updates", type=int, default=20000)
+    parser.add_argument("--free-text-share", type=float, default=0.5, help="доля апдейтов, которые не кнопки")
+    parser.add_argument("--verbose", action="store_true", help="оставить INFO-логи (aiogram пишет строку на апдейт)")
+    return parser.parse_args(argv)
+
+
+def legacy_is_menu_button(buttons: list[str], text: str) -> bool:
+    """is_menu_button до перехода на MENU_TABLE — для сравнения."""
+    if not text:
+        return False
+    text_normalized = text.strip()
+    if text_normalized.startswith("/"):
+        return True
+    for button in buttons:
+        button_text = button.split(" ", 1)[-1] if " " in button else button
+        if text_normalized.lower() == button.lower() or text_normalized.lower() == button_text.lower():
+            return True
+    return False
+
+
+def build_dispatchers(buttons: list[str]):
+    from aiogram import Dispatcher, F
+
+    from app.menu import MenuButtonFilter, MenuTable
+
+    async def noop(message, **kwargs: Any) -> None:
+        return None
+
+    legacy = Dispatcher()
+    for button in buttons:
+        legacy.message.register(noop, F.text.casefold() == button.lower())
+
+    async def legacy_fallback(message, **kwargs: Any) -> None:
+        legacy_is_menu_button(buttons, message.text or "")
+
+    legacy.message.register(legacy_fallback)
+
+    table = MenuTable(buttons)
+    routed = Dispatcher()
+    routed.message.register(noop, MenuButtonFilter(table))
+
+    async def routed_fallback(message, **kwargs: Any) -> None:
+        table.is_menu_text(message.text or "")
+
+    routed.message.register(routed_fallback)
+    return legacy, routed
+
+
+def make_updates(buttons: list[str], count: int, free_share: float) -> list[Any]:
+    from aiogram.types import Update
+
+    free_texts = [
+        "Здравствуйте, сколько стоит химчистка дивана?",
+        "Добрый день! Можно завтра после обеда?",
+        "спасибо",
+        "Хочу заказать стирку ковра 2x3",
+    ]
+    updates = []
+    for i in range(count):
+        if (i % 100) / 100 < free_share:
+            text = free_texts[i % len(free_texts)]
+        else:
+            text = buttons[i % len(buttons)]
+        updates.append(
+            Update.model_validate(
+                {
+                    "update_id": i,
+                    "message": {
+                        "message_id": i,
+                        "date": 0,
+                        "chat": {"id": 7_000_000_000 + i % 500, "type": "private"},
+                        "from": {"id": 7_000_000_000 + i % 500, "is_bot": False, "first_name": "Bench"},
+                        "text": text,
+                    },
+                }
+            )
+        )
+    return updates
+
+
+async def measure(dp, bot, updates: list[Any]) -> dict[str, float]:
+    samples = []
+    for update in updates:
+        started = time.perf_counter()
+        await dp.feed_update(bot, update)
+        samples.append(time.perf_counter() - started)
+    return percentiles(samples)
+
+
+async def run(args: argparse.Namespace) -> None:
+    from aiogram import Bot
+
+    import bot as bot_module
+    from app.config import TEST_BOT_TOKEN
+
+    # Иначе в замер попадает INFO-строка aiogram на каждый апдейт
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    buttons = list(bot_module.MENU_BUTTONS)
+    legacy, routed = build_dispatchers(buttons)
+    updates = make_updates(buttons, args.updates, args.free_text_share)
+    bot = Bot(TEST_BOT_TOKEN)
+    # Прогрев, затем чередуем прогоны, чтобы уравнять влияние кэшей и GC
+    await measure(legacy, bot, updates[:500])
+    await measure(routed, bot, updates[:500])
+    legacy_stats = await measure(legacy, bot, updates)
+    routed_stats = await measure(routed, bot, updates)
+    await bot.session.close()
+
+    for name, stats in (("chain of magic filters", legacy_stats), ("MENU_TABLE router", routed_stats)):
+        print(
+            f"{name:<24} mean={stats['mean'] * 1e6:7.1f}µs p50={stats['p50'] * 1e6:7.1f}µs "
+            f"p95={stats['p95'] * 1e6:7.1f}µs p99={stats['p99'] * 1e6:7.1f}µs"
+        )
+    print(f"speedup (mean): {legacy_stats['mean'] / routed_stats['mean']:.2f}x")
+
+    probes = [u.message.text for u in updates[:1000]]
+    started = time.perf_counter()
+    for _ in range(20):
+        for text in probes:
+            legacy_is_menu_button(buttons, text)
+    legacy_ns = (time.perf_counter() - started) / (20 * len(probes)) * 1e9
+    started = time.perf_counter()
+    for _ in range(20):
+        for text in probes:
+            bot_module.is_menu_button(text)
+    table_ns = (time.perf_counter() - started) / (20 * len(probes)) * 1e9
+    print(f"is_menu_button: {legacy_ns:.0f}ns → {table_ns:.0f}ns per call")
+
+
+def main(argv: list[str] | None = None) -> None:
+    asyncio.run(run(parse_args(argv)))
+
+
+if __name__ == "__main__":
+    main()
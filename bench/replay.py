@@ -0,0 +1,230 @@
+"""
+Воспроизведение записанных апдейтов (UPDATE_RECORD_PATH) для поиска регрессий.
+
+Запись проигрывается через настоящий Dispatcher из bot.py с фейковым Bot API и
+локальной БД. Апдейты одного клиента идут строго по порядку и с исходными
+интервалами (делёнными на --speed); --speed 0 — без пауз, максимально быстро.
+Отчёт можно сохранить как базовый и сравнивать с ним следующие прогоны.
+
+Пример:
+    BENCH_DB_DSN=postgresql://postgres@localhost/bench \\
+        python -m bench.replay var/updates.jsonl.gz --speed 10 --baseline bench/baseline.json
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import sys
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Any
+
+from bench.common import apply_bench_schema, bench_env, format_ms, percentiles
+from bench.fake_bot_api import FakeBotAPI
+
+# Разница меньше этой считается шумом при сравнении с базовым прогоном.
+NOISE_FLOOR_SEC = 0.002
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("recording", type=Path, help="gzip JSONL, записанный UpdateRecorder")
+    parser.add_argument("--speed", type=float, default=1.0, help="1 — реальное время, 10 — в 10 раз быстрее, 0 — без пауз")
+    parser.add_argument("--pool-size", type=int, default=5)
+    parser.add_argument("--api-latency-ms", type=float, default=35.0)
+    parser.add_argument("--api-jitter-ms", type=float, default=15.0)
+    parser.add_argument("--init-schema", action="store_true")
+    parser.add_argument("--reset", action="store_true", help="удалить клиентов и лидов из записи перед прогоном")
+    parser.add_argument("--baseline", type=Path, help="сравнить с сохранённым отчётом")
+    parser.add_argument("--save-baseline", type=Path, help="сохранить отчёт как базовый")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="допустимый рост p95 (0.2 = +20%%)")
+    parser.add_argument("--verbose", action="store_true")
+    return parser.parse_args(argv)
+
+
+def update_owner(update: dict[str, Any]) -> int:
+    for key in ("message", "edited_message", "callback_query", "my_chat_member"):
+        event = update.get(key)
+        if not event:
+            continue
+        sender = event.get("from") or {}
+        if sender.get("id"):
+            return int(sender["id"])
+        chat = event.get("chat") or (event.get("message") or {}).get("chat") or {}
+        if chat.get("id"):
+            return int(chat["id"])
+    return 0
+
+
+class HandlerProbe:
+    """Внутренняя middleware: узнаёт, какой хэндлер обработал апдейт."""
+
+    async def __call__(self, handler, event, data):
+        probe = data.get("replay_probe")
+        handler_object = data.get("handler")
+        if probe is not None and handler_object is not None:
+            probe["handler"] = getattr(handler_object.callback, "__name__", "unknown")
+        return await handler(event, data)
+
+
+async def run(args: argparse.Namespace) -> dict[str, Any]:
+    from app.recorder import read_recording
+
+    records = read_recording(args.recording)
+    if not records:
+        raise SystemExit(f"{args.recording}: no updates recorded")
+
+    dsn = bench_env()
+    if args.init_schema:
+        await apply_bench_schema(dsn)
+
+    import bot as bot_module
+    from aiogram.client.telegram import TelegramAPIServer
+    from app.db import close_pool, get_pool, init_pool, pool_stats
+
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    api = FakeBotAPI(latency_ms=args.api_latency_ms, jitter_ms=args.api_jitter_ms)
+    await api.start()
+    bot, dp = bot_module.create_app()
+    bot.session.api = TelegramAPIServer.from_base(api.base_url)
+
+    await init_pool(min_size=1, max_size=args.pool_size)
+    await bot_module.ensure_runtime_schema()
+
+    per_user: dict[int, list[dict[str, Any]]] = defaultdict(list)
+    for record in records:
+        per_user[update_owner(record["update"])].append(record)
+
+    if args.reset:
+        user_ids = [uid for uid in per_user if uid > 0]
+        async with get_pool().acquire() as conn:
+            await conn.execute("DELETE FROM clients WHERE bot_tg_user_id = ANY($1::bigint[])", user_ids)
+            await conn.execute("DELETE FROM leads WHERE tg_user_id = ANY($1::bigint[])", user_ids)
+            await conn.execute("DELETE FROM bot_fsm_states WHERE user_id = ANY($1::bigint[])", user_ids)
+
+    probe = HandlerProbe()
+    for observer in (dp.message, dp.callback_query, dp.my_chat_member):
+        observer.middleware(probe)
+    bot_module.fsm_storage.start()
+
+    latencies: dict[str, list[float]] = defaultdict(list)
+    lags: list[float] = []
+    errors: dict[str, int] = defaultdict(int)
+    first_t = records[0]["t"]
+
+    async def drive(user_records: list[dict[str, Any]], t0: float) -> None:
+        for record in user_records:
+            if args.speed > 0:
+                due = t0 + (record["t"] - first_t) / args.speed
+                delay = due - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                lags.append(max(0.0, time.perf_counter() - due))
+            info: dict[str, Any] = {}
+            started = time.perf_counter()
+            try:
+                await dp.feed_raw_update(bot, record["update"], replay_probe=info)
+            except Exception as exc:
+                errors[info.get("handler", "unhandled")] += 1
+                if args.verbose:
+                    logging.exception("Replay update failed: %s", exc)
+            latencies[info.get("handler", "unhandled")].append(time.perf_counter() - started)
+
+    pool_stats.reset()
+    pool_stats.samples = []
+    sink = open(os.devnull, "w") if not args.verbose else sys.stdout
+    t0 = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(sink):
+            await asyncio.gather(*(drive(items, t0) for items in per_user.values()))
+            await bot_module.fsm_storage.flush()
+    finally:
+        if sink is not sys.stdout:
+            sink.close()
+    wall = time.perf_counter() - t0
+
+    total = sum(len(v) for v in latencies.values())
+    report = {
+        "recording": str(args.recording),
+        "speed": args.speed,
+        "updates": total,
+        "users": len(per_user),
+        "wall_sec": wall,
+        "updates_per_sec": total / wall if wall else 0.0,
+        "db_queries_per_update": pool_stats.queries / total if total else 0.0,
+        "latency_all": percentiles(v for values in latencies.values() for v in values),
+        "handlers": {name: percentiles(values) for name, values in sorted(latencies.items())},
+        "schedule_lag": percentiles(lags),
+        "pool_wait": percentiles(pool_stats.samples),
+        "errors": dict(errors),
+    }
+
+    await bot_module.fsm_storage.close()
+    await close_pool()
+    await bot.session.close()
+    await api.stop()
+    return report
+
+
+def compare(report: dict[str, Any], baseline: dict[str, Any], max_regression: float) -> list[str]:
+    """Печатает разницу с базовым прогоном и возвращает список регрессий."""
+    regressions: list[str] = []
+
+    def line(name: str, cur: dict[str, float], base: dict[str, float]) -> None:
+        cells = []
+        for q in ("p50", "p95", "p99"):
+            delta = cur[q] - base[q]
+            rel = delta / base[q] if base[q] else 0.0
+            cells.append(f"{q} {base[q] * 1000:7.2f}→{cur[q] * 1000:7.2f}ms ({rel:+.0%})")
+        print(f"{name:<32} " + "  ".join(cells))
+        delta95 = cur["p95"] - base["p95"]
+        if base["p95"] and delta95 > NOISE_FLOOR_SEC and delta95 / base["p95"] > max_regression:
+            regressions.append(f"{name}: p95 {base['p95'] * 1000:.2f}ms → {cur['p95'] * 1000:.2f}ms")
+
+    print(f"\nСравнение с базовым прогоном ({baseline.get('recording')}, speed={baseline.get('speed')}):")
+    line("all", report["latency_all"], baseline["latency_all"])
+    for name, stats in report["handlers"].items():
+        base = baseline.get("handlers", {}).get(name)
+        if base and base["count"] and stats["count"]:
+            line(name, stats, base)
+    base_db = baseline.get("db_queries_per_update", 0.0)
+    print(f"{'db round trips/update':<32} {base_db:.2f} → {report['db_queries_per_update']:.2f}")
+    if report["db_queries_per_update"] > base_db * (1 + max_regression) and base_db:
+        regressions.append(f"db round trips/update: {base_db:.2f} → {report['db_queries_per_update']:.2f}")
+    return regressions
+
+
+def main(argv: list[str] | None = None) -> None:
+    args = parse_args(argv)
+    report = asyncio.run(run(args))
+    print(
+        f"updates={report['updates']} users={report['users']} wall={report['wall_sec']:.2f}s "
+        f"throughput={report['updates_per_sec']:.1f} upd/s speed={report['speed']}"
+    )
+    print(f"{'all':<32} {format_ms(report['latency_all'])}")
+    for name, stats in report["handlers"].items():
+        print(f"{name:<32} {format_ms(stats)}")
+    print(f"{'schedule lag':<32} {format_ms(report['schedule_lag'])}")
+    print(f"{'pool wait':<32} {format_ms(report['pool_wait'])}")
+    if report["errors"]:
+        print(f"errors: {report['errors']}")
+
+    if args.save_baseline:
+        args.save_baseline.write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+    if args.baseline:
+        baseline = json.loads(args.baseline.read_text(encoding="utf-8"))
+        regressions = compare(report, baseline, args.max_regression)
+        if regressions:
+            print("\nРЕГРЕССИИ:")
+            for item in regressions:
+                print(f"  {item}")
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+-- Минимальная схема общих таблиц RaketaClean для локальных бенчмарков.
+-- Только для пустой тестовой БД: в бою эти таблицы принадлежат основному стеку.
+
+CREATE TABLE IF NOT EXISTS clients (
+    id SERIAL PRIMARY KEY,
+    full_name TEXT,
+    phone TEXT,
+    phone_digits TEXT,
+    status TEXT,
+    bonus_balance INTEGER NOT NULL DEFAULT 0,
+    total_spent NUMERIC NOT NULL DEFAULT 0,
+    total_bonuses_earned INTEGER NOT NULL DEFAULT 0,
+    total_bonuses_spent INTEGER NOT NULL DEFAULT 0,
+    tg_user_id BIGINT,
+    tg_username TEXT,
+    tg_first_name TEXT,
+    tg_last_name TEXT,
+    last_updated TIMESTAMPTZ,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+CREATE TABLE IF NOT EXISTS orders (
+    id SERIAL PRIMARY KEY,
+    client_id INTEGER REFERENCES clients(id) ON DELETE CASCADE,
+    status TEXT,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+CREATE TABLE IF NOT EXISTS bonus_transactions (
+    id SERIAL PRIMARY KEY,
+    client_id INTEGER REFERENCES clients(id) ON DELETE CASCADE,
+    order_id INTEGER,
+    delta INTEGER NOT NULL,
+    reason TEXT,
+    expires_at TIMESTAMPTZ,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+CREATE TABLE IF NOT EXISTS leads (
+    id SERIAL PRIMARY KEY,
+    name TEXT,
+    phone TEXT,
+    source TEXT,
+    status TEXT,
+    tg_user_id BIGINT,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
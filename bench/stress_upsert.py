@@ -0,0 +1,142 @@
+"""
+Стресс-тест upsert_contact: тысячи одновременных сохранений номера в локальной БД.
+
+Для каждого номера одновременно приходят несколько запросов: кнопка «Поделиться
+номером» и ручной ввод от одного пользователя, плюс другие аккаунты с тем же
+номером. После прогона проверяется, что на номер ровно один клиент, ровно одна
+транзакция bot_signup и баланс равен ONBOARDING_BONUS.
+
+Пример:
+    BENCH_DB_DSN=postgresql://postgres@localhost/bench \\
+        python -m bench.stress_upsert --init-schema --phones 1000 --devices 4
+"""
+import argparse
+import asyncio
+import logging
+import sys
+import time
+from typing import Any
+
+from bench.common import apply_bench_schema, bench_env, format_ms, percentiles
+from bench.updates import BENCH_USER_ID_BASE
+
+STRESS_USER_ID_BASE = BENCH_USER_ID_BASE + 500_000_000
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--phones", type=int, default=1000, help="сколько разных номеров")
+    parser.add_argument("--devices", type=int, default=4, help="одновременных запросов на один номер")
+    parser.add_argument("--concurrency", type=int, default=200, help="одновременных upsert_contact")
+    parser.add_argument("--pool-size", type=int, default=10)
+    parser.add_argument("--min-rate", type=float, default=0.0, help="упасть, если upsert/s ниже")
+    parser.add_argument("--init-schema", action="store_true")
+    return parser.parse_args(argv)
+
+
+def stress_phone(index: int) -> str:
+    return f"98{index:08d}"
+
+
+async def run(args: argparse.Namespace) -> int:
+    dsn = bench_env()
+    if args.init_schema:
+        await apply_bench_schema(dsn)
+
+    import bot as bot_module
+    from aiogram.types import User
+    from app.db import close_pool, get_pool, init_pool
+
+    logging.getLogger().setLevel(logging.WARNING)
+    await init_pool(min_size=1, max_size=args.pool_size)
+    await bot_module.ensure_runtime_schema()
+    phones = [bot_module.normalize_phone(stress_phone(i)) for i in range(args.phones)]
+    async with get_pool().acquire() as conn:
+        await conn.execute("DELETE FROM clients WHERE phone = ANY($1::text[])", phones)
+
+    calls: list[tuple[Any, str]] = []
+    for i in range(args.phones):
+        for device in range(args.devices):
+            # Устройства 0 и 1 — один аккаунт (кнопка и ручной ввод), остальные — чужие аккаунты.
+            account = STRESS_USER_ID_BASE + i * args.devices + (0 if device < 2 else device)
+            user = User(id=account, is_bot=False, first_name=f"Stress{i}")
+            raw = f"+7{stress_phone(i)}" if device % 2 == 0 else stress_phone(i)
+            calls.append((user, raw))
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies: list[float] = []
+    failures: list[str] = []
+
+    async def one(user: Any, raw: str) -> None:
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                await bot_module.upsert_contact(user, raw, user.first_name)
+            except Exception as exc:
+                failures.append(f"{type(exc).__name__}: {exc}")
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(user, raw) for user, raw in calls))
+    wall = time.perf_counter() - started
+    rate = len(calls) / wall if wall else 0.0
+
+    problems: list[str] = []
+    async with get_pool().acquire() as conn:
+        dup_clients = await conn.fetch(
+            """
+            SELECT phone, COUNT(*) AS n FROM clients
+            WHERE phone = ANY($1::text[])
+            GROUP BY phone HAVING COUNT(*) <> 1
+            """,
+            phones,
+        )
+        found = await conn.fetchval("SELECT COUNT(DISTINCT phone) FROM clients WHERE phone = ANY($1::text[])", phones)
+        bad_grants = await conn.fetch(
+            """
+            SELECT c.id, c.phone, c.bonus_balance,
+                   COUNT(bt.id) FILTER (WHERE bt.reason = 'bot_signup') AS grants
+            FROM clients c
+            LEFT JOIN bonus_transactions bt ON bt.client_id = c.id
+            WHERE c.phone = ANY($1::text[])
+            GROUP BY c.id
+            HAVING COUNT(bt.id) FILTER (WHERE bt.reason = 'bot_signup') <> 1
+                OR c.bonus_balance <> $2
+            """,
+            phones,
+            bot_module.ONBOARDING_BONUS,
+        )
+    if found != len(phones):
+        problems.append(f"clients found for {found} of {len(phones)} phones")
+    if dup_clients:
+        problems.append(f"{len(dup_clients)} phones have duplicate clients, e.g. {dict(dup_clients[0])}")
+    if bad_grants:
+        problems.append(f"{len(bad_grants)} clients with wrong signup grants, e.g. {dict(bad_grants[0])}")
+    if failures:
+        problems.append(f"{len(failures)} upserts failed, e.g. {failures[0]}")
+    if args.min_rate and rate < args.min_rate:
+        problems.append(f"throughput {rate:.1f} upsert/s is below --min-rate {args.min_rate}")
+
+    print(
+        f"upserts={len(calls)} phones={args.phones} devices={args.devices} "
+        f"concurrency={args.concurrency} pool={args.pool_size}"
+    )
+    print(f"wall={wall:.2f}s throughput={rate:.1f} upsert/s")
+    print(f"latency  {format_ms(percentiles(latencies))}")
+    await close_pool()
+
+    if problems:
+        print("FAILED:")
+        for problem in problems:
+            print(f"  {problem}")
+        return 1
+    print("OK: one client and one signup grant per phone")
+    return 0
+
+
+def main(argv: list[str] | None = None) -> None:
+    sys.exit(asyncio.run(run(parse_args(argv))))
+
+
+if __name__ == "__main__":
+    main()
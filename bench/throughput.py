@@ -0,0 +1,169 @@
+"""
+Сквозной бенчмарк пропускной способности бота.
+
+Поднимает фейковый Bot API (bench.fake_bot_api), направляет в него сессию бота
+и прогоняет синтетические апдейты через настоящий Dispatcher из bot.py
+с локальным Postgres. Сеть наружу не нужна.
+
+Пример:
+    BENCH_DB_DSN=postgresql://postgres@localhost/bench \\
+        python -m bench.throughput --init-schema --reset --users 200 --concurrency 50
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import sys
+import time
+from collections import defaultdict
+from typing import Any
+
+from bench.common import apply_bench_schema, bench_env, format_ms, percentiles
+from bench.fake_bot_api import FakeBotAPI
+from bench.updates import BENCH_USER_ID_BASE, SCENARIOS, SyntheticUser
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100, help="число виртуальных клиентов")
+    parser.add_argument("--concurrency", type=int, default=50, help="сколько клиентов действуют одновременно")
+    parser.add_argument(
+        "--scenarios",
+        default="menu,question,order,media",
+        help="сценарии после онбординга через запятую: " + ",".join(SCENARIOS),
+    )
+    parser.add_argument("--pool-size", type=int, default=5, help="max_size пула asyncpg (как в main())")
+    parser.add_argument("--api-latency-ms", type=float, default=35.0)
+    parser.add_argument("--api-jitter-ms", type=float, default=15.0)
+    parser.add_argument("--init-schema", action="store_true", help="создать минимальную схему в BENCH_DB_DSN")
+    parser.add_argument("--reset", action="store_true", help="удалить данные прошлых прогонов бенчмарка")
+    parser.add_argument("--json", dest="json_path", help="сохранить отчёт в JSON")
+    parser.add_argument("--verbose", action="store_true", help="не глушить print/logging хэндлеров")
+    return parser.parse_args(argv)
+
+
+async def reset_bench_data(pool) -> None:
+    async with pool.acquire() as conn:
+        await conn.execute("DELETE FROM clients WHERE bot_tg_user_id >= $1", BENCH_USER_ID_BASE)
+        await conn.execute("DELETE FROM leads WHERE tg_user_id >= $1", BENCH_USER_ID_BASE)
+        await conn.execute("DELETE FROM bot_fsm_states WHERE user_id >= $1", BENCH_USER_ID_BASE)
+
+
+async def run(args: argparse.Namespace) -> dict[str, Any]:
+    dsn = bench_env()
+    if args.init_schema:
+        await apply_bench_schema(dsn)
+
+    import bot as bot_module
+    from aiogram.client.telegram import TelegramAPIServer
+    from app.db import close_pool, get_pool, init_pool, pool_stats
+
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    api = FakeBotAPI(latency_ms=args.api_latency_ms, jitter_ms=args.api_jitter_ms)
+    await api.start()
+    bot, dp = bot_module.create_app()
+    bot.session.api = TelegramAPIServer.from_base(api.base_url)
+
+    await init_pool(min_size=1, max_size=args.pool_size)
+    await bot_module.ensure_runtime_schema()
+    if args.reset:
+        await reset_bench_data(get_pool())
+    bot_module.fsm_storage.start()
+
+    scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = [s for s in scenarios if s not in SCENARIOS]
+    if unknown:
+        raise SystemExit(f"Unknown scenarios: {', '.join(unknown)}")
+    plan = ["onboarding", *scenarios]
+
+    latencies: dict[str, list[float]] = defaultdict(list)
+    errors: dict[str, int] = defaultdict(int)
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def drive(user: SyntheticUser) -> None:
+        async with semaphore:
+            # Апдейты одного клиента идут строго по очереди, как из Telegram.
+            for scenario in plan:
+                for update in SCENARIOS[scenario](user):
+                    started = time.perf_counter()
+                    try:
+                        await dp.feed_raw_update(bot, update)
+                    except Exception as exc:
+                        errors[scenario] += 1
+                        if args.verbose:
+                            logging.exception("Update failed in %s: %s", scenario, exc)
+                    latencies[scenario].append(time.perf_counter() - started)
+
+    users = [SyntheticUser(i) for i in range(args.users)]
+    pool_stats.reset()
+    pool_stats.samples = []
+    api.calls.clear()
+
+    sink = open(os.devnull, "w") if not args.verbose else sys.stdout
+    started = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(sink):
+            await asyncio.gather(*(drive(u) for u in users))
+            await bot_module.fsm_storage.flush()
+    finally:
+        if sink is not sys.stdout:
+            sink.close()
+    wall = time.perf_counter() - started
+
+    total_updates = sum(len(v) for v in latencies.values())
+    report: dict[str, Any] = {
+        "users": args.users,
+        "concurrency": args.concurrency,
+        "pool_size": args.pool_size,
+        "api_latency_ms": args.api_latency_ms,
+        "wall_sec": wall,
+        "updates": total_updates,
+        "updates_per_sec": total_updates / wall if wall else 0.0,
+        "db_queries": pool_stats.queries,
+        "db_queries_per_update": pool_stats.queries / total_updates if total_updates else 0.0,
+        "api_calls": dict(api.calls),
+        "api_calls_per_update": sum(api.calls.values()) / total_updates if total_updates else 0.0,
+        "errors": dict(errors),
+        "latency": {name: percentiles(values) for name, values in latencies.items()},
+        "latency_all": percentiles(v for values in latencies.values() for v in values),
+        "pool_wait": percentiles(pool_stats.samples),
+    }
+
+    await bot_module.fsm_storage.close()
+    await close_pool()
+    await bot.session.close()
+    await api.stop()
+    return report
+
+
+def print_report(report: dict[str, Any]) -> None:
+    print(
+        f"updates={report['updates']} wall={report['wall_sec']:.2f}s "
+        f"throughput={report['updates_per_sec']:.1f} upd/s "
+        f"(users={report['users']}, concurrency={report['concurrency']}, pool={report['pool_size']})"
+    )
+    print(f"db round trips/update: {report['db_queries_per_update']:.2f}  "
+          f"bot api calls/update: {report['api_calls_per_update']:.2f}")
+    print(f"{'all':<12} {format_ms(report['latency_all'])}")
+    for name, stats in report["latency"].items():
+        print(f"{name:<12} {format_ms(stats)}")
+    print(f"{'pool wait':<12} {format_ms(report['pool_wait'])}")
+    if report["errors"]:
+        print(f"errors: {report['errors']}")
+
+
+def main(argv: list[str] | None = None) -> None:
+    args = parse_args(argv)
+    report = asyncio.run(run(args))
+    print_report(report)
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as fh:
+            json.dump(report, fh, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
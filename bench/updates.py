@@ -0,0 +1,103 @@
+"""Генератор синтетических апдейтов Telegram для бенчмарков."""
+import itertools
+import time
+from typing import Any, Callable
+
+BENCH_USER_ID_BASE = 7_000_000_000
+
+_update_ids = itertools.count(1)
+_message_ids = itertools.count(1)
+
+
+class SyntheticUser:
+    """Виртуальный клиент: собирает апдейты от своего имени."""
+
+    def __init__(self, index: int) -> None:
+        self.id = BENCH_USER_ID_BASE + index
+        self.first_name = f"Bench{index}"
+        # 10 цифр, начинается с 9 — как при ручном вводе номера
+        self.phone = f"9{index:09d}"
+
+    def _user(self) -> dict[str, Any]:
+        return {"id": self.id, "is_bot": False, "first_name": self.first_name, "language_code": "ru"}
+
+    def _message(self, **fields: Any) -> dict[str, Any]:
+        message = {
+            "message_id": next(_message_ids),
+            "date": int(time.time()),
+            "chat": {"id": self.id, "type": "private", "first_name": self.first_name},
+            "from": self._user(),
+        }
+        message.update(fields)
+        return {"update_id": next(_update_ids), "message": message}
+
+    def text(self, text: str) -> dict[str, Any]:
+        fields: dict[str, Any] = {"text": text}
+        if text.startswith("/"):
+            command = text.split()[0]
+            fields["entities"] = [{"type": "bot_command", "offset": 0, "length": len(command)}]
+        return self._message(**fields)
+
+    def contact(self) -> dict[str, Any]:
+        return self._message(
+            contact={
+                "phone_number": f"+7{self.phone}",
+                "first_name": self.first_name,
+                "user_id": self.id,
+            }
+        )
+
+    def photo(self, media_group_id: str | None = None, caption: str | None = None) -> dict[str, Any]:
+        file_id = f"AgACAgIAAxkBAAI{next(_message_ids):012d}"
+        fields: dict[str, Any] = {
+            "photo": [
+                {"file_id": file_id + "s", "file_unique_id": file_id[-12:] + "s", "width": 90, "height": 67},
+                {"file_id": file_id, "file_unique_id": file_id[-12:], "width": 1280, "height": 960},
+            ]
+        }
+        if media_group_id:
+            fields["media_group_id"] = media_group_id
+        if caption:
+            fields["caption"] = caption
+        return self._message(**fields)
+
+
+def onboarding(user: SyntheticUser) -> list[dict[str, Any]]:
+    return [user.text("/start"), user.contact(), user.text("Мои бонусы")]
+
+
+def menu(user: SyntheticUser) -> list[dict[str, Any]]:
+    return [
+        user.text("💰 Прайс"),
+        user.text("🕐 Режим работы"),
+        user.text("Мои бонусы"),
+        user.text("/info"),
+    ]
+
+
+def question(user: SyntheticUser) -> list[dict[str, Any]]:
+    return [user.text("Задать вопрос"), user.text("Сколько стоит химчистка углового дивана?")]
+
+
+def order(user: SyntheticUser) -> list[dict[str, Any]]:
+    return [user.text("Сделать заказ"), user.text("Нужна химчистка ковра 2x3 в субботу")]
+
+
+def media(user: SyntheticUser) -> list[dict[str, Any]]:
+    group = f"mg{user.id}{next(_message_ids)}"
+    return [
+        user.text("Отправить фото/видео"),
+        user.photo(group, caption="Пятно на диване"),
+        user.photo(group),
+        user.photo(group),
+        user.text("Закрыть"),
+    ]
+
+
+SCENARIOS: dict[str, Callable[[SyntheticUser], list[dict[str, Any]]]] = {
+    "onboarding": onboarding,
+    "menu": menu,
+    "question": question,
+    "order": order,
+    "media": media,
+}
@@ -4,6 +4,8 @@ import os
 import re
 import socket
 import time as monotonic_time
+from contextvars import ContextVar
+from pathlib import Path
 from datetime import datetime, timedelta, timezone, date
 from zoneinfo import ZoneInfo
 from typing import Any, Optional, Tuple
@@ -11,20 +13,20 @@ from typing import Any, Optional, Tuple
 import asyncpg
 from aiohttp.abc import AbstractResolver
 from aiohttp.resolver import DefaultResolver
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from apscheduler.triggers.cron import CronTrigger
-from aiogram import Bot, Dispatcher, F
+from aiogram import Bot, Dispatcher, F, Router
 from aiogram.client.default import DefaultBotProperties
 from aiogram.client.session.aiohttp import AiohttpSession
-from aiogram.enums import ChatMemberStatus, ChatType, ParseMode
-from aiogram.exceptions import TelegramBadRequest
-from aiogram.filters import Command, CommandStart, StateFilter
+from aiogram.enums import ChatAction, ChatMemberStatus, ChatType, ParseMode
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
+from aiogram.filters import Command, CommandObject, CommandStart, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram import BaseMiddleware
 from aiogram.types import (
     BotCommand,
+    CallbackQuery,
     ChatMemberUpdated,
+    FSInputFile,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
     KeyboardButton,
@@ -36,20 +38,59 @@ from aiogram.types import (
 )
 from dotenv import load_dotenv
 
-from app.db import close_pool, get_pool, init_pool
+from app.bonus_ledger import (
+    MOSCOW_TZ,
+    alive_expiry,
+    apply_bonus_transaction,
+    count_bonus_history,
+    ensure_bonus_ledger_schema,
+    fetch_bonus_history_page,
+    fetch_ledger,
+    load_buckets,
+    reconcile_bonus_ledger,
+)
+from app.bonus_reminders import ensure_bonus_reminder_schema, send_bonus_expiry_reminders
+from app.bot_routes import ChatRoutes, ensure_bot_routes_schema
+from app.config import BotConfig, load_configs
+from app.crm_forward import CRM_FORWARD_ENABLED, CrmExporter, ensure_crm_outbox_schema
+from app.crm_webhook import CRM_WEBHOOK_SECRET, CrmReplyRelay, ensure_crm_inbox_schema
+from app.dedup import merge_clients
+from app.db import (
+    DatabaseUnavailable,
+    acquire,
+    batch_connection,
+    close_pool,
+    db_breaker,
+    get_pool,
+    init_pool,
+    is_db_unavailable_error,
+    pool_stats,
+    warm_pool,
+)
+from app.export import EXPORT_MAX_BYTES, ExportFilters, export_clients_csv, parse_export_args
+from app.fsm_storage import PgFSMStorage, ensure_fsm_storage_schema
+from app.journal import ensure_write_journal_schema, write_journal
+from app.order_push import ORDER_PUSH_ENABLED, OrderStatusListener, client_chat_cache
+from app.phone_backfill import backfill_missing_phone_digits
+from app.phones import normalize_phone, normalize_phone_digits
+from app.recipients import SEND_RETRY_AFTER, SEND_UNREACHABLE, BlockedChats, classify_send_error, failed_chat_id
+from app.recorder import UPDATE_RECORD_PATH, UpdateRecorder
+from app.sender import RateLimitedSender
+from app.startup import Startup
+from app.stats import backfill_stats, bump_stats, ensure_stats_schema, format_stats, read_stats
+from app.templates import BotTexts, TemplateSession, frozen
+from app.throttle import THROTTLE_BUDGETS, LoadShedder, SlidingWindowLimiter, ThrottleMiddleware, deferrable
+from app.known_leads import known_leads
+from app.menu import MenuButtonFilter, MenuTable
+from app.liveness import LIVENESS_TICK_MIN, ensure_liveness_schema, sweep_liveness
+from app.leader import LeaderElector, ensure_job_runs_schema, prune_job_runs
 
 load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-TOKEN = os.getenv("BOT_TOKEN")
-if not TOKEN:
-    raise RuntimeError("BOT_TOKEN is not set")
-
-LOGS_CHAT_ID = int(os.getenv("LOGS_CHAT_ID", "0") or "0")
-ids_str = os.getenv("ADMIN_TG_IDS", "")
-ADMIN_TG_IDS = tuple(int(x) for x in ids_str.split()) if ids_str else ()
 ONBOARDING_BONUS = int(os.getenv("ONBOARDING_BONUS", "300") or "300")
+BONUS_HISTORY_PAGE_SIZE = int(os.getenv("BONUS_HISTORY_PAGE_SIZE", "8") or "8")
 TELEGRAM_PROXY_URL = (os.getenv("TELEGRAM_PROXY_URL") or "").strip()
 TELEGRAM_API_IP = (os.getenv("TELEGRAM_API_IP") or "").strip()
 TELEGRAM_API_IPS_RAW = (
@@ -58,10 +99,6 @@ TELEGRAM_API_IPS_RAW = (
 ).strip()
 TELEGRAM_IP_PROBE_TIMEOUT_SEC = float(os.getenv("TELEGRAM_IP_PROBE_TIMEOUT_SEC", "1.5") or "1.5")
 TELEGRAM_IP_RECHECK_SEC = float(os.getenv("TELEGRAM_IP_RECHECK_SEC", "30") or "30")
-CLIENT_BOT_HEALTH_SERVICE_KEY = (os.getenv("CLIENT_BOT_HEALTH_SERVICE_KEY") or "telegram-bot-client").strip()
-CLIENT_BOT_HEALTH_DISPLAY_NAME = (
-    os.getenv("CLIENT_BOT_HEALTH_DISPLAY_NAME") or "Клиентский Telegram бот"
-).strip()
 CLIENT_BOT_HEARTBEAT_INTERVAL_SEC = int(os.getenv("CLIENT_BOT_HEARTBEAT_INTERVAL_SEC", "60") or "60")
 CLIENT_BOT_HEALTH_PROBE_TIMEOUT_SEC = float(
     os.getenv("CLIENT_BOT_HEALTH_PROBE_TIMEOUT_SEC", "10") or "10"
@@ -169,7 +206,7 @@ class _TelegramIPFallbackResolver(AbstractResolver):
 
 
 def _build_telegram_session() -> AiohttpSession:
-    session = AiohttpSession(proxy=TELEGRAM_PROXY_URL or None)
+    session = TemplateSession(proxy=TELEGRAM_PROXY_URL or None)
     if TELEGRAM_API_IP_POOL:
         # Probe known Telegram API IPs so polling can survive a bad DNS answer on this host.
         session._connector_init["resolver"] = _TelegramIPFallbackResolver(TELEGRAM_API_IP_POOL)
@@ -177,16 +214,41 @@ def _build_telegram_session() -> AiohttpSession:
     return session
 
 
-def _make_telegram_bot(token: str) -> Bot:
+def _make_telegram_bot(token: str, session: Optional[AiohttpSession] = None) -> Bot:
     return Bot(
         token,
-        session=_build_telegram_session(),
+        session=session or _build_telegram_session(),
         default=DefaultBotProperties(parse_mode=ParseMode.HTML),
     )
 
 
-bot = _make_telegram_bot(TOKEN)
-dp = Dispatcher()
+# Bot и Dispatcher собирает create_app(): импорт модуля не требует токена и не
+# открывает сессий. Хэндлеры регистрируются на router.
+# bot — основной бот; все боты процесса (BOT_TOKENS) — в bots, их настройки — в bot_configs.
+bot: Optional[Bot] = None
+dp: Optional[Dispatcher] = None
+bots: dict[int, Bot] = {}
+bot_configs: dict[int, BotConfig] = {}
+router = Router(name="client")
+fsm_storage = PgFSMStorage()
+# Через какого бота писать клиенту вне обработки его апдейта
+chat_routes = ChatRoutes()
+# Бот, чей апдейт сейчас обрабатывается (ставит BotContextMiddleware)
+_current_bot: ContextVar[Optional[Bot]] = ContextVar("current_bot", default=None)
+
+
+def current_bot() -> Bot:
+    """Бот текущего апдейта, а вне апдейта (фоновые задачи) — основной."""
+    return _current_bot.get() or bot
+
+
+def current_config() -> BotConfig:
+    return bot_configs[current_bot().id]
+
+
+def bot_for_chat(chat_id: int) -> Bot:
+    """Бот, с которым клиент общался последним."""
+    return bots.get(chat_routes.bot_id_for(chat_id)) or bot
 
 BTN_BONUS = "Мои бонусы"
 BTN_ORDER = "Сделать заказ"
@@ -209,6 +271,8 @@ MENU_BUTTONS = [
     BTN_PRICE,
     BTN_SCHEDULE,
 ]
+# Таблица маршрутизации кнопок: общая для menu_router и is_menu_button
+MENU_TABLE = MenuTable(MENU_BUTTONS)
 
 
 class ClientRequestFSM(StatesGroup):
@@ -226,37 +290,59 @@ def is_admin(user_id: Optional[int]) -> bool:
     """Проверяет, является ли пользователь админом."""
     if user_id is None:
         return False
-    return user_id in ADMIN_TG_IDS
+    return user_id in current_config().admin_ids
 
 
-def main_menu(require_contact: bool, user_id: Optional[int] = None) -> Optional[ReplyKeyboardMarkup]:
-    """
-    Возвращает клавиатуру главного меню или None для админов.
-    Админам клавиатура не показывается.
-    """
-    # Админам не показываем клавиатуру
-    if user_id is not None and is_admin(user_id):
-        return None
-    
-    if require_contact:
-        rows = [
+# Клавиатуры одинаковы для всех клиентов: строим один раз, JSON кэширует TemplateSession.
+# Кнопку "Отмена" не показываем в главном меню - мы и так в главном меню
+MAIN_MENU_CONTACT_KEYBOARD = frozen(
+    ReplyKeyboardMarkup(
+        keyboard=[
             [KeyboardButton(text=BTN_SHARE_CONTACT, request_contact=True)],
             [KeyboardButton(text=BTN_PRICE), KeyboardButton(text=BTN_SCHEDULE)],
-        ]
-    else:
-        # Когда номер уже указан, кнопку "Поделиться номером" не показываем
-        rows = [
+        ],
+        resize_keyboard=True,
+        input_field_placeholder="Выберите действие",
+    )
+)
+# Когда номер уже указан, кнопку "Поделиться номером" не показываем
+MAIN_MENU_KEYBOARD = frozen(
+    ReplyKeyboardMarkup(
+        keyboard=[
             [KeyboardButton(text=BTN_BONUS)],
             [KeyboardButton(text=BTN_ORDER), KeyboardButton(text=BTN_QUESTION)],
             [KeyboardButton(text=BTN_MEDIA)],
             [KeyboardButton(text=BTN_PRICE), KeyboardButton(text=BTN_SCHEDULE)],
-        ]
-    # Кнопку "Отмена" не показываем в главном меню - мы и так в главном меню
-    return ReplyKeyboardMarkup(
-        keyboard=rows,
+        ],
         resize_keyboard=True,
         input_field_placeholder="Выберите действие",
     )
+)
+CONTACT_KEYBOARD = frozen(
+    ReplyKeyboardMarkup(
+        keyboard=[
+            [KeyboardButton(text=BTN_SHARE_CONTACT, request_contact=True)],
+            [KeyboardButton(text=BTN_CANCEL)],
+        ],
+        resize_keyboard=True,
+        input_field_placeholder="Нажмите, чтобы поделиться номером",
+    )
+)
+CANCEL_KEYBOARD = frozen(ReplyKeyboardMarkup(keyboard=[[KeyboardButton(text=BTN_CANCEL)]], resize_keyboard=True))
+CLOSE_KEYBOARD = frozen(ReplyKeyboardMarkup(keyboard=[[KeyboardButton(text=BTN_CLOSE)]], resize_keyboard=True))
+# Тексты «Прайс» и «Режим работы» — из BOT_TEXTS_PATH, меняются без перезапуска
+bot_texts = BotTexts()
+
+
+def main_menu(require_contact: bool, user_id: Optional[int] = None) -> Optional[ReplyKeyboardMarkup]:
+    """
+    Возвращает клавиатуру главного меню или None для админов.
+    Админам клавиатура не показывается.
+    """
+    # Админам не показываем клавиатуру
+    if user_id is not None and is_admin(user_id):
+        return None
+    return MAIN_MENU_CONTACT_KEYBOARD if require_contact else MAIN_MENU_KEYBOARD
 
 
 def contact_keyboard(user_id: Optional[int] = None) -> Optional[ReplyKeyboardMarkup]:
@@ -267,53 +353,78 @@ def contact_keyboard(user_id: Optional[int] = None) -> Optional[ReplyKeyboardMar
     # Админам не показываем клавиатуру
     if user_id is not None and is_admin(user_id):
         return None
-    
-    return ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text=BTN_SHARE_CONTACT, request_contact=True)],
-            [KeyboardButton(text=BTN_CANCEL)],
-        ],
-        resize_keyboard=True,
-        input_field_placeholder="Нажмите, чтобы поделиться номером",
-    )
+    return CONTACT_KEYBOARD
 
 
-async def safe_send_message(chat_id: int, text: str, **kwargs) -> Optional[Message]:
+async def safe_send_message(
+    chat_id: int, text: str, *, raise_retry_after: bool = False, **kwargs
+) -> Optional[Message]:
     """
     Безопасная отправка сообщения с автоматической обработкой отписки.
     Возвращает Message при успехе, None при ошибке (включая блокировку бота).
+    В известные недоступные чаты не отправляет вовсе.
+    raise_retry_after=True пропускает 429 наружу — для RateLimitedSender.
     """
+    if chat_id in blocked_chats:
+        blocked_chats.short_circuited += 1
+        return None
     try:
-        return await bot.send_message(chat_id, text, **kwargs)
-    except TelegramBadRequest as e:
-        error_codes = {
-            "bot_blocked_by_user",
-            "user_is_deleted",
-            "chat_not_found",
-        }
-        if any(code in str(e).lower() for code in error_codes):
-            await mark_client_unsubscribed(chat_id)
-            logging.warning(f"Не удалось отправить сообщение пользователю {chat_id}: {e}")
-            return None
-        raise
+        return await bot_for_chat(chat_id).send_message(chat_id, text, **kwargs)
     except Exception as e:
+        kind = classify_send_error(e)
+        if kind == SEND_RETRY_AFTER:
+            if raise_retry_after:
+                raise
+            logging.warning(f"Telegram просит подождать, сообщение пользователю {chat_id} не отправлено")
+            return None
+        if kind == SEND_UNREACHABLE:
+            # Отметка в clients уйдёт пачкой из blocked_chats
+            if blocked_chats.add(chat_id):
+                logging.warning(f"Не удалось отправить сообщение пользователю {chat_id}: {e}")
+            return None
+        if isinstance(e, TelegramBadRequest):
+            raise
         logging.error(f"Ошибка при отправке сообщения пользователю {chat_id}: {e}")
         return None
 
 
+async def _send_outbound(chat_id: int, text: str, **kwargs) -> Optional[Message]:
+    return await safe_send_message(chat_id, text, raise_retry_after=True, **kwargs)
+
+
+async def _send_or_raise(chat_id: int, text: str, **kwargs) -> Optional[Message]:
+    """Для отправок с повтором: недоступный чат — None, остальные ошибки — наружу."""
+    if chat_id in blocked_chats:
+        return None
+    try:
+        return await bot_for_chat(chat_id).send_message(chat_id, text, **kwargs)
+    except Exception as e:
+        if classify_send_error(e) == SEND_UNREACHABLE:
+            blocked_chats.add(chat_id)
+            return None
+        raise
+
+
+# Массовые и фоновые рассылки идут через общий ограничитель скорости
+outbound = RateLimitedSender(_send_outbound)
+# Перегрузка: пул соединений не успевает или копится очередь исходящих
+load_shed = LoadShedder(pool_stats, lambda: outbound.pending)
+
+
 async def notify_admins(text: str) -> None:
-    print(f"[NOTIFY_ADMINS] Вызван. ADMIN_TG_IDS: {ADMIN_TG_IDS}, количество админов: {len(ADMIN_TG_IDS)}")
+    admin_ids = current_config().admin_ids
+    print(f"[NOTIFY_ADMINS] Вызван. ADMIN_TG_IDS: {admin_ids}, количество админов: {len(admin_ids)}")
     print(f"[NOTIFY_ADMINS] Текст сообщения: {text[:100]}...")
-    logging.info(f"notify_admins вызван. ADMIN_TG_IDS: {ADMIN_TG_IDS}, количество админов: {len(ADMIN_TG_IDS)}")
-    if not ADMIN_TG_IDS:
+    logging.info(f"notify_admins вызван. ADMIN_TG_IDS: {admin_ids}, количество админов: {len(admin_ids)}")
+    if not admin_ids:
         print("[NOTIFY_ADMINS] ADMIN_TG_IDS пуст! Сообщение не будет отправлено никому.")
         logging.warning("ADMIN_TG_IDS пуст! Сообщение не будет отправлено никому.")
         return
-    for admin_id in ADMIN_TG_IDS:
+    for admin_id in admin_ids:
         try:
             print(f"[NOTIFY_ADMINS] Отправка сообщения админу {admin_id}")
             logging.info(f"Отправка сообщения админу {admin_id}")
-            await bot.send_message(admin_id, text)
+            await current_bot().send_message(admin_id, text)
             print(f"[NOTIFY_ADMINS] Сообщение успешно отправлено админу {admin_id}")
             logging.info(f"Сообщение успешно отправлено админу {admin_id}")
         except Exception as exc:
@@ -416,7 +527,9 @@ def _health_error_text(exc: Exception) -> str:
     return f"{type(exc).__name__}: {exc}"
 
 
-async def _write_client_bot_health(*, status: str, last_error: Optional[str], mark_ok: bool) -> None:
+async def _write_client_bot_health(
+    config: BotConfig, *, status: str, last_error: Optional[str], mark_ok: bool
+) -> None:
     pool = get_pool()
     async with pool.acquire() as conn:
         await conn.execute(
@@ -452,33 +565,55 @@ async def _write_client_bot_health(*, status: str, last_error: Optional[str], ma
                 last_error = EXCLUDED.last_error,
                 updated_at = NOW()
             """,
-            CLIENT_BOT_HEALTH_SERVICE_KEY,
-            CLIENT_BOT_HEALTH_DISPLAY_NAME,
+            config.health_service_key,
+            config.health_display_name,
             status,
             mark_ok,
             last_error,
         )
 
 
-async def heartbeat_client_bot() -> None:
+async def _heartbeat_one(telegram_bot: Bot) -> None:
+    config = bot_configs[telegram_bot.id]
     try:
-        await asyncio.wait_for(bot.get_me(), timeout=CLIENT_BOT_HEALTH_PROBE_TIMEOUT_SEC)
+        await asyncio.wait_for(telegram_bot.get_me(), timeout=CLIENT_BOT_HEALTH_PROBE_TIMEOUT_SEC)
     except Exception as exc:
         error_text = _health_error_text(exc)
-        await _write_client_bot_health(status="error", last_error=error_text[:1000], mark_ok=False)
-        logging.warning("Client bot heartbeat failed: %s", error_text)
+        await _write_client_bot_health(config, status="error", last_error=error_text[:1000], mark_ok=False)
+        logging.warning("Client bot heartbeat failed (%s): %s", config.health_service_key, error_text)
         return
 
-    await _write_client_bot_health(status="ok", last_error=None, mark_ok=True)
+    await _write_client_bot_health(config, status="ok", last_error=None, mark_ok=True)
+
+
+async def heartbeat_client_bot() -> None:
+    """Heartbeat каждого бота процесса — своей строкой service_heartbeats."""
+    await asyncio.gather(*(_heartbeat_one(telegram_bot) for telegram_bot in bots.values()))
 
 
 async def get_bonus_info(conn: asyncpg.Connection, client_id: int) -> Tuple[int, Optional[datetime]]:
-    """Получает баланс бонусов и срок действия новых бонусов за подписку."""
-    balance = await conn.fetchval(
-        "SELECT bonus_balance FROM clients WHERE id=$1",
-        client_id
-    ) or 0
-    
+    """Получает баланс бонусов и ближайшую дату их сгорания."""
+    # Баланс — всегда clients.bonus_balance: его меняют и другие сервисы, а проекцию
+    # client_bonus_ledger ведёт только бот. Из проекции берём лишь корзины сгорания.
+    row = await conn.fetchrow(
+        """
+        SELECT c.bonus_balance, l.buckets
+        FROM clients c
+        LEFT JOIN client_bonus_ledger l ON l.client_id = c.id
+        WHERE c.id = $1
+        """,
+        client_id,
+    )
+    balance = int(row["bonus_balance"] or 0) if row is not None else 0
+    if row is not None and row["buckets"] is not None:
+        if balance <= 0:
+            return balance, None
+        next_day, _ = alive_expiry(load_buckets(row["buckets"]), datetime.now(MOSCOW_TZ).date())
+        if next_day is None:
+            return balance, None
+        return balance, datetime.combine(next_day, datetime.min.time(), tzinfo=MOSCOW_TZ)
+
+    # Проекции для клиента ещё нет (не пересобрана после деплоя)
     # Находим срок действия бонусов за подписку (последняя транзакция с expires_at)
     expires_at = await conn.fetchval(
         """
@@ -511,8 +646,6 @@ async def send_bonus_message(client: asyncpg.Record, user: User) -> None:
         if expires_at.tzinfo is None:
             expires_at = expires_at.replace(tzinfo=timezone.utc)
         # Конвертируем в МСК для отображения
-        from zoneinfo import ZoneInfo
-        MOSCOW_TZ = ZoneInfo("Europe/Moscow")
         expires_local = expires_at.astimezone(MOSCOW_TZ)
         expires_str = expires_local.strftime("%d.%m.%Y")
         lines.append(f"Срок действия новых бонусов: до {expires_str}")
@@ -531,7 +664,8 @@ async def send_bonus_message(client: asyncpg.Record, user: User) -> None:
 
 async def log_signup(client: asyncpg.Record, user: User, was_new: bool = False) -> None:
     """Логирует нового подписчика в чат после получения телефона."""
-    if LOGS_CHAT_ID == 0:
+    logs_chat_id = current_config().logs_chat_id
+    if logs_chat_id == 0:
         return
     username = f"@{user.username}" if user.username else "—"
     phone = client.get("phone") or "не указан"
@@ -546,24 +680,11 @@ async def log_signup(client: asyncpg.Record, user: User, was_new: bool = False)
         f"✅ бонус {ONBOARDING_BONUS} начислен{status_note}"
     )
     try:
-        await bot.send_message(LOGS_CHAT_ID, text)
+        await current_bot().send_message(logs_chat_id, text)
     except Exception as exc:
         logging.warning("Не удалось отправить лог о подписчике: %s", exc)
 
 
-def normalize_phone(raw: str) -> str:
-    digits = re.sub(r"\D", "", raw or "")
-    if len(digits) == 11 and digits.startswith("8"):
-        digits = "7" + digits[1:]
-    if len(digits) == 10 and digits.startswith("9"):
-        digits = "7" + digits
-    if digits.startswith("7") and len(digits) == 11:
-        return f"+{digits}"
-    if raw.startswith("+"):
-        return raw.strip()
-    return raw.strip()
-
-
 _CLIENTS_NAME_COLUMN: str | None = None
 _CLIENTS_COLUMNS: set[str] | None = None
 
@@ -630,15 +751,6 @@ async def _clients_name_column(conn: asyncpg.Connection) -> str:
     raise RuntimeError("clients table has neither 'name' nor 'full_name' column")
 
 
-def normalize_phone_digits(raw: str) -> str:
-    digits = re.sub(r"\D", "", raw or "")
-    if len(digits) == 11 and digits.startswith("8"):
-        digits = "7" + digits[1:]
-    if len(digits) == 10 and digits.startswith("9"):
-        digits = "7" + digits
-    return digits
-
-
 async def _update_client_tg_fields(conn: asyncpg.Connection, client_id: int, user: User) -> asyncpg.Record:
     """
     Best-effort update of telegram identity fields on clients table, if those columns exist.
@@ -687,29 +799,6 @@ async def _update_client_tg_fields(conn: asyncpg.Connection, client_id: int, use
     return row
 
 
-async def merge_clients(conn: asyncpg.Connection, keep_id: int, drop_id: int) -> None:
-    await conn.execute("UPDATE orders SET client_id=$1 WHERE client_id=$2", keep_id, drop_id)
-    await conn.execute(
-        "UPDATE bonus_transactions SET client_id=$1 WHERE client_id=$2",
-        keep_id,
-        drop_id,
-    )
-    await conn.execute(
-        """
-        UPDATE clients target
-        SET bonus_balance = target.bonus_balance + source.bonus_balance,
-            total_spent = target.total_spent + source.total_spent,
-            total_bonuses_earned = target.total_bonuses_earned + source.total_bonuses_earned,
-            total_bonuses_spent = target.total_bonuses_spent + source.total_bonuses_spent
-        FROM clients source
-        WHERE target.id=$1 AND source.id=$2
-        """,
-        keep_id,
-        drop_id,
-    )
-    await conn.execute("DELETE FROM clients WHERE id=$1", drop_id)
-
-
 async def get_client_by_tg(user_id: int) -> Optional[asyncpg.Record]:
     pool = get_pool()
     async with pool.acquire() as conn:
@@ -722,20 +811,29 @@ async def _grant_signup_bonus_if_needed(conn: asyncpg.Connection, client_id: int
     Начисляет бонусы только если их еще не начисляли.
     Возвращает True если бонусы были начислены, False если уже были.
     """
-    # Проверяем, начислялись ли уже бонусы за подписку
-    existing_signup_bonus = await conn.fetchval(
+    # Проверка и вставка одним запросом. NOT EXISTS отсекает повторное начисление,
+    # а уникальный индекс bonus_transactions_bot_signup_once (миграция 0004) —
+    # гонку двух одновременных транзакций: вторая упрётся в ON CONFLICT DO NOTHING.
+    expires_at = datetime.now(timezone.utc) + timedelta(days=30)
+    inserted = await conn.fetchval(
         """
-        SELECT COUNT(*) FROM bonus_transactions
-        WHERE client_id = $1 AND reason = 'bot_signup'
+        INSERT INTO bonus_transactions(client_id, order_id, delta, reason, expires_at)
+        SELECT $1, NULL, $2, 'bot_signup', $3
+        WHERE NOT EXISTS (
+            SELECT 1 FROM bonus_transactions
+            WHERE client_id = $1 AND reason = 'bot_signup'
+        )
+        ON CONFLICT DO NOTHING
+        RETURNING id
         """,
-        client_id
+        client_id,
+        ONBOARDING_BONUS,
+        expires_at,
     )
-    
-    if existing_signup_bonus > 0:
+    if inserted is None:
         return False  # Бонусы уже начислены
     
-    # Начисляем бонусы
-    expires_at = datetime.now(timezone.utc) + timedelta(days=30)
+    await apply_bonus_transaction(conn, client_id, ONBOARDING_BONUS, expires_at, inserted)
     await conn.execute(
         """
         UPDATE clients
@@ -746,19 +844,16 @@ async def _grant_signup_bonus_if_needed(conn: asyncpg.Connection, client_id: int
         ONBOARDING_BONUS,
         client_id,
     )
-    await conn.execute(
-        """
-        INSERT INTO bonus_transactions(client_id, order_id, delta, reason, expires_at)
-        VALUES ($1, NULL, $2, 'bot_signup', $3)
-        """,
-        client_id,
-        ONBOARDING_BONUS,
-        expires_at,
-    )
+    await bump_stats(conn, signups=1, bonus_granted=ONBOARDING_BONUS)
     return True  # Бонусы начислены
 
 
-async def upsert_contact(user: User, phone_raw: str, name: Optional[str]) -> Tuple[asyncpg.Record, bool]:
+async def upsert_contact(
+    user: User,
+    phone_raw: str,
+    name: Optional[str],
+    conn: Optional[asyncpg.Connection] = None,
+) -> Tuple[asyncpg.Record, bool]:
     """
     Универсальная функция обработки получения телефона от пользователя.
     
@@ -771,9 +866,16 @@ async def upsert_contact(user: User, phone_raw: str, name: Optional[str]) -> Tup
     """
     phone = normalize_phone(phone_raw)
     phone_digits = normalize_phone_digits(phone)
-    pool = get_pool()
-    async with pool.acquire() as conn:
+    # Клиент пишет боту — значит, снова доступен (bot_started ниже станет true)
+    blocked_chats.discard(user.id)
+    async with acquire(conn) as conn:
         async with conn.transaction():
+            # Сериализуем обработку одного номера: иначе два одновременных запроса
+            # (кнопка + ручной ввод, два устройства) оба не найдут клиента и создадут дубль.
+            await conn.execute(
+                "SELECT pg_advisory_xact_lock(hashtext('client_phone:' || $1))",
+                phone_digits or phone,
+            )
             cols = await _clients_columns(conn)
             
             # Ищем клиента ТОЛЬКО по номеру телефона
@@ -793,6 +895,7 @@ async def upsert_contact(user: User, phone_raw: str, name: Optional[str]) -> Tup
             if client:
                 # Клиент найден по номеру телефона
                 client_id = client["id"]
+                was_started = bool(client.get("bot_started"))
                 
                 # Начисляем бонусы за подписку (если еще не начисляли)
                 await _grant_signup_bonus_if_needed(conn, client_id)
@@ -814,6 +917,8 @@ async def upsert_contact(user: User, phone_raw: str, name: Optional[str]) -> Tup
                 
                 sql = "UPDATE clients SET " + ", ".join(updates) + " WHERE id=$1 RETURNING *"
                 client = await conn.fetchrow(sql, *params)
+                if not was_started:
+                    await bump_stats(conn, subscribed=1, active=1)
                 if client:
                     try:
                         # Обновляем TG поля (username и другие)
@@ -838,51 +943,86 @@ async def upsert_contact(user: User, phone_raw: str, name: Optional[str]) -> Tup
                     columns += ", tg_user_id"
                     values += ", $3"
                 
+                # Без phone_digits новый клиент не находится поиском выше, и следующий
+                # запрос с тем же номером создаёт дубль
+                if "phone_digits" in cols and phone_digits:
+                    columns += ", phone_digits"
+                    values += f", ${len(params) + 1}"
+                    params.append(phone_digits)
+                
                 sql = f"INSERT INTO clients({columns}) VALUES ({values}) RETURNING *"
                 client = await conn.fetchrow(sql, *params)
+                await bump_stats(conn, new_clients=1, subscribed=1, active=1)
                 
                 # Начисляем бонусы за подписку новому клиенту
                 await _grant_signup_bonus_if_needed(conn, client["id"])
                 
                 # Записываем в leads
                 try:
-                    lead_cols = await conn.fetch(
-                        """
-                        SELECT column_name
-                        FROM information_schema.columns
-                        WHERE table_schema = 'public' AND table_name = 'leads'
-                        """
-                    )
-                    lead_col_names = [col["column_name"] for col in lead_cols]
-                    has_tg_user_id_lead = "tg_user_id" in lead_col_names
-                    
-                    if has_tg_user_id_lead:
-                        await conn.execute(
+                    lead_name = name or user.full_name or user.username or "Без имени"
+                    has_tg_user_id_lead, has_unique_lead = await _leads_schema(conn)
+                    new_leads = 0
+                    if has_tg_user_id_lead and has_unique_lead:
+                        # Лид без телефона обычно уже создан на /start (create_lead_if_missing) —
+                        # дописываем в него номер, а не теряем его на конфликте
+                        inserted = await conn.fetchval(
                             """
                             INSERT INTO leads(name, phone, source, status, tg_user_id)
                             VALUES ($1, $2, 'telegram_bot', 'new', $3)
-                            ON CONFLICT DO NOTHING
+                            ON CONFLICT (tg_user_id) DO UPDATE
+                            SET phone = COALESCE(leads.phone, EXCLUDED.phone),
+                                name = COALESCE(leads.name, EXCLUDED.name)
+                            RETURNING xmax = 0
                             """,
-                            name or user.full_name or user.username or "Без имени",
+                            lead_name,
                             phone,
-                            user.id
+                            user.id,
                         )
+                        new_leads = int(bool(inserted))
+                    elif has_tg_user_id_lead:
+                        filled = await conn.execute(
+                            """
+                            UPDATE leads SET phone = $2, name = COALESCE(name, $1)
+                            WHERE tg_user_id = $3 AND phone IS NULL
+                            """,
+                            lead_name,
+                            phone,
+                            user.id,
+                        )
+                        if filled == "UPDATE 0":
+                            lead_status = await conn.execute(
+                                """
+                                INSERT INTO leads(name, phone, source, status, tg_user_id)
+                                VALUES ($1, $2, 'telegram_bot', 'new', $3)
+                                ON CONFLICT DO NOTHING
+                                """,
+                                lead_name,
+                                phone,
+                                user.id,
+                            )
+                            new_leads = int(lead_status.split()[-1])
                     else:
-                        await conn.execute(
+                        lead_status = await conn.execute(
                             """
                             INSERT INTO leads(name, phone, source, status)
                             VALUES ($1, $2, 'telegram_bot', 'new')
                             ON CONFLICT DO NOTHING
                             """,
-                            name or user.full_name or user.username or "Без имени",
-                            phone
+                            lead_name,
+                            phone,
                         )
+                        new_leads = int(lead_status.split()[-1])
+                    await bump_stats(conn, leads=new_leads)
                 except Exception as e:
                     logging.warning(f"Не удалось записать в leads: {e}")
             
             # Получаем актуальные данные клиента
             client = await conn.fetchrow("SELECT * FROM clients WHERE id=$1", client["id"])
-            return client, was_new
+    # После коммита: иначе уведомления о заказах успеют снова закэшировать старый чат
+    client_chat_cache.invalidate(client["id"])
+    # Номер мог достаться другому чату: ответы менеджеров должны пойти в новый
+    crm_replies.cache.invalidate(phone_digits)
+    return client, was_new
 
 
 def format_admin_payload(kind: str, message: Message, client: Optional[asyncpg.Record]) -> str:
@@ -919,62 +1059,103 @@ def format_admin_media_payload(kind: str, message: Message, client: Optional[asy
 
 
 async def notify_admins_media(kind: str, message: Message, client: Optional[asyncpg.Record]) -> None:
-    if not ADMIN_TG_IDS:
+    admin_ids = current_config().admin_ids
+    if not admin_ids:
         logging.warning("ADMIN_TG_IDS пуст! Медиа не будет отправлено.")
         return
     caption = format_admin_media_payload(kind, message, client)
-    for admin_id in ADMIN_TG_IDS:
+    # file_id действительны только для бота, получившего файл
+    media_bot = message.bot
+    for admin_id in admin_ids:
         try:
             if message.photo:
-                await bot.send_photo(admin_id, message.photo[-1].file_id, caption=caption)
+                await media_bot.send_photo(admin_id, message.photo[-1].file_id, caption=caption)
             elif message.video:
-                await bot.send_video(admin_id, message.video.file_id, caption=caption)
+                await media_bot.send_video(admin_id, message.video.file_id, caption=caption)
             elif message.document:
-                await bot.send_document(admin_id, message.document.file_id, caption=caption)
+                await media_bot.send_document(admin_id, message.document.file_id, caption=caption)
             else:
-                await bot.send_message(admin_id, caption)
+                await media_bot.send_message(admin_id, caption)
         except Exception as exc:
             logging.error("Не удалось отправить медиа админу %s: %s", admin_id, exc)
 
 
-def is_menu_button(text: str) -> bool:
-    """Проверяет, является ли текст кнопкой меню."""
-    if not text:
-        return False
-    
-    text_normalized = text.strip()
-    
-    # Проверяем команды
-    if text_normalized.startswith("/"):
-        return True
-    
-    # Проверяем кнопки (убираем эмодзи для сравнения)
-    for button in MENU_BUTTONS:
-        # Убираем эмодзи и пробелы для сравнения
-        button_text = button.split(" ", 1)[-1] if " " in button else button
-        if text_normalized.lower() == button.lower() or text_normalized.lower() == button_text.lower():
-            return True
-    
-    return False
+# Свободный текст, вопросы и заказы клиентов с телефоном уходят в Wahelp/amoCRM через очередь
+crm_exporter = CrmExporter()
 
 
-async def create_lead_and_notify_admin(message: Message) -> None:
-    """Создает лид в БД и отправляет уведомление админам."""
-    if not message.from_user:
+async def forward_to_crm(client: Optional[asyncpg.Record], text: Optional[str], kind: str = "text") -> None:
+    """Ставит сообщение клиента в очередь на пересылку в CRM. Ответ клиенту не задерживает."""
+    if not CRM_FORWARD_ENABLED or not text or not client or not client.get("phone"):
         return
-    
-    user = message.from_user
-    pool = get_pool()
-    async with pool.acquire() as conn:
-        # Проверяем структуру таблицы leads
-        cols = await conn.fetch(
-            """
-            SELECT column_name
-            FROM information_schema.columns
-            WHERE table_schema = 'public' AND table_name = 'leads'
-            """
+    try:
+        await crm_exporter.enqueue(
+            client["phone"],
+            text,
+            kind=kind,
+            name=client.get("full_name") or client.get("name"),
+            client_id=client["id"],
         )
-        has_tg_user_id = any(col["column_name"] == "tg_user_id" for col in cols)
+    except Exception as exc:
+        logging.warning("Не удалось поставить сообщение клиента %s в очередь CRM: %s", client.get("id"), exc)
+
+
+def is_menu_button(text: str) -> bool:
+    """Проверяет, является ли текст кнопкой меню или командой."""
+    return MENU_TABLE.is_menu_text(text)
+
+
+_LEADS_SCHEMA: tuple[bool, bool] | None = None
+
+
+async def _leads_schema(conn: asyncpg.Connection) -> tuple[bool, bool]:
+    """(есть колонка tg_user_id, есть уникальный индекс по ней) — проверяется один раз на процесс."""
+    global _LEADS_SCHEMA
+    if _LEADS_SCHEMA is not None:
+        return _LEADS_SCHEMA
+    row = await conn.fetchrow(
+        """
+        SELECT
+            EXISTS (
+                SELECT 1 FROM information_schema.columns
+                WHERE table_schema = 'public' AND table_name = 'leads' AND column_name = 'tg_user_id'
+            ) AS has_tg_user_id,
+            EXISTS (
+                SELECT 1 FROM pg_index i
+                JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = i.indkey[0]
+                WHERE i.indrelid = 'public.leads'::regclass
+                  AND i.indisunique AND i.indisvalid AND i.indnatts = 1
+                  AND i.indpred IS NULL AND a.attname = 'tg_user_id'
+            ) AS has_unique
+        """
+    )
+    _LEADS_SCHEMA = (bool(row["has_tg_user_id"]), bool(row["has_unique"]))
+    return _LEADS_SCHEMA
+
+
+async def create_lead_if_missing(user: User, conn: Optional[asyncpg.Connection] = None) -> None:
+    """Создает лид для пользователя без телефона, если его ещё нет."""
+    # Лид уже есть — в БД не ходим
+    if known_leads.contains(user.id):
+        return
+    name = user.full_name or user.username or "Без имени"
+    async with acquire(conn) as conn:
+        has_tg_user_id, has_unique = await _leads_schema(conn)
+        if has_tg_user_id and has_unique:
+            # Уникальный индекс leads_tg_user_id_key (миграция 0008) отсекает дубль и без кэша
+            async with conn.transaction():
+                status = await conn.execute(
+                    """
+                    INSERT INTO leads(name, phone, source, status, tg_user_id)
+                    VALUES ($1, NULL, 'telegram_bot', 'new', $2)
+                    ON CONFLICT (tg_user_id) DO NOTHING
+                    """,
+                    name,
+                    user.id,
+                )
+                await bump_stats(conn, leads=int(status.split()[-1]))
+            known_leads.add(user.id)
+            return
         
         # Проверяем, есть ли уже лид с таким tg_user_id (если колонка есть)
         existing_lead = None
@@ -990,27 +1171,44 @@ async def create_lead_and_notify_admin(message: Message) -> None:
         
         if not existing_lead:
             # Создаем новый лид
-            if has_tg_user_id:
-                await conn.execute(
-                    """
-                    INSERT INTO leads(name, phone, source, status, tg_user_id)
-                    VALUES ($1, NULL, 'telegram_bot', 'new', $2)
-                    """,
-                    user.full_name or user.username or "Без имени",
-                    user.id
-                )
-            else:
-                await conn.execute(
-                    """
-                    INSERT INTO leads(name, phone, source, status)
-                    VALUES ($1, NULL, 'telegram_bot', 'new')
-                    """,
-                    user.full_name or user.username or "Без имени"
-                )
-        
-        # Отправляем админам
-        payload = format_admin_payload("Вопрос от лида (без телефона)", message, None)
-        await notify_admins(payload)
+            async with conn.transaction():
+                if has_tg_user_id:
+                    await conn.execute(
+                        """
+                        INSERT INTO leads(name, phone, source, status, tg_user_id)
+                        VALUES ($1, NULL, 'telegram_bot', 'new', $2)
+                        """,
+                        name,
+                        user.id
+                    )
+                else:
+                    await conn.execute(
+                        """
+                        INSERT INTO leads(name, phone, source, status)
+                        VALUES ($1, NULL, 'telegram_bot', 'new')
+                        """,
+                        name
+                    )
+                await bump_stats(conn, leads=1)
+        if has_tg_user_id:
+            known_leads.add(user.id)
+
+
+async def create_lead_and_notify_admin(message: Message) -> None:
+    """Создает лид в БД и отправляет уведомление админам."""
+    if not message.from_user:
+        return
+    
+    user = message.from_user
+    await write_journal.run_or_append(
+        "create_lead",
+        {"user": _user_payload(user)},
+        lambda: create_lead_if_missing(user),
+    )
+    
+    # Отправляем админам
+    payload = format_admin_payload("Вопрос от лида (без телефона)", message, None)
+    await notify_admins(payload)
 
 
 async def send_menu(message: Message, client: Optional[asyncpg.Record]) -> None:
@@ -1021,7 +1219,7 @@ async def send_menu(message: Message, client: Optional[asyncpg.Record]) -> None:
     )
 
 
-@dp.message(CommandStart())
+@router.message(CommandStart())
 async def start_handler(message: Message, state: FSMContext) -> None:
     print(f"[START_HANDLER] Обработка команды /start от {message.from_user.id if message.from_user else 'unknown'}")
     await state.clear()
@@ -1063,7 +1261,7 @@ async def start_handler(message: Message, state: FSMContext) -> None:
         )
 
 
-@dp.message(F.contact)
+@router.message(F.contact)
 async def contact_handler(message: Message, state: FSMContext) -> None:
     print(f"[CONTACT_HANDLER] Обработка контакта от {message.from_user.id if message.from_user else 'unknown'}")
     contact = message.contact
@@ -1083,8 +1281,16 @@ async def contact_handler(message: Message, state: FSMContext) -> None:
     if first or last:
         contact_name = " ".join([p for p in [first, last] if p])
     
-    client, was_new = await upsert_contact(user, contact.phone_number, contact_name or user.full_name)
+    result = await write_journal.run_or_append(
+        "upsert_contact",
+        {"user": _user_payload(user), "phone": contact.phone_number, "name": contact_name or user.full_name},
+        lambda: upsert_contact(user, contact.phone_number, contact_name or user.full_name),
+    )
     await state.clear()
+    if result is None:
+        await message.answer(DEGRADED_CONTACT_TEXT, reply_markup=main_menu(require_contact=False, user_id=user.id))
+        return
+    client, was_new = result
     
     # Отправляем сообщение о бонусах
     await send_bonus_message(client, user)
@@ -1098,7 +1304,7 @@ async def contact_handler(message: Message, state: FSMContext) -> None:
     )
 
 
-@dp.message(Command("info"))
+@router.message(Command("info"))
 async def info_handler(message: Message) -> None:
     if not message.from_user:
         return
@@ -1110,7 +1316,7 @@ async def info_handler(message: Message) -> None:
     )
 
 
-@dp.message(StateFilter(ClientRequestFSM.waiting_question))
+@router.message(StateFilter(ClientRequestFSM.waiting_question))
 async def handle_question_text(message: Message, state: FSMContext) -> None:
     print(f"[HANDLE_QUESTION_TEXT] Обработка текста в состоянии waiting_question от {message.from_user.id if message.from_user else 'unknown'}: {message.text[:50] if message.text else 'no text'}")
     if not message.from_user:
@@ -1136,9 +1342,10 @@ async def handle_question_text(message: Message, state: FSMContext) -> None:
         reply_markup=main_menu(require_contact=needs_phone(client), user_id=user_id),
     )
     await state.clear()
+    await forward_to_crm(client, message.text, kind="question")
 
 
-@dp.message(StateFilter(ClientRequestFSM.waiting_order))
+@router.message(StateFilter(ClientRequestFSM.waiting_order))
 async def handle_order_text(message: Message, state: FSMContext) -> None:
     print(f"[HANDLE_ORDER_TEXT] Обработка текста в состоянии waiting_order от {message.from_user.id if message.from_user else 'unknown'}: {message.text[:50] if message.text else 'no text'}")
     if not message.from_user:
@@ -1164,9 +1371,15 @@ async def handle_order_text(message: Message, state: FSMContext) -> None:
         reply_markup=main_menu(require_contact=needs_phone(client), user_id=user_id),
     )
     await state.clear()
+    await forward_to_crm(client, message.text, kind="order")
+
+
+@router.message(MenuButtonFilter(MENU_TABLE))
+async def menu_router(message: Message, state: FSMContext, menu_button: str) -> None:
+    """Все кнопки меню: один поиск по MENU_TABLE вместо цепочки фильтров по каждой кнопке."""
+    await MENU_HANDLERS[menu_button](message, state)
 
 
-@dp.message(F.text.casefold() == BTN_BONUS.lower())
 async def bonuses_handler(message: Message) -> None:
     print(f"[BONUSES_HANDLER] Обработка кнопки 'Мои бонусы' от {message.from_user.id if message.from_user else 'unknown'}")
     if not message.from_user:
@@ -1188,11 +1401,120 @@ async def bonuses_handler(message: Message) -> None:
     balance = client.get("bonus_balance") or 0
     await message.answer(
         f"На вашем бонусном счету <b>{balance}</b> бонусов. Можно оплатить ими до 50% заказа.",
-        reply_markup=main_menu(require_contact=False, user_id=user_id),
+        reply_markup=BONUS_HISTORY_OPEN_KEYBOARD,
     )
 
 
-@dp.message(F.text.casefold() == BTN_SHARE_CONTACT.lower())
+# --- История бонусов ---
+# callback_data: bh:<o|n|p>:<страница>:<всего>:<created_at в мкс>:<id>
+# o — открыть первую страницу (здесь один раз считаем COUNT), n — старее, p — новее.
+# Всего записей едет в callback_data, чтобы не пересчитывать COUNT на каждой странице.
+
+BONUS_HISTORY_CB = "bh"
+BONUS_HISTORY_OPEN_KEYBOARD = frozen(
+    InlineKeyboardMarkup(
+        inline_keyboard=[[InlineKeyboardButton(text="📜 История бонусов", callback_data=f"{BONUS_HISTORY_CB}:o")]]
+    )
+)
+BONUS_REASON_LABELS = {
+    "bot_signup": "Бонус за подписку",
+    "bonus_expired": "Сгорание бонусов",
+}
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def _history_cursor_data(direction: str, page: int, total: int, row: asyncpg.Record) -> str:
+    created_at = row["created_at"]
+    if created_at.tzinfo is None:
+        created_at = created_at.replace(tzinfo=timezone.utc)
+    micros = (created_at - _EPOCH) // timedelta(microseconds=1)
+    return f"{BONUS_HISTORY_CB}:{direction}:{page}:{total}:{micros}:{row['id']}"
+
+
+def _parse_history_data(data: str) -> Optional[tuple[str, int, int, Optional[tuple[datetime, int]]]]:
+    parts = data.split(":")
+    try:
+        if parts[1] == "o":
+            return "o", 1, 0, None
+        direction, page, total, micros, row_id = parts[1], int(parts[2]), int(parts[3]), int(parts[4]), int(parts[5])
+    except (IndexError, ValueError):
+        return None
+    if direction not in {"n", "p"}:
+        return None
+    return direction, page, total, (_EPOCH + timedelta(microseconds=micros), row_id)
+
+
+def _format_history_row(row: asyncpg.Record) -> str:
+    delta = int(row["delta"])
+    created = row["created_at"]
+    if created.tzinfo is None:
+        created = created.replace(tzinfo=timezone.utc)
+    reason = row["reason"] or ""
+    line = (
+        f"{created.astimezone(MOSCOW_TZ).strftime('%d.%m.%Y')}  "
+        f"<b>{delta:+d}</b> — {BONUS_REASON_LABELS.get(reason, reason or 'операция')}"
+    )
+    expires_at = row["expires_at"]
+    if expires_at and delta > 0:
+        if expires_at.tzinfo is None:
+            expires_at = expires_at.replace(tzinfo=timezone.utc)
+        line += f" (до {expires_at.astimezone(MOSCOW_TZ).strftime('%d.%m.%Y')})"
+    return line
+
+
+def _render_history_page(
+    rows: list[asyncpg.Record], page: int, total: int, has_older: bool, has_newer: bool
+) -> tuple[str, Optional[InlineKeyboardMarkup]]:
+    pages = max(1, -(-total // BONUS_HISTORY_PAGE_SIZE))
+    if not rows:
+        return "📜 История бонусов пока пуста.", None
+    lines = [f"📜 <b>История бонусов</b> (стр. {page} из {max(pages, page)})", ""]
+    lines.extend(_format_history_row(row) for row in rows)
+    buttons: list[InlineKeyboardButton] = []
+    if has_newer:
+        buttons.append(
+            InlineKeyboardButton(text="◀️ Новее", callback_data=_history_cursor_data("p", page - 1, total, rows[0]))
+        )
+    if has_older:
+        buttons.append(
+            InlineKeyboardButton(text="Старее ▶️", callback_data=_history_cursor_data("n", page + 1, total, rows[-1]))
+        )
+    return "\n".join(lines), InlineKeyboardMarkup(inline_keyboard=[buttons]) if buttons else None
+
+
+@router.callback_query(F.data.startswith(f"{BONUS_HISTORY_CB}:"))
+async def bonus_history_callback(callback: CallbackQuery) -> None:
+    parsed = _parse_history_data(callback.data or "")
+    if parsed is None or not isinstance(callback.message, Message):
+        await callback.answer()
+        return
+    direction, page, total, cursor = parsed
+    async with acquire() as conn:
+        # Клиента ищем по тому, кто нажал кнопку, а не по данным кнопки
+        client = await _fetch_client_by_tg(conn, callback.from_user.id)
+        if not client or needs_phone(client):
+            await callback.answer("Бонусы отображаются после подтверждения номера.", show_alert=True)
+            return
+        if direction == "o":
+            total = await count_bonus_history(conn, client["id"])
+        rows, has_more = await fetch_bonus_history_page(
+            conn, client["id"], BONUS_HISTORY_PAGE_SIZE, cursor=cursor, newer=direction == "p"
+        )
+    if direction == "p":
+        has_newer, has_older = has_more, True
+    else:
+        has_older, has_newer = has_more, direction == "n"
+    if direction == "p" and not has_newer:
+        page = 1  # вернулись к самым новым, даже если с тех пор добавились записи
+    text, markup = _render_history_page(rows, page, total, has_older, has_newer)
+    try:
+        await callback.message.edit_text(text, reply_markup=markup)
+    except TelegramBadRequest as exc:
+        if "message is not modified" not in str(exc):
+            raise
+    await callback.answer()
+
+
 async def share_contact_prompt(message: Message, state: FSMContext) -> None:
     print(f"[SHARE_CONTACT_PROMPT] Обработка кнопки 'Поделиться номером' от {message.from_user.id if message.from_user else 'unknown'}")
     await state.set_state(ClientRequestFSM.waiting_phone_manual)
@@ -1203,7 +1525,6 @@ async def share_contact_prompt(message: Message, state: FSMContext) -> None:
     )
 
 
-@dp.message(F.text.casefold() == BTN_QUESTION.lower())
 async def ask_question(message: Message, state: FSMContext) -> None:
     print(f"[ASK_QUESTION] Обработка кнопки 'Задать вопрос' от {message.from_user.id if message.from_user else 'unknown'}")
     if not message.from_user:
@@ -1217,17 +1538,13 @@ async def ask_question(message: Message, state: FSMContext) -> None:
         )
         return
     await state.set_state(ClientRequestFSM.waiting_question)
-    cancel_keyboard = ReplyKeyboardMarkup(
-        keyboard=[[KeyboardButton(text=BTN_CANCEL)]],
-        resize_keyboard=True,
-    ) if not is_admin(user_id) else None
+    cancel_keyboard = CANCEL_KEYBOARD if not is_admin(user_id) else None
     await message.answer(
         "Опишите ваш вопрос. Чтобы отменить, нажмите «Отмена».",
         reply_markup=cancel_keyboard,
     )
 
 
-@dp.message(F.text.casefold() == BTN_ORDER.lower())
 async def make_order(message: Message, state: FSMContext) -> None:
     print(f"[MAKE_ORDER] Обработка кнопки 'Сделать заказ' от {message.from_user.id if message.from_user else 'unknown'}")
     if not message.from_user:
@@ -1241,17 +1558,13 @@ async def make_order(message: Message, state: FSMContext) -> None:
         )
         return
     await state.set_state(ClientRequestFSM.waiting_order)
-    cancel_keyboard = ReplyKeyboardMarkup(
-        keyboard=[[KeyboardButton(text=BTN_CANCEL)]],
-        resize_keyboard=True,
-    ) if not is_admin(user_id) else None
+    cancel_keyboard = CANCEL_KEYBOARD if not is_admin(user_id) else None
     await message.answer(
         "Расскажите, какая услуга нужна. Чтобы отменить, нажмите «Отмена».",
         reply_markup=cancel_keyboard,
     )
 
 
-@dp.message(F.text.casefold() == BTN_MEDIA.lower())
 async def send_media_request(message: Message, state: FSMContext) -> None:
     if not message.from_user:
         return
@@ -1264,10 +1577,7 @@ async def send_media_request(message: Message, state: FSMContext) -> None:
         )
         return
     await state.set_state(ClientRequestFSM.waiting_media)
-    cancel_keyboard = ReplyKeyboardMarkup(
-        keyboard=[[KeyboardButton(text=BTN_CLOSE)]],
-        resize_keyboard=True,
-    ) if not is_admin(user_id) else None
+    cancel_keyboard = CLOSE_KEYBOARD if not is_admin(user_id) else None
     await message.answer(
         "Отправьте фото или видео для оценки. Можно отправить несколько.\n"
         "Когда закончите — нажмите «Закрыть».",
@@ -1275,7 +1585,7 @@ async def send_media_request(message: Message, state: FSMContext) -> None:
     )
 
 
-@dp.message(StateFilter(ClientRequestFSM.waiting_media))
+@router.message(StateFilter(ClientRequestFSM.waiting_media))
 async def handle_media_upload(message: Message, state: FSMContext) -> None:
     if not message.from_user:
         return
@@ -1301,41 +1611,51 @@ async def handle_media_upload(message: Message, state: FSMContext) -> None:
     )
 
 
-@dp.message(F.text.casefold() == BTN_PRICE.lower())
 async def price_handler(message: Message) -> None:
     """Обработчик кнопки 'Прайс' - показывает ссылку на прайс на сайте"""
     print(f"[PRICE_HANDLER] Обработка кнопки 'Прайс' от {message.from_user.id if message.from_user else 'unknown'}")
-    text = "💰 <b>Прайс на услуги</b>\n\nПосмотрите актуальные цены на нашем сайте:"
-    keyboard = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [InlineKeyboardButton(text="📄 Открыть прайс", url="https://raketaclean.ru/price")]
-        ]
-    )
-    await message.answer(text, reply_markup=keyboard)
+    await message.answer(bot_texts.get("price_text"), reply_markup=bot_texts.price_keyboard)
 
 
-@dp.message(F.text.casefold() == BTN_SCHEDULE.lower())
 async def schedule_handler(message: Message) -> None:
     """Обработчик кнопки 'Режим работы' - показывает контактную информацию"""
     print(f"[SCHEDULE_HANDLER] Обработка кнопки 'Режим работы' от {message.from_user.id if message.from_user else 'unknown'}")
-    text = (
-        "🕐 <b>Режим работы:</b>\n"
-        "Ежедневно с 9:00 до 19:00\n\n"
-        "<b>Для связи:</b>\n"
-        "Телефон: +79040437523\n"
-        "Telegram: @raketaclean\n"
-        "Сайт: raketaclean.ru\n"
-        "Эл.почта: raketa@raketaclean.ru\n"
-        "Адрес: Нижний Новгород, ул. Артельная 37 (офис)\n\n"
-        "<b>Услуги:</b> Химчистка мебели и ковролина, клининг, стирка ковров, клининг для бизнеса"
+    await message.answer(bot_texts.get("schedule_text"), parse_mode=ParseMode.HTML)
+
+
+MENU_HANDLERS = {
+    BTN_BONUS: lambda message, state: bonuses_handler(message),
+    BTN_SHARE_CONTACT: share_contact_prompt,
+    BTN_QUESTION: ask_question,
+    BTN_ORDER: make_order,
+    BTN_MEDIA: send_media_request,
+    BTN_PRICE: lambda message, state: price_handler(message),
+    BTN_SCHEDULE: lambda message, state: schedule_handler(message),
+    BTN_CANCEL: lambda message, state: cancel_handler(message, state),
+}
+
+
+async def _update_client_bot_state(
+    conn: asyncpg.Connection, set_clause: str, params: list[object], cols: set[str]
+) -> Optional[bool]:
+    """UPDATE клиента params[0]; возвращает bot_started до изменения (None — колонки нет)."""
+    if "bot_started" not in cols:
+        await conn.execute(f"UPDATE clients SET {set_clause} WHERE id=$1", *params)
+        return None
+    return await conn.fetchval(
+        f"""
+        UPDATE clients c SET {set_clause}
+        FROM (SELECT id, COALESCE(bot_started, false) AS was_started FROM clients WHERE id=$1 FOR UPDATE) old
+        WHERE c.id = old.id
+        RETURNING old.was_started
+        """,
+        *params,
     )
-    await message.answer(text, parse_mode=ParseMode.HTML)
 
 
-async def mark_client_unsubscribed(user_id: int) -> None:
+async def mark_client_unsubscribed(user_id: int, conn: Optional[asyncpg.Connection] = None) -> None:
     """Помечает клиента как отписавшегося от бота."""
-    pool = get_pool()
-    async with pool.acquire() as conn:
+    async with acquire(conn) as conn:
         client = await _fetch_client_by_tg(conn, user_id)
         if not client:
             return
@@ -1358,14 +1678,78 @@ async def mark_client_unsubscribed(user_id: int) -> None:
         if not updates:
             return
         set_clause = ", ".join(updates)
-        await conn.execute(f"UPDATE clients SET {set_clause} WHERE id=$1", *params)
+        async with conn.transaction():
+            was_started = await _update_client_bot_state(conn, set_clause, params, cols)
+            if was_started:
+                await bump_stats(conn, unsubscribed=1, active=-1)
+        client_chat_cache.invalidate(client["id"])
         logging.info(f"Клиент {client['id']} (TG: {user_id}) помечен как отписавшийся")
 
 
-async def mark_client_subscribed(user_id: int) -> None:
+async def mark_clients_unsubscribed(user_ids: list[int], conn: Optional[asyncpg.Connection] = None) -> int:
+    """Помечает отписавшимися сразу пачку клиентов по TG ID. Возвращает число изменённых строк."""
+    async with acquire(conn) as conn:
+        cols = await _clients_columns(conn)
+        updates: list[str] = []
+        changed: list[str] = []
+        if "bot_started" in cols:
+            updates.append("bot_started = false")
+            changed.append("bot_started IS DISTINCT FROM false")
+        if "preferred_contact" in cols:
+            updates.append("preferred_contact = 'wahelp'")
+            changed.append("preferred_contact IS DISTINCT FROM 'wahelp'")
+        matches = [f"{col} = ANY($1::bigint[])" for col in ("bot_tg_user_id", "tg_user_id") if col in cols]
+        if not updates or not matches:
+            return 0
+        was_started = "COALESCE(bot_started, false)" if "bot_started" in cols else "false"
+        async with conn.transaction():
+            rows = await conn.fetch(
+                f"""
+                UPDATE clients c SET {", ".join(updates)}
+                FROM (
+                    SELECT id, {was_started} AS was_started FROM clients
+                    WHERE ({" OR ".join(matches)}) AND ({" OR ".join(changed)})
+                    FOR UPDATE
+                ) old
+                WHERE c.id = old.id
+                RETURNING c.id, old.was_started
+                """,
+                user_ids,
+            )
+            unsubscribed = sum(1 for r in rows if r["was_started"])
+            await bump_stats(conn, unsubscribed=unsubscribed, active=-unsubscribed)
+        for row in rows:
+            client_chat_cache.invalidate(row["id"])
+        count = len(rows)
+        if count:
+            logging.info(f"Помечено отписавшимися клиентов: {count} (TG ID: {len(user_ids)})")
+        return count
+
+
+async def _flush_unsubscribed(user_ids: list[int]) -> None:
+    await write_journal.run_or_append(
+        "mark_clients_unsubscribed",
+        {"user_ids": user_ids},
+        lambda: mark_clients_unsubscribed(user_ids),
+    )
+
+
+# Чаты, куда писать бесполезно (заблокировали бота, удалены): отправки в них не идут
+blocked_chats = BlockedChats(_flush_unsubscribed)
+
+
+async def _send_crm_reply(chat_id: int, text: str, **kwargs) -> Optional[Message]:
+    """Ответ менеджера как есть (без HTML); сетевые ошибки — наружу, на повтор."""
+    return await _send_or_raise(chat_id, text, parse_mode=None, **kwargs)
+
+
+# Ответы менеджеров из amoCRM/Wahelp: webhook → клиенту, в общем темпе исходящих
+crm_replies = CrmReplyRelay(outbound, _send_crm_reply)
+
+
+async def mark_client_subscribed(user_id: int, conn: Optional[asyncpg.Connection] = None) -> None:
     """Помечает клиента как подписавшегося на бота."""
-    pool = get_pool()
-    async with pool.acquire() as conn:
+    async with acquire(conn) as conn:
         client = await _fetch_client_by_tg(conn, user_id)
         if not client:
             return
@@ -1392,13 +1776,102 @@ async def mark_client_subscribed(user_id: int) -> None:
             return
         set_clause_parts = updates + literals
         set_clause = ", ".join(set_clause_parts)
-        await conn.execute(f"UPDATE clients SET {set_clause} WHERE id=$1", *params)
+        async with conn.transaction():
+            was_started = await _update_client_bot_state(conn, set_clause, params, cols)
+            if was_started is False:
+                await bump_stats(conn, subscribed=1, active=1)
+        client_chat_cache.invalidate(client["id"])
         logging.info(f"Клиент {client['id']} (TG: {user_id}) помечен как подписавшийся")
 
 
+# --- Деградированный режим: записи при недоступной БД уходят в журнал ---
+
+DEGRADED_CONTACT_TEXT = (
+    "Спасибо! Номер получили. Сейчас у нас технические работы — "
+    "бонусы начислим автоматически в ближайшее время и пришлём уведомление."
+)
+DEGRADED_REPLY_TEXT = (
+    "⚠️ Сейчас у нас технические работы, попробуйте чуть позже.\n"
+    "Прайс и режим работы доступны в меню."
+)
+
+
+def _user_payload(user: User) -> dict[str, Any]:
+    return user.model_dump(mode="json", exclude_none=True)
+
+
+async def _replay_upsert_contact(conn: asyncpg.Connection, payload: dict[str, Any]) -> Tuple[asyncpg.Record, bool]:
+    user = User.model_validate(payload["user"])
+    return await upsert_contact(user, payload["phone"], payload.get("name"), conn=conn)
+
+
+async def _after_upsert_contact(payload: dict[str, Any], result: Tuple[asyncpg.Record, bool]) -> None:
+    # Клиент получил ответ без бонусов — досылаем то, что обычно шлёт contact_handler.
+    client, was_new = result
+    user = User.model_validate(payload["user"])
+    await send_bonus_message(client, user)
+    await log_signup(client, user, was_new)
+    await safe_send_message(
+        user.id,
+        "Номер сохранён. Теперь можете пользоваться меню.",
+        reply_markup=main_menu(require_contact=needs_phone(client), user_id=user.id),
+    )
+
+
+async def _replay_create_lead(conn: asyncpg.Connection, payload: dict[str, Any]) -> None:
+    await create_lead_if_missing(User.model_validate(payload["user"]), conn=conn)
+
+
+async def _replay_mark_client_unsubscribed(conn: asyncpg.Connection, payload: dict[str, Any]) -> None:
+    await mark_client_unsubscribed(int(payload["user_id"]), conn=conn)
+
+
+async def _replay_mark_clients_unsubscribed(conn: asyncpg.Connection, payload: dict[str, Any]) -> None:
+    await mark_clients_unsubscribed([int(user_id) for user_id in payload["user_ids"]], conn=conn)
+
+
+async def _replay_mark_client_subscribed(conn: asyncpg.Connection, payload: dict[str, Any]) -> None:
+    await mark_client_subscribed(int(payload["user_id"]), conn=conn)
+
+
+write_journal.register("upsert_contact", _replay_upsert_contact, after=_after_upsert_contact)
+write_journal.register("create_lead", _replay_create_lead)
+write_journal.register("mark_client_unsubscribed", _replay_mark_client_unsubscribed)
+write_journal.register("mark_clients_unsubscribed", _replay_mark_clients_unsubscribed)
+write_journal.register("mark_client_subscribed", _replay_mark_client_subscribed)
+
+
+class DegradedModeMiddleware(BaseMiddleware):
+    """Отвечает клиенту вместо молчания, если хэндлер упал из-за недоступной БД."""
+
+    async def __call__(
+        self,
+        handler,
+        event: TelegramObject,
+        data: dict,
+    ):
+        try:
+            return await handler(event, data)
+        except Exception as exc:
+            if not is_db_unavailable_error(exc):
+                raise
+            if not isinstance(exc, DatabaseUnavailable):
+                db_breaker.record_failure()
+            logging.warning("БД недоступна, апдейт обработан в деградированном режиме: %s", exc)
+            message = getattr(event, "message", None)
+            if isinstance(message, Message) and message.chat.type == ChatType.PRIVATE:
+                try:
+                    await message.answer(DEGRADED_REPLY_TEXT)
+                except Exception as send_exc:
+                    logging.warning("Не удалось ответить в деградированном режиме: %s", send_exc)
+
+
 class UnsubscribeMiddleware(BaseMiddleware):
-    """Middleware для обработки отписки пользователей при ошибках отправки сообщений."""
-    
+    """
+    Middleware для обработки отписки пользователей при ошибках отправки сообщений.
+    Висит на update, поэтому чат берём из упавшего метода, а не из события.
+    """
+
     async def __call__(
         self,
         handler,
@@ -1407,42 +1880,48 @@ class UnsubscribeMiddleware(BaseMiddleware):
     ):
         try:
             return await handler(event, data)
-        except TelegramBadRequest as e:
-            # Обрабатываем ошибки, связанные с блокировкой бота
-            error_message = str(e).lower()
-            error_codes = [
-                "bot_blocked_by_user",
-                "user_is_deleted", 
-                "chat_not_found",
-                "user not found",
-            ]
-            
-            if any(code in error_message for code in error_codes):
-                # Пытаемся получить user_id из события
-                user_id = None
-                if isinstance(event, Message):
-                    if event.from_user:
-                        user_id = event.from_user.id
-                    elif event.chat and event.chat.type == ChatType.PRIVATE:
-                        user_id = event.chat.id
-                elif isinstance(event, ChatMemberUpdated):
-                    if event.from_user:
-                        user_id = event.from_user.id
-                    elif event.chat and event.chat.type == ChatType.PRIVATE:
-                        user_id = event.chat.id
-                
-                if user_id:
-                    await mark_client_unsubscribed(user_id)
-                    logging.warning(f"Пользователь {user_id} заблокировал бота или удалён: {e}")
-                else:
-                    logging.warning(f"Не удалось определить user_id для обработки отписки: {e}")
-            
-            # Пробрасываем ошибку дальше, если это не связано с блокировкой
-            if not any(code in error_message for code in error_codes):
+        except (TelegramBadRequest, TelegramForbiddenError) as e:
+            if classify_send_error(e) != SEND_UNREACHABLE:
                 raise
+            chat_id = failed_chat_id(e)
+            if chat_id is None:
+                chat = data.get("event_chat")
+                if chat is not None and chat.type == ChatType.PRIVATE:
+                    chat_id = chat.id
+            if chat_id is not None:
+                blocked_chats.add(chat_id)
+                logging.warning(f"Пользователь {chat_id} заблокировал бота или удалён: {e}")
+            else:
+                logging.warning(f"Не удалось определить user_id для обработки отписки: {e}")
+
+
+class BotContextMiddleware(BaseMiddleware):
+    """
+    Делает бота апдейта текущим (current_bot) — для уведомлений админам — и
+    запоминает, через какого бота писать клиенту, если ботов несколько.
+    """
+
+    async def __call__(
+        self,
+        handler,
+        event: TelegramObject,
+        data: dict,
+    ):
+        event_bot = data["bot"]
+        token = _current_bot.set(event_bot)
+        try:
+            # my_chat_member разбирает chat_member_updates: блокировка старого бота не меняет маршрут
+            if len(bots) > 1 and getattr(event, "my_chat_member", None) is None:
+                user = data.get("event_from_user")
+                chat = data.get("event_chat")
+                if user is not None and chat is not None and chat.type == ChatType.PRIVATE:
+                    chat_routes.remember(user.id, event_bot.id)
+            return await handler(event, data)
+        finally:
+            _current_bot.reset(token)
 
 
-@dp.my_chat_member()
+@router.my_chat_member()
 async def chat_member_updates(event: ChatMemberUpdated) -> None:
     """Обработка событий изменения статуса в группах/каналах."""
     if event.chat.type != ChatType.PRIVATE:
@@ -1453,13 +1932,90 @@ async def chat_member_updates(event: ChatMemberUpdated) -> None:
     status = event.new_chat_member.status
     
     if status in {ChatMemberStatus.KICKED, ChatMemberStatus.LEFT}:
-        await mark_client_unsubscribed(user.id)
+        # Клиент ушёл к другому нашему боту — блокировка старого его не отписывает
+        if chat_routes.bot_id_for(user.id) != event.bot.id:
+            return
+        # Отметка в clients уйдёт пачкой
+        blocked_chats.add(user.id)
     elif status in {ChatMemberStatus.MEMBER, ChatMemberStatus.ADMINISTRATOR}:
-        await mark_client_subscribed(user.id)
+        chat_routes.remember(user.id, event.bot.id)
+        blocked_chats.discard(user.id)
+        await write_journal.run_or_append(
+            "mark_client_subscribed",
+            {"user_id": user.id},
+            lambda: mark_client_subscribed(user.id),
+        )
+
+
+@router.message(Command("stats"))
+async def stats_handler(message: Message) -> None:
+    """Сводка для админов по счётчикам bot_daily_stats — без COUNT(*) по общим таблицам."""
+    if not is_admin(message.from_user.id if message.from_user else None):
+        return
+    async with acquire() as conn:
+        stats = await read_stats(conn)
+    await message.answer(format_stats(stats), parse_mode=None)
+
+
+# Выгрузки идут в фоне; у каждого админа — не больше одной одновременно
+_export_tasks: dict[int, asyncio.Task] = {}
+
+
+async def _run_client_export(message: Message, filters: ExportFilters) -> None:
+    status = await message.answer(f"⏳ Готовлю выгрузку ({filters.describe()})…", parse_mode=None)
+
+    async def progress(rows: int) -> None:
+        try:
+            await status.edit_text(f"⏳ Выгрузка ({filters.describe()}): {rows} строк…", parse_mode=None)
+        except TelegramBadRequest:
+            pass  # текст не изменился или сообщение удалено
+
+    result = None
+    try:
+        async with acquire() as conn:
+            name_column = await _clients_name_column(conn)
+        result = await export_clients_csv(filters, name_column=name_column, progress=progress)
+        if result.size > EXPORT_MAX_BYTES:
+            await status.edit_text(
+                f"Файл {result.size // (1024 * 1024)} МБ больше лимита Telegram — сузьте фильтры /export.",
+                parse_mode=None,
+            )
+            return
+        await message.answer_document(
+            FSInputFile(result.path, filename=result.filename),
+            caption=f"Клиенты: {result.rows} ({filters.describe()})",
+            parse_mode=None,
+        )
+        await status.edit_text(f"✅ Выгрузка готова: {result.rows} строк, {result.size // 1024} КБ", parse_mode=None)
+    except Exception as exc:
+        logging.exception("Выгрузка клиентов не удалась")
+        await status.edit_text(f"Не удалось сделать выгрузку: {exc}", parse_mode=None)
+    finally:
+        if result is not None:
+            os.unlink(result.path)
+
+
+@router.message(Command("export"))
+async def export_handler(message: Message, command: CommandObject) -> None:
+    """CSV клиентов и их бонусов для админов; хэндлер только запускает фоновую выгрузку."""
+    user_id = message.from_user.id if message.from_user else None
+    if not is_admin(user_id):
+        return
+    try:
+        filters = parse_export_args(command.args)
+    except ValueError as exc:
+        await message.answer(str(exc), parse_mode=None)
+        return
+    running = _export_tasks.get(user_id)
+    if running is not None and not running.done():
+        await message.answer("Предыдущая выгрузка ещё идёт.", parse_mode=None)
+        return
+    task = asyncio.create_task(_run_client_export(message, filters), name=f"client-export-{user_id}")
+    _export_tasks[user_id] = task
+    task.add_done_callback(lambda _: _export_tasks.pop(user_id, None))
 
 
-@dp.message(Command("cancel"))
-@dp.message(F.text.casefold() == BTN_CANCEL.lower())
+@router.message(Command("cancel"))
 async def cancel_handler(message: Message, state: FSMContext) -> None:
     await state.clear()
     if not message.from_user:
@@ -1472,7 +2028,7 @@ async def cancel_handler(message: Message, state: FSMContext) -> None:
     )
 
 
-@dp.message(StateFilter(ClientRequestFSM.waiting_phone_manual), F.text)
+@router.message(StateFilter(ClientRequestFSM.waiting_phone_manual), F.text)
 async def handle_manual_phone(message: Message, state: FSMContext) -> None:
     """Обработка ручного ввода номера телефона (только текстовые сообщения)."""
     print(f"[HANDLE_MANUAL_PHONE] Обработка текста в состоянии waiting_phone_manual от {message.from_user.id if message.from_user else 'unknown'}: {message.text[:50] if message.text else 'no text'}")
@@ -1493,8 +2049,16 @@ async def handle_manual_phone(message: Message, state: FSMContext) -> None:
     if re.match(r"^9\d{9}$", phone_text):
         normalized = normalize_phone(phone_text)
         user = message.from_user
-        client, was_new = await upsert_contact(user, normalized, user.full_name)
+        result = await write_journal.run_or_append(
+            "upsert_contact",
+            {"user": _user_payload(user), "phone": normalized, "name": user.full_name},
+            lambda: upsert_contact(user, normalized, user.full_name),
+        )
         await state.clear()
+        if result is None:
+            await message.answer(DEGRADED_CONTACT_TEXT, reply_markup=main_menu(require_contact=False, user_id=user.id))
+            return
+        client, was_new = result
         
         # Отправляем сообщение о бонусах
         await send_bonus_message(client, user)
@@ -1515,7 +2079,7 @@ async def handle_manual_phone(message: Message, state: FSMContext) -> None:
     )
 
 
-@dp.message(StateFilter(ClientRequestFSM.waiting_phone_manual))
+@router.message(StateFilter(ClientRequestFSM.waiting_phone_manual))
 async def handle_manual_phone_nontext(message: Message, state: FSMContext) -> None:
     """Защита от не-текстовых сообщений в режиме ручного ввода номера."""
     print(f"[HANDLE_MANUAL_PHONE_NONTEXT] Обработка не-текста в состоянии waiting_phone_manual от {message.from_user.id if message.from_user else 'unknown'}")
@@ -1532,7 +2096,7 @@ async def handle_manual_phone_nontext(message: Message, state: FSMContext) -> No
     )
 
 
-@dp.message()
+@router.message()
 async def fallback(message: Message, state: FSMContext) -> None:
     """Обработчик всех сообщений, которые не попали в другие handlers."""
     # Используем print для гарантированного вывода в логи
@@ -1582,8 +2146,8 @@ async def fallback(message: Message, state: FSMContext) -> None:
         )
     else:
         # Клиент с телефоном - отправляем как вопрос админу
-        print(f"[FALLBACK] Отправка вопроса админу для клиента с телефоном. ADMIN_TG_IDS: {ADMIN_TG_IDS}")
-        logging.info(f"Отправка вопроса админу для клиента с телефоном. ADMIN_TG_IDS: {ADMIN_TG_IDS}")
+        print(f"[FALLBACK] Отправка вопроса админу для клиента с телефоном. ADMIN_TG_IDS: {current_config().admin_ids}")
+        logging.info(f"Отправка вопроса админу для клиента с телефоном. ADMIN_TG_IDS: {current_config().admin_ids}")
         payload = format_admin_payload("Вопрос от клиента", message, client)
         await notify_admins(payload)
         print("[FALLBACK] Вопрос отправлен админам")
@@ -1593,20 +2157,20 @@ async def fallback(message: Message, state: FSMContext) -> None:
             "Передал вопрос администратору. Ответим как можно скорее!",
             reply_markup=main_menu(require_contact=False, user_id=user_id),
         )
+        await forward_to_crm(client, message.text)
 
 
-async def cleanup_expired_bonuses() -> None:
+async def cleanup_expired_bonuses() -> int:
     """
     Ежедневная очистка клиентов с истекшими бонусами за подписку.
     Удаляет клиентов, у которых:
     - Истек срок действия бонусов за подписку (expires_at = сегодня)
     - Нет заказов (дата последнего заказа пуста)
     """
-    MOSCOW_TZ = ZoneInfo("Europe/Moscow")
     today_moscow = datetime.now(MOSCOW_TZ).date()
     
-    pool = get_pool()
-    async with pool.acquire() as conn:
+    # Скан bonus_transactions и рассылка внутри транзакции дольше лимита запросов пула
+    async with batch_connection("cleanup-expired-bonuses") as conn:
         async with conn.transaction():
             # Находим клиентов для удаления
             clients_to_delete = await conn.fetch("""
@@ -1615,6 +2179,7 @@ async def cleanup_expired_bonuses() -> None:
                     c.phone,
                     c.bonus_balance,
                     c.bot_tg_user_id,
+                    COALESCE(c.bot_started, false) AS bot_started,
                     bt.expires_at
                 FROM clients c
                 JOIN bonus_transactions bt ON bt.client_id = c.id
@@ -1626,6 +2191,8 @@ async def cleanup_expired_bonuses() -> None:
             """, today_moscow)
             
             deleted_count = 0
+            burned = 0
+            active_deleted = 0
             for client in clients_to_delete:
                 client_id = client["id"]
                 bot_tg_user_id = client.get("bot_tg_user_id")
@@ -1641,59 +2208,213 @@ async def cleanup_expired_bonuses() -> None:
                     except Exception as e:
                         logging.warning(f"Не удалось отправить сообщение клиенту {bot_tg_user_id} перед удалением: {e}")
                 
-                # Списываем бонусы (если баланс > 0)
-                if bonus_balance > 0:
-                    await conn.execute(
-                        """
-                        UPDATE clients
-                        SET bonus_balance = bonus_balance - LEAST(bonus_balance, $1)
-                        WHERE id = $2
-                        """,
-                        ONBOARDING_BONUS,
-                        client_id
+                # Сгорает то, что реально осталось в сгорающих корзинах (по проекции),
+                # а если проекции нет — как раньше, не больше бонуса за подписку.
+                # Списание не пишем: клиент сейчас удалится, и CASCADE унесёт и
+                # транзакцию, и строку проекции — сумма нужна только для статистики.
+                ledger = await fetch_ledger(conn, client_id)
+                if ledger is not None:
+                    expired = sum(
+                        amount for day, amount in ledger[1]
+                        if day is not None and amount > 0 and date.fromisoformat(day) <= today_moscow
                     )
+                else:
+                    expired = ONBOARDING_BONUS
+                burned += min(expired, max(bonus_balance, 0))
                 
                 # Удаляем клиента (транзакции удалятся автоматически через CASCADE)
                 await conn.execute("DELETE FROM clients WHERE id = $1", client_id)
                 deleted_count += 1
+                if client["bot_started"] and bot_tg_user_id:
+                    active_deleted += 1
                 
                 logging.info(
                     f"Удален клиент ID={client_id}, телефон={client.get('phone')}, "
                     f"баланс был={bonus_balance}, бонусы истекли={client['expires_at']}"
                 )
             
+            await bump_stats(conn, bonus_burned=burned, cleaned_clients=deleted_count, active=-active_deleted)
             if deleted_count > 0:
                 logging.info(f"Очистка завершена: удалено {deleted_count} клиентов с истекшими бонусами")
+            return deleted_count
 
 
-async def main() -> None:
+throttle = ThrottleMiddleware(
+    SlidingWindowLimiter(THROTTLE_BUDGETS),
+    load_shed,
+    is_menu=is_menu_button,
+    exempt=is_admin,
+)
+
+
+def setup_middlewares(dispatcher: Dispatcher) -> None:
+    dispatcher.update.outer_middleware(BotContextMiddleware())
+    # Антифлуд до фильтров: лишние сообщения не трогают ни БД, ни админов
+    dispatcher.message.outer_middleware(throttle)
     # Регистрируем middleware для обработки отписки
     # В aiogram 3.x middleware регистрируется через update
-    dp.update.middleware(UnsubscribeMiddleware())
-    
-    # Настраиваем команды бота (синее меню слева)
-    await bot.set_my_commands([
-        BotCommand(command="start", description="Начать работу с ботом"),
-        BotCommand(command="info", description="Этот бот может"),
-    ])
-    
-    await init_pool(min_size=1, max_size=5)
+    dispatcher.update.middleware(UnsubscribeMiddleware())
+    dispatcher.update.middleware(DegradedModeMiddleware())
+    if UPDATE_RECORD_PATH:
+        # Запись апдейтов для воспроизведения нагрузки (bench.replay); без UPDATE_RECORD_SALT не стартует
+        recorder = UpdateRecorder(Path(UPDATE_RECORD_PATH), keep_text=is_menu_button)
+        dispatcher.update.outer_middleware(recorder)
+        dispatcher.shutdown.register(recorder.flush)
+
+
+def create_dispatcher() -> Dispatcher:
+    dispatcher = Dispatcher(storage=fsm_storage)
+    dispatcher.include_router(router)
+    setup_middlewares(dispatcher)
+    return dispatcher
+
+
+def create_app(configs: Optional[list[BotConfig]] = None) -> tuple[Bot, Dispatcher]:
+    """
+    Собирает ботов и Dispatcher и возвращает основного бота. Вызывается один
+    раз — из main(), бенчмарков или тестов; повторный вызов возвращает уже
+    собранные объекты. Все боты делят одну HTTP-сессию (пул соединений к Bot API).
+    """
+    global bot, dp
+    if bot is None:
+        configs = configs or load_configs()
+        session = _build_telegram_session()
+        for config in configs:
+            telegram_bot = _make_telegram_bot(config.token, session)
+            bots[telegram_bot.id] = telegram_bot
+            bot_configs[telegram_bot.id] = config
+        bot = bots[configs[0].bot_id]
+        chat_routes.default_bot_id = bot.id
+        dp = create_dispatcher()
+    return bot, dp
+
+
+async def remind_expiring_bonuses() -> int:
+    """Напоминания о скором сгорании бонусов за подписку."""
+    return await send_bonus_expiry_reminders(outbound, fallback_amount=ONBOARDING_BONUS, send_func=_send_or_raise)
+
+
+async def _probe_chat(chat_id: int) -> None:
+    await bot_for_chat(chat_id).send_chat_action(chat_id, ChatAction.TYPING)
+
+
+async def _mark_unreachable(chat_ids: list[int]) -> None:
+    for chat_id in chat_ids:
+        blocked_chats.add(chat_id)
+    await blocked_chats.flush()
+
+
+async def sweep_subscriber_liveness() -> int:
+    """Проверка доступности подписчиков бота; при перегрузке запуск пропускается."""
+    if load_shed.active:
+        return 0
+    stats = await sweep_liveness(_probe_chat, _mark_unreachable)
+    return stats["unreachable"]
+
+
+async def ensure_runtime_schema() -> None:
+    """Создаёт служебные таблицы бота, если их ещё нет."""
     pool = get_pool()
     async with pool.acquire() as conn:
         await ensure_service_heartbeat_schema(conn)
-    await _write_client_bot_health(status="starting", last_error=None, mark_ok=False)
-    
+        await ensure_fsm_storage_schema(conn)
+        await ensure_job_runs_schema(conn)
+        await ensure_write_journal_schema(conn)
+        await ensure_bonus_ledger_schema(conn)
+        await ensure_bonus_reminder_schema(conn)
+        await ensure_liveness_schema(conn)
+        await ensure_crm_outbox_schema(conn)
+        await ensure_crm_inbox_schema(conn)
+        await ensure_bot_routes_schema(conn)
+        await ensure_stats_schema(conn)
+
+
+BOT_COMMANDS = [
+    BotCommand(command="start", description="Начать работу с ботом"),
+    BotCommand(command="info", description="Этот бот может"),
+]
+DB_POOL_MAX_SIZE = 5
+
+
+async def _warm_connection(conn: asyncpg.Connection) -> None:
+    """Горячие запросы апдейта: поиск клиента по TG ID и баланс бонусов."""
+    await _fetch_client_by_tg(conn, 0)
+    await get_bonus_info(conn, 0)
+
+
+async def _warm_blocked_chats() -> None:
+    async with acquire() as conn:
+        logging.info("Недоступных чатов в кэше: %s", await blocked_chats.warm(conn))
+
+
+async def _warm_chat_routes() -> None:
+    if len(bots) > 1:
+        async with acquire() as conn:
+            logging.info("Клиентов неосновных ботов: %s", await chat_routes.warm(conn))
+
+
+async def _prepare_database(startup: Startup) -> None:
+    await startup.step("pool", init_pool(min_size=1, max_size=DB_POOL_MAX_SIZE))
+    await startup.step("schema", ensure_runtime_schema())
+    fsm_storage.start()
+
+
+async def main() -> None:
+    # Планировщик нужен только боевому запуску — не тянем его при импорте модуля
+    from apscheduler.schedulers.asyncio import AsyncIOScheduler
+    from apscheduler.triggers.cron import CronTrigger
+
+    telegram_bot, dispatcher = create_app()
+    startup = Startup()
+
+    # БД и Telegram друг от друга не зависят: готовим параллельно
+    await startup.parallel(
+        database=_prepare_database(startup),
+        delete_webhook=asyncio.gather(
+            *(item.delete_webhook(drop_pending_updates=True) for item in bots.values())
+        ),
+    )
+    # Задачи планировщика выполняет только один инстанс — лидер
+    leader = LeaderElector(f"{bot_configs[telegram_bot.id].health_service_key}:scheduler")
+    await startup.parallel(
+        warm_pool=warm_pool(_warm_connection, DB_POOL_MAX_SIZE),
+        blocked_chats=_warm_blocked_chats(),
+        chat_routes=_warm_chat_routes(),
+        leader=leader.start(),
+        health=asyncio.gather(
+            *(
+                _write_client_bot_health(config, status="starting", last_error=None, mark_ok=False)
+                for config in bot_configs.values()
+            )
+        ),
+    )
+    blocked_chats.start()
+    if len(bots) > 1:
+        chat_routes.start()
+    # Прогрев индекса лидов в фоне: до его окончания промахи просто идут в БД
+    warm_leads_task = asyncio.create_task(known_leads.warm(), name="known-leads-warm")
+    # Досылаем записи, накопленные в журнале, пока БД была недоступна
+    write_journal.start_recovery()
+    # Смена статуса заказа в общей БД → уведомление клиенту (шлёт только лидер)
+    order_listener = OrderStatusListener(outbound, should_send=lambda: leader.is_leader, cache=client_chat_cache)
+    if ORDER_PUSH_ENABLED:
+        order_listener.start()
+    if CRM_FORWARD_ENABLED:
+        crm_exporter.start()
+    if CRM_WEBHOOK_SECRET:
+        await crm_replies.start()
+
     # Настраиваем планировщик для ежедневной очистки истекших бонусов
     scheduler = AsyncIOScheduler(timezone=ZoneInfo("Europe/Moscow"))
     scheduler.add_job(
-        cleanup_expired_bonuses,
+        leader.singleton("cleanup_expired_bonuses", cleanup_expired_bonuses),
         trigger=CronTrigger(hour=12, minute=0),  # 12:00 МСК ежедневно
         id="cleanup_expired_bonuses",
         name="Очистка истекших бонусов",
         replace_existing=True,
     )
     scheduler.add_job(
-        heartbeat_client_bot,
+        leader.singleton("client_bot_heartbeat", heartbeat_client_bot),
         trigger="interval",
         seconds=CLIENT_BOT_HEARTBEAT_INTERVAL_SEC,
         id="client_bot_heartbeat",
@@ -1702,15 +2423,86 @@ async def main() -> None:
         coalesce=True,
         max_instances=1,
     )
+    scheduler.add_job(
+        leader.singleton("remind_expiring_bonuses", deferrable(load_shed, remind_expiring_bonuses)),
+        # Основной прогон в 11:00, до очистки в 12:00; следующие часы добирают
+        # временные ошибки и зависшие брони, остальных не трогают
+        trigger=CronTrigger(hour="11-18", minute=0),
+        id="remind_expiring_bonuses",
+        name="Напоминания о сгорании бонусов",
+        replace_existing=True,
+    )
+    scheduler.add_job(
+        leader.singleton("reconcile_bonus_ledger", deferrable(load_shed, reconcile_bonus_ledger)),
+        trigger=CronTrigger(hour=3, minute=30),
+        id="reconcile_bonus_ledger",
+        name="Сверка проекции бонусов",
+        replace_existing=True,
+    )
+    scheduler.add_job(
+        leader.singleton("backfill_phone_digits", deferrable(load_shed, backfill_missing_phone_digits)),
+        trigger=CronTrigger(hour=4, minute=0),
+        id="backfill_phone_digits",
+        name="Догоняющее заполнение phone_digits",
+        replace_existing=True,
+    )
+    scheduler.add_job(
+        leader.singleton("sweep_subscriber_liveness", sweep_subscriber_liveness),
+        trigger="interval",
+        minutes=LIVENESS_TICK_MIN,
+        id="sweep_subscriber_liveness",
+        name="Проверка доступности подписчиков",
+        replace_existing=True,
+        coalesce=True,
+        max_instances=1,
+    )
+    scheduler.add_job(
+        leader.singleton("backfill_stats", deferrable(load_shed, backfill_stats)),
+        trigger=CronTrigger(hour=4, minute=45),
+        # Первый запуск вскоре после старта: история для /stats появится сразу
+        next_run_time=datetime.now(MOSCOW_TZ) + timedelta(minutes=1),
+        id="backfill_stats",
+        name="История и сверка счётчиков /stats",
+        replace_existing=True,
+    )
+    scheduler.add_job(
+        leader.singleton("prune_job_runs", prune_job_runs),
+        trigger=CronTrigger(hour=4, minute=30),
+        id="prune_job_runs",
+        name="Очистка истории запусков задач",
+        replace_existing=True,
+    )
     scheduler.start()
     logging.info("Планировщик запущен: очистка истекших бонусов ежедневно в 12:00 МСК")
-    
+
+    # Команды меню и первый heartbeat не нужны для приёма апдейтов — после старта polling
+    startup.defer(
+        "set_my_commands",
+        lambda: asyncio.gather(*(item.set_my_commands(BOT_COMMANDS) for item in bots.values())),
+    )
+
+    async def first_heartbeat() -> None:
+        if leader.is_leader:
+            await heartbeat_client_bot()
+
+    startup.defer("first_heartbeat", first_heartbeat)
+    dispatcher.startup.register(startup.launch_deferred)
+
     try:
-        await heartbeat_client_bot()
-        await bot.delete_webhook(drop_pending_updates=True)
-        await dp.start_polling(bot)
+        # Все боты — в одном цикле событий и с одним пулом БД
+        await dispatcher.start_polling(*bots.values())
     finally:
         scheduler.shutdown()
+        warm_leads_task.cancel()
+        await order_listener.stop()
+        await crm_exporter.stop()
+        await crm_replies.stop()
+        await blocked_chats.stop()
+        await chat_routes.stop()
+        await leader.stop()
+        await write_journal.stop()
+        # start_polling хранилище не закрывает — без этого несброшенные состояния FSM теряются
+        await fsm_storage.close()
         await close_pool()
 
 